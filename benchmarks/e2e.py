@@ -0,0 +1,255 @@
+"""
+Run the bot against local fake Telegram, OpenAI and Replicate servers,
+replay a synthetic stream of updates and report throughput, handler latency
+and memory of the bot process. Example:
+>>> python -m benchmarks.e2e --updates 2000 --rate 200 --openai-latency 0.3
+Settings of the bot can be overridden with a TOML file merged into the
+generated config, so two runs can be compared:
+>>> python -m benchmarks.e2e --config sender-off.toml
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+from typing import Optional
+
+import toml
+
+from benchmarks import fakes
+
+ROOT = Path(__file__).resolve().parent.parent
+TOKEN = "123456:bench"
+# Share of every kind of update in the stream
+MIX = {
+    "chat": 0.25,
+    "completion": 0.1,
+    "dalle": 0.05,
+    "replicate": 0.05,
+    "voice": 0.05,
+    "chatter": 0.5,
+}
+COMMANDS = {"chat": "/c", "completion": "/t", "dalle": "/d", "replicate": "/m"}
+
+
+def get_config(base_url: str, users: int, groups: int, extra: dict) -> dict:
+    config = {
+        "debug": False,
+        "install_global_handlers": True,
+        "general": {},
+        "telegram": {
+            "bot_token": TOKEN,
+            "api_url": base_url,
+            "allowed_users": list(range(1, users + 1)),
+            "allowed_chats": [-i for i in range(1, groups + 1)],
+        },
+        "integrations": {
+            "openai": {
+                "api_key": "bench",
+                "networks": [
+                    network("completion", "davinci", "t", "text"),
+                    network("chat", "gpt", "c", "text"),
+                    network("image", "dalle", "d", "text"),
+                ],
+            },
+            "replicate": {
+                "api_key": "bench",
+                "networks": [
+                    network("bench/image", "image", "m", "image"),
+                    network("bench/audio", "audio", "a", "audio"),
+                ],
+            },
+        },
+    }
+    return merge(config, extra)
+
+
+def network(name: str, version: str, command: str, type: str) -> dict:
+    return {"name": name, "version": version, "command": command, "type": type}
+
+
+def merge(base: dict, extra: dict) -> dict:
+    for key, value in extra.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            merge(base[key], value)
+        else:
+            base[key] = value
+    return base
+
+
+def generate_updates(count: int, users: int, groups: int, seed: int):
+    """
+    Yield (update, kind, expects_answer), commands come from private
+    chats and groups, chatter only from groups.
+    """
+    rng = random.Random(seed)
+    kinds, weights = zip(*MIX.items())
+    for update_id in range(1, count + 1):
+        kind = rng.choices(kinds, weights)[0]
+        user_id = rng.randint(1, users)
+        private = kind != "chatter" and rng.random() < 0.5
+        chat_id = user_id if private else -rng.randint(1, groups)
+        message = {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if private else "group"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"},
+        }
+        if kind == "voice":
+            message["voice"] = {
+                "file_id": f"voice-{update_id}",
+                "file_unique_id": f"voice-{update_id}",
+                "duration": 5,
+                "mime_type": "audio/ogg",
+                "file_size": len(fakes.VOICE),
+            }
+        elif kind == "chatter":
+            message["text"] = f"Just chatting {update_id}"
+        else:
+            # A few prompts repeat, like in real chats
+            message["text"] = f"{COMMANDS[kind]} prompt {rng.randint(1, 50)}"
+        yield {"update_id": update_id, "message": message}, kind, kind != "chatter"
+
+
+def start_bot(workdir: Path, runtime: str, env: dict) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", "src.app", "--runtime", runtime],
+        cwd=workdir,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+
+
+def get_memory(pid: int) -> dict[str, int]:
+    """
+    Resident memory of the process in KiB, Linux only.
+    """
+    memory = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in ("VmRSS", "VmHWM"):
+                    memory[name] = int(value.split()[0])
+    except OSError:
+        pass
+    return memory
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, round(p / 100 * (len(values) - 1)))
+    return values[index]
+
+
+def report(
+    results: dict[str, list[Optional[float]]], elapsed: float, acknowledged: int
+):
+    print(
+        f"{acknowledged} updates in {elapsed:.1f}s, "
+        f"{acknowledged / elapsed:.1f} updates/sec"
+    )
+    print(f"{'kind':>10} {'count':>6} {'lost':>5} {'p50':>7} {'p95':>7} {'p99':>7}")
+    everything = []
+    for kind, latencies in sorted(results.items()):
+        answered = sorted(latency for latency in latencies if latency is not None)
+        everything.extend(answered)
+        print_row(kind, len(latencies), len(latencies) - len(answered), answered)
+    everything.sort()
+    lost = sum(len(latencies) for latencies in results.values()) - len(everything)
+    print_row("all", len(everything) + lost, lost, everything)
+
+
+def print_row(kind: str, count: int, lost: int, latencies: list[float]):
+    p50, p95, p99 = (percentile(latencies, p) for p in (50, 95, 99))
+    print(f"{kind:>10} {count:6d} {lost:5d} {p50:7.3f} {p95:7.3f} {p99:7.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=1000)
+    parser.add_argument(
+        "--rate", type=float, default=100, help="updates/sec, 0 for all at once"
+    )
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--runtime", choices=("sync", "async"), default="sync")
+    parser.add_argument("--telegram-latency", type=float, default=0.02)
+    parser.add_argument("--openai-latency", type=float, default=0.3)
+    parser.add_argument("--replicate-latency", type=float, default=1.0)
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="of OpenAI and Replicate"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=120, help="wait for answers, seconds"
+    )
+    parser.add_argument("--config", type=Path, help="TOML merged into the bot config")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = fakes.FakeServer(
+        telegram=fakes.Service(args.telegram_latency),
+        openai=fakes.Service(args.openai_latency, args.error_rate),
+        replicate=fakes.Service(args.replicate_latency, args.error_rate),
+    )
+    server.start()
+    extra = toml.load(args.config) if args.config else {}
+    with tempfile.TemporaryDirectory(prefix="bench-") as workdir:
+        config = get_config(server.base_url, args.users, args.groups, extra)
+        (Path(workdir) / "config.toml").write_text(toml.dumps(config))
+        env = {
+            **os.environ,
+            "PYTHONPATH": str(ROOT),
+            "OPENAI_API_BASE": f"{server.base_url}/v1",
+            "REPLICATE_API_BASE_URL": server.base_url,
+            "REPLICATE_POLL_INTERVAL": "0.1",
+        }
+        started = time.monotonic()
+        process = start_bot(Path(workdir), args.runtime, env)
+        try:
+            if not server.telegram.polled.wait(60):
+                process.terminate()
+                _, stderr = process.communicate()
+                raise SystemExit(f"Bot didn't start: {(stderr or b'').decode()}")
+            startup = time.monotonic() - started
+            print(f"Bot started in {startup:.2f}s, {args.runtime} runtime")
+            elapsed = run(server.telegram, args)
+            memory = get_memory(process.pid)
+        finally:
+            process.terminate()
+            process.wait()
+    report(server.telegram.get_results(), elapsed, server.telegram.acknowledged)
+    if memory:
+        rss, peak = memory["VmRSS"] / 1024, memory["VmHWM"] / 1024
+        print(f"memory: {rss:.1f} MiB rss, {peak:.1f} MiB peak")
+    server.shutdown()
+
+
+def run(telegram: fakes.Telegram, args: argparse.Namespace) -> float:
+    """
+    Release updates at the given rate and wait until they are answered,
+    return how long it took.
+    """
+    started = time.monotonic()
+    updates = generate_updates(args.updates, args.users, args.groups, args.seed)
+    for i, (update, kind, expects_answer) in enumerate(updates):
+        if args.rate:
+            delay = started + i / args.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        telegram.release(update, kind, expects_answer)
+    deadline = time.monotonic() + args.timeout
+    while time.monotonic() < deadline:
+        if telegram.acknowledged >= args.updates and not telegram.unanswered():
+            break
+        time.sleep(0.1)
+    return time.monotonic() - started
+
+
+if __name__ == "__main__":
+    main()
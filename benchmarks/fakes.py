@@ -0,0 +1,384 @@
+"""
+Local stand-ins for Telegram Bot API, OpenAI and Replicate served by a single
+HTTP server, so the bot can be benchmarked without network and API keys.
+Every service answers after the configured latency and fails the configured
+share of requests. Telegram keeps track of when every update was handed out
+and when the bot answered it.
+"""
+import json
+import time
+import random
+import itertools
+import threading
+from typing import cast
+from typing import Optional
+from dataclasses import field
+from dataclasses import dataclass
+from email import policy
+from email.parser import BytesParser
+from urllib.parse import parse_qsl, urlparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Replies that don't answer the update yet
+PLACEHOLDERS = ("...", "Generating text...")
+IMAGE = b"\x89PNG\r\n\x1a\n" + b"\x00" * 1024
+VOICE = b"OggS" + b"\x00" * 4096
+
+
+@dataclass
+class Service:
+    latency: float = 0.0  # seconds, answers take from latency to twice as long
+    error_rate: float = 0.0  # share of requests failed with 503
+
+    def delay(self):
+        if self.latency:
+            time.sleep(self.latency * (1 + random.random()))
+
+    def fails(self) -> bool:
+        return random.random() < self.error_rate
+
+
+@dataclass
+class Pending:
+    kind: str
+    released_at: float
+    answered_at: Optional[float] = None
+
+
+@dataclass
+class Telegram:
+    """
+    Hands out updates with getUpdates and records answers to them.
+    """
+
+    service: Service
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    released: threading.Condition = field(default_factory=threading.Condition)
+    updates: list[dict] = field(default_factory=list)
+    pending: dict[tuple[int, int], Pending] = field(default_factory=dict)
+    # Sent message to the update it answers, by (chat_id, message_id)
+    replies: dict[tuple[int, int], tuple[int, int]] = field(default_factory=dict)
+    message_ids: itertools.count = field(
+        default_factory=lambda: itertools.count(10**6)
+    )
+    polled: threading.Event = field(default_factory=threading.Event)
+    acknowledged: int = 0  # update id confirmed by the bot
+    errors: int = 0
+
+    def release(self, update: dict, kind: str, expects_answer: bool):
+        message = update["message"]
+        key = (message["chat"]["id"], message["message_id"])
+        with self.lock:
+            if expects_answer:
+                self.pending[key] = Pending(kind, time.monotonic())
+        with self.released:
+            self.updates.append(update)
+            self.released.notify_all()
+
+    def get_updates(self, params: dict) -> list[dict]:
+        self.polled.set()
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        with self.released:
+            self.acknowledged = max(self.acknowledged, offset - 1)
+            deadline = time.monotonic() + timeout
+            while True:
+                updates = [u for u in self.updates if u["update_id"] >= offset]
+                if updates or time.monotonic() >= deadline:
+                    # Acknowledged updates aren't needed anymore
+                    self.updates = updates
+                    return updates[:limit]
+                self.released.wait(deadline - time.monotonic())
+
+    def send(self, method: str, params: dict) -> dict:
+        chat_id = int(params["chat_id"])
+        message_id = next(self.message_ids)
+        reply_to = params.get("reply_to_message_id")
+        if not reply_to and params.get("reply_parameters"):
+            reply_to = json.loads(params["reply_parameters"]).get("message_id")
+        text = params.get("text", "")
+        if reply_to:
+            origin = (chat_id, int(reply_to))
+            with self.lock:
+                self.replies[(chat_id, message_id)] = origin
+            self._answer(origin, method, text)
+        return self._message(chat_id, message_id, text, method == "sendPhoto")
+
+    def edit(self, params: dict) -> dict:
+        chat_id = int(params["chat_id"])
+        message_id = int(params["message_id"])
+        with self.lock:
+            origin = self.replies.get((chat_id, message_id))
+        if origin:
+            self._answer(origin, "editMessageText", params.get("text", ""))
+        return self._message(chat_id, message_id, params.get("text", ""), False)
+
+    def get_results(self) -> dict[str, list[Optional[float]]]:
+        """
+        Handler latencies by kind of update, None for unanswered ones.
+        """
+        results: dict[str, list] = {}
+        with self.lock:
+            for pending in self.pending.values():
+                latency = None
+                if pending.answered_at is not None:
+                    latency = pending.answered_at - pending.released_at
+                results.setdefault(pending.kind, []).append(latency)
+        return results
+
+    def unanswered(self) -> int:
+        with self.lock:
+            return sum(1 for p in self.pending.values() if p.answered_at is None)
+
+    def _answer(self, origin: tuple[int, int], method: str, text: str):
+        placeholder = text in PLACEHOLDERS or text.startswith("Queued")
+        if method != "sendPhoto" and placeholder:
+            return
+        with self.lock:
+            pending = self.pending.get(origin)
+            if pending and pending.answered_at is None:
+                pending.answered_at = time.monotonic()
+
+    def _message(self, chat_id: int, message_id: int, text: str, photo: bool) -> dict:
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+            "text": text,
+        }
+        if photo:
+            message["photo"] = [
+                {
+                    "file_id": f"photo-{message_id}",
+                    "file_unique_id": f"photo-{message_id}",
+                    "width": 768,
+                    "height": 768,
+                }
+            ]
+        return message
+
+
+@dataclass
+class Replicate:
+    service: Service
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    # Prediction id to (version id, finished at)
+    predictions: dict[str, tuple[str, float]] = field(default_factory=dict)
+    ids: itertools.count = field(default_factory=itertools.count)
+
+    def create(self, body: dict, base_url: str) -> dict:
+        prediction_id = f"prediction-{next(self.ids)}"
+        latency = self.service.latency * (1 + random.random())
+        with self.lock:
+            self.predictions[prediction_id] = (
+                body["version"],
+                time.monotonic() + latency,
+            )
+        return self.get(prediction_id, base_url)
+
+    def get(self, prediction_id: str, base_url: str) -> dict:
+        with self.lock:
+            version, finished_at = self.predictions[prediction_id]
+        finished = time.monotonic() >= finished_at
+        output = None
+        if finished and "audio" in version:
+            output = {
+                "segments": [{"start": 0.0, "end": 2.0, "text": " Benchmark voice"}],
+                "transcription": " Benchmark voice",
+            }
+        elif finished:
+            output = [f"{base_url}/images/{prediction_id}.png"]
+        return {
+            "id": prediction_id,
+            "version": version,
+            "status": "succeeded" if finished else "processing",
+            "input": {},
+            "output": output,
+            "error": None,
+            "logs": "",
+            "created_at": None,
+            "started_at": None,
+            "completed_at": None,
+        }
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self._dispatch()
+
+    def do_POST(self):
+        self._dispatch()
+
+    def _dispatch(self):
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+        body = self._read_body(params)
+        parts = url.path.strip("/").split("/")
+        server = cast("FakeServer", self.server)
+        if parts[0].startswith("bot"):
+            return self._telegram(parts[1], params)
+        if parts[0] == "file":
+            server.telegram.service.delay()
+            return self._send_bytes(VOICE, "audio/ogg")
+        if parts[0] == "images":
+            return self._send_bytes(IMAGE, "image/png")
+        if parts[:2] == ["v1", "models"]:
+            # Version of a Replicate model
+            return self._send_json(
+                {
+                    "id": parts[-1],
+                    "created_at": "2023-01-01T00:00:00Z",
+                    "cog_version": "0.6.0",
+                    "openapi_schema": {
+                        "components": {"schemas": {"Output": {"type": "string"}}}
+                    },
+                }
+            )
+        if parts[:2] == ["v1", "predictions"]:
+            replicate = server.replicate
+            if len(parts) == 2:
+                replicate.service.delay()
+                if replicate.service.fails():
+                    return self._send_json({"detail": "Injected error"}, 503)
+                return self._send_json(replicate.create(body, server.base_url), 201)
+            return self._send_json(replicate.get(parts[2], server.base_url))
+        if parts[0] == "v1":
+            return self._openai("/".join(parts[1:]), body)
+        self._send_json({"error": "Not found"}, 404)
+
+    def _telegram(self, method: str, params: dict):
+        telegram = cast("FakeServer", self.server).telegram
+        if method == "getUpdates":
+            return self._send_json({"ok": True, "result": telegram.get_updates(params)})
+        telegram.service.delay()
+        if method in ("sendMessage", "sendPhoto"):
+            result = telegram.send(method, params)
+        elif method == "editMessageText":
+            result = telegram.edit(params)
+        elif method == "getFile":
+            result = {
+                "file_id": params["file_id"],
+                "file_unique_id": params["file_id"],
+                "file_size": len(VOICE),
+                "file_path": f"voice/{params['file_id']}.oga",
+            }
+        elif method == "getMe":
+            result = {
+                "id": 1,
+                "is_bot": True,
+                "first_name": "Bench",
+                "username": "bench_bot",
+            }
+        else:
+            result = True
+        self._send_json({"ok": True, "result": result})
+
+    def _openai(self, endpoint: str, body: dict):
+        server = cast("FakeServer", self.server)
+        openai = server.openai
+        openai.delay()
+        if openai.fails():
+            return self._send_json(
+                {"error": {"message": "Injected error", "type": "server_error"}}, 503
+            )
+        usage = {"prompt_tokens": 10, "completion_tokens": 10, "total_tokens": 20}
+        if endpoint == "chat/completions":
+            message = {"role": "assistant", "content": "Benchmark answer"}
+            return self._send_json(
+                {
+                    "id": "chat",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body.get("model", ""),
+                    "choices": [
+                        {"index": 0, "message": message, "finish_reason": "stop"}
+                    ],
+                    "usage": usage,
+                }
+            )
+        if endpoint == "completions":
+            return self._send_json(
+                {
+                    "id": "completion",
+                    "object": "text_completion",
+                    "created": int(time.time()),
+                    "model": body.get("model", ""),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "text": "Benchmark answer",
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": usage,
+                }
+            )
+        if endpoint == "images/generations":
+            number = next(server.replicate.ids)
+            url = f"{server.base_url}/images/dalle-{number}.png"
+            return self._send_json(
+                {"created": int(time.time()), "data": [{"url": url}]}
+            )
+        self._send_json({"error": {"message": "Not found"}}, 404)
+
+    def _read_body(self, params: dict) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        raw = self.rfile.read(length)
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.startswith("application/json"):
+            return json.loads(raw)
+        if content_type.startswith("application/x-www-form-urlencoded"):
+            params.update(parse_qsl(raw.decode()))
+        elif content_type.startswith("multipart/form-data"):
+            message = BytesParser(policy=policy.default).parsebytes(
+                f"Content-Type: {content_type}\r\n\r\n".encode() + raw
+            )
+            for part in message.iter_parts():
+                name = part.get_param("name", header="content-disposition")
+                if name and not part.get_filename():
+                    payload = cast(bytes, part.get_payload(decode=True))
+                    params[name] = payload.decode()
+        return {}
+
+    def _send_json(self, data, status: int = 200):
+        self._send_bytes(json.dumps(data).encode(), "application/json", status)
+
+    def _send_bytes(self, body: bytes, content_type: str, status: int = 200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        telegram: Service,
+        openai: Service,
+        replicate: Service,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        super().__init__((host, port), FakeHandler)
+        self.base_url = f"http://{host}:{self.server_port}"
+        self.telegram = Telegram(telegram)
+        self.openai = openai
+        self.replicate = Replicate(replicate)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="fakes", daemon=True).start()
+
+    def handle_error(self, request, client_address):
+        # The bot is stopped in the middle of long polling
+        pass
@@ -0,0 +1,92 @@
+"""
+Compare memory used by dialogs history before and after compact entries:
+slotted dataclasses with interned roles kept in lists capped in place.
+Has to be started from the directory with config.toml, example:
+>>> python -m benchmarks.memory --conversations 100000 --entries 5
+"""
+import time
+import argparse
+import tracemalloc
+from dataclasses import dataclass
+
+from src import model
+from src import storage
+
+
+@dataclass
+class LegacyChatHistoryEntry:
+    """
+    History entry as it was before: a dataclass with __dict__ kept in a list.
+    """
+
+    timestamp: int
+    message: str
+    message_role: str
+    response: str
+
+
+def fill_legacy(conversations: int, entries: int, limit: int) -> dict:
+    chats: dict[str, list[LegacyChatHistoryEntry]] = {}
+    now = int(time.time())
+    for i in range(conversations):
+        key = f"{i}:{i}"
+        for j in range(entries):
+            if key not in chats:
+                chats[key] = []
+            chats[key].append(
+                LegacyChatHistoryEntry(
+                    timestamp=now + j,
+                    message=f"message {i} {j}",
+                    message_role="user",
+                    response=f"response {i} {j}",
+                )
+            )
+            chats[key] = chats[key][-limit:]
+    return chats
+
+
+def fill_compact(conversations: int, entries: int, limit: int):
+    backend = storage.MemoryDialogsBackend(limit)
+    now = int(time.time())
+    for i in range(conversations):
+        key = f"{i}:{i}"
+        for j in range(entries):
+            backend.append(
+                storage.CHATS,
+                key,
+                model.ChatHistoryEntry.from_message(
+                    f"message {i} {j}", now + j, f"response {i} {j}"
+                ),
+            )
+    return backend
+
+
+def measure(fill, conversations: int, entries: int, limit: int) -> int:
+    tracemalloc.start()
+    result = fill(conversations, entries, limit)
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return used
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--conversations", type=int, default=100_000)
+    parser.add_argument("--entries", type=int, default=5)
+    parser.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args()
+    print(
+        f"{args.conversations} conversations, {args.entries} entries each, "
+        f"limit {args.limit}"
+    )
+    for name, fill in (("before", fill_legacy), ("after", fill_compact)):
+        used = measure(fill, args.conversations, args.entries, args.limit)
+        print(
+            f"{name:>6}: {used / 1024 / 1024:8.1f} MiB, "
+            f"{used / args.conversations:8.0f} bytes per conversation"
+        )
+
+
+if __name__ == "__main__":
+    main()
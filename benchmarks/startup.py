@@ -0,0 +1,77 @@
+"""
+Measure cold start: time from a fresh interpreter to a bot ready to poll,
+the way containers are started under autoscaling. Every run is a new process,
+so nothing is cached in memory. Integrations are loaded in the background
+after the bot is built, their import time is reported separately. Example:
+>>> python -m benchmarks.startup --runs 10 --runtime async
+Uses config.toml of the working directory unless --config is given.
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+# Runs in the child process, prints timings as JSON
+SCRIPT = """
+import sys
+import json
+import time
+
+started = time.perf_counter()
+from src import app
+from src import config
+
+cfg = config.load_settings({config!r})
+app.create_bot(cfg, {runtime!r})
+ready = time.perf_counter()
+from src import integrations
+
+loaded = [m for m in ("openai", "replicate", "aiohttp") if m in sys.modules]
+for name in integrations.get_configured():
+    getattr(integrations, name)
+print(json.dumps({{
+    "ready": ready - started,
+    "integrations": time.perf_counter() - ready,
+    "loaded": loaded,
+}}))
+"""
+
+
+def measure(config: Path, runtime: str) -> dict:
+    script = SCRIPT.format(config=str(config), runtime=runtime)
+    output = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=config.parent,
+        env={**os.environ, "PYTHONPATH": str(ROOT)},
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--runtime", choices=("sync", "async"), default="sync")
+    parser.add_argument("--config", type=Path, default=Path.cwd() / "config.toml")
+    args = parser.parse_args()
+
+    # The first run warms up the file system cache and compiles bytecode
+    measure(args.config.resolve(), args.runtime)
+    results = [measure(args.config.resolve(), args.runtime) for _ in range(args.runs)]
+    ready = [r["ready"] for r in results]
+    deferred = [r["integrations"] for r in results]
+    print(f"{args.runs} runs, {args.runtime} runtime")
+    median = statistics.median(ready)
+    print(f"bot ready:    median {median:.3f}s, min {min(ready):.3f}s")
+    print(f"integrations: median {statistics.median(deferred):.3f}s, in background")
+    print(f"loaded before ready: {', '.join(results[0]['loaded']) or 'nothing'}")
+
+
+if __name__ == "__main__":
+    main()
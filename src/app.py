@@ -0,0 +1,55 @@
+"""
+Application factory and entry point. The bot is built from settings
+passed in instead of config.toml in the working directory, example:
+>>> cfg = config.load_settings(Path("/etc/bot/config.toml"))
+>>> bot = app.create_bot(cfg)
+Run it with:
+>>> python -m src.app --config /etc/bot/config.toml --runtime async
+Settings are global, so a process runs a single bot.
+"""
+import asyncio
+import argparse
+from pathlib import Path
+from typing import Optional
+
+from . import config
+
+SYNC = "sync"
+ASYNC = "async"
+
+
+def create_bot(cfg: Optional[config.Config] = None, runtime: str = SYNC):
+    """
+    Build TeleBot or AsyncTeleBot with handlers of configured networks,
+    without starting it. Integrations are imported on first use.
+    """
+    if cfg is not None:
+        cfg.validate()
+        config.set_settings(cfg)
+    if runtime == ASYNC:
+        from . import async_bot
+
+        return async_bot.create_bot()
+    from . import bot
+
+    return bot.create_bot()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Telegram bot for AI networks")
+    parser.add_argument("--config", type=Path, help="config.toml by default")
+    parser.add_argument("--runtime", choices=(SYNC, ASYNC), default=SYNC)
+    args = parser.parse_args()
+    config.set_settings(config.load_settings(args.config))
+    if args.runtime == ASYNC:
+        from . import async_bot
+
+        asyncio.run(async_bot.main())
+    else:
+        from . import bot
+
+        bot.main()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,432 @@
+import sys
+import asyncio
+from typing import BinaryIO
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+
+import telebot
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+from . import jobs
+from . import media
+from . import model
+from . import handlers
+from . import utils
+from . import store
+from . import config
+from . import scheduler
+from . import sender
+from . import transcription
+from . import routing
+from . import streaming
+from . import metrics
+from . import connections
+from . import integrations
+
+
+logger = config.logger
+settings = config.get_settings()
+dialogs_store = store.DialogsStore.get_instance()
+job_scheduler = scheduler.Scheduler.get_instance()
+router = routing.Router.get_instance()
+
+if settings.telegram.api_url:
+    asyncio_helper.API_URL = settings.telegram.api_url.rstrip("/") + "/bot{0}/{1}"
+
+
+class TeleBot(AsyncTeleBot):
+    """
+    Drops updates no handler would act on before filters.
+    """
+
+    async def process_new_updates(self, updates: list[telebot.types.Update]):
+        await super().process_new_updates(router.filter_updates(updates))
+
+
+# Set by create_bot
+bot: TeleBot
+outbox: sender.AsyncSender
+
+
+async def handle_start(m: telebot.types.Message):
+    handlers.start(outbox, m)
+
+
+async def handle_ping(m: telebot.types.Message):
+    handlers.ping(outbox, m)
+
+
+async def handle_help(m: telebot.types.Message):
+    handlers.show_help(outbox, m)
+
+
+async def handle_whitelist(m: telebot.types.Message):
+    handlers.whitelist(outbox, m)
+
+
+async def handle_blacklist(m: telebot.types.Message):
+    handlers.blacklist(outbox, m)
+
+
+async def handle_stats(m: telebot.types.Message):
+    handlers.show_stats(outbox, m)
+
+
+async def handle_breakers(m: telebot.types.Message):
+    handlers.show_breakers(outbox, m)
+
+
+async def get_audio_file(file_id: str) -> BinaryIO:
+    """
+    Download audio file from the message, the file has to be closed.
+    """
+    file_info = await bot.get_file(file_id)
+    return await asyncio.to_thread(media.download_telegram_file, file_info.file_path)
+
+
+def schedule(
+    m: telebot.types.Message, cfg: model.Network, fn, *args, key=None, notify=True
+):
+    """
+    Run job in the worker pool of the network.
+    Jobs with the same key, e.g. of the same dialog, run one after another.
+    Replies with the position when the job has to wait in the queue.
+    """
+    try:
+        position = job_scheduler.submit_async(cfg, fn, m, cfg, *args, key=key)
+    except model.QueueFullException:
+        logger.warning(f">>> Queue is full, rejected request to {cfg.name}")
+        if notify:
+            outbox.reply_to(m, "Too many requests, please try again later")
+        return
+    if position and notify:
+        outbox.reply_to(m, f"Queued, position {position}")
+
+
+async def handle_replicate_request(m: telebot.types.Message):
+    """
+    Image generation and voice-to-text decode using Replicate API.
+    Example:
+    >>> /m A sunset on the beach
+    """
+    cfg = handlers.find_network(outbox, m)
+    if not cfg:
+        return
+    if cfg.type == "audio":
+        reply_to = m.reply_to_message
+        voice = handlers.check_voice(outbox, m, reply_to.voice if reply_to else None)
+        if voice:
+            schedule(m, cfg, process_replicate_audio_request, voice)
+        return
+    if cfg.type == "image":
+        return schedule(m, cfg, process_replicate_image_request)
+    outbox.reply_to(m, "Unknown command type")
+
+
+async def process_replicate_audio_request(
+    m: telebot.types.Message, cfg: model.Network, voice: telebot.types.Voice
+):
+    text = utils.get_message_text(m)
+    try:
+        file = await get_audio_file(voice.file_id)
+    except model.FileTooLargeException as e:
+        return outbox.reply_to(m, str(e))
+    with file:
+        # Long messages are split into chunks transcribed in parallel instead
+        duration = voice.duration
+        if settings.jobs.enabled and not transcription.should_split(duration):
+            error = await asyncio.to_thread(
+                jobs.JobManager.get_instance().submit,
+                jobs.AUDIO,
+                cfg,
+                m,
+                lambda: integrations.replicate.start_replicate_audio_prediction(
+                    file, text, cfg
+                ),
+            )
+            if error:
+                outbox.reply_to(m, error)
+            return
+        response, error = await transcription.transcribe_async(
+            file, duration, text, cfg
+        )
+    outbox.reply_to(m, error or response)
+
+
+async def process_replicate_image_request(
+    m: telebot.types.Message, cfg: model.Network
+):
+    text = utils.get_message_text(m)
+    if settings.jobs.enabled:
+        error = await asyncio.to_thread(
+            jobs.JobManager.get_instance().submit,
+            jobs.IMAGE,
+            cfg,
+            m,
+            lambda: integrations.replicate.start_replicate_image_prediction(text, cfg),
+            key=f"{cfg.command}:{text}",
+        )
+        if error:
+            outbox.reply_to(m, error)
+        return
+    response, error = await integrations.replicate.get_replicate_image_response_async(
+        text, cfg
+    )
+    if error:
+        return outbox.reply_to(m, error)
+    await media.send_photo_async(
+        outbox, m.chat.id, response, reply_to_message_id=m.message_id
+    )
+
+
+async def handle_dalle_request(m: telebot.types.Message):
+    """
+    Image generation using OpenAI Dall-E API.
+    Example:
+    >>> /d A sunset on the beach
+    """
+    cfg = handlers.find_network(outbox, m)
+    if cfg:
+        schedule(m, cfg, process_dalle_request)
+
+
+async def process_dalle_request(m: telebot.types.Message, cfg: model.Network):
+    text = utils.get_message_text(m)
+    response, error = await integrations.openai.get_dalle_response_async(text)
+    if error:
+        return outbox.reply_to(m, error)
+    await media.send_photo_async(
+        outbox, m.chat.id, response, reply_to_message_id=m.message_id
+    )
+
+
+async def handle_completion_request(m: telebot.types.Message):
+    """
+    Conversation handler using OpenAI text completion models.
+    Example:
+    >>> /d What is the meaning of life?
+    To clean the history:
+    >>> /d clear
+    """
+    cfg = handlers.find_network(outbox, m)
+    if not cfg:
+        return
+    unique_id = handlers.get_dialog_id(m)
+    schedule(m, cfg, process_completion_request, unique_id, key=unique_id)
+
+
+async def process_completion_request(
+    m: telebot.types.Message, cfg: model.Network, unique_id: str
+):
+    if handlers.clean_completion(outbox, m, cfg, unique_id):
+        return
+    text = utils.get_message_text(m)
+    history = dialogs_store.get_from_completions(unique_id)
+    response, error = await integrations.openai.get_completion_response_async(
+        history, text, cfg
+    )
+    handlers.finish_completion(outbox, m, cfg, unique_id, response, error)
+
+
+async def handle_chat_request(m: telebot.types.Message):
+    """
+    Chat handler using OpenAI chat models.
+    Example:
+    >>> /c You are a helpful Twitch moderator
+    To clean the history:
+    >>> /c clear
+    """
+    cfg = handlers.find_network(outbox, m)
+    if not cfg:
+        return
+    unique_id = handlers.get_dialog_id(m)
+    schedule(m, cfg, process_chat_request, unique_id, key=unique_id)
+
+
+async def process_chat_request(
+    m: telebot.types.Message, cfg: model.Network, unique_id: str
+):
+    if handlers.clean_chat(outbox, m, cfg, unique_id):
+        return
+    text = utils.get_message_text(m)
+    history = dialogs_store.get_from_chats(unique_id)
+    if settings.integrations.openai and settings.integrations.openai.stream:
+        return await process_chat_stream_request(m, history, cfg, unique_id)
+    response, error = await integrations.openai.get_chat_response_async(
+        history, text, cfg
+    )
+    handlers.finish_chat(outbox, m, cfg, unique_id, response, error)
+
+
+async def process_chat_stream_request(
+    m: telebot.types.Message,
+    history: list[model.ChatHistoryEntry],
+    cfg: model.Network,
+    unique_id: str,
+):
+    text = utils.get_message_text(m)
+    chunks, error = await integrations.openai.get_chat_stream_async(history, text, cfg)
+    if error or not chunks:
+        return outbox.reply_to(m, error or "Error while getting response")
+    openai_settings = settings.integrations.openai
+    interval = openai_settings.stream_edit_interval if openai_settings else 0
+    try:
+        response = await streaming.AsyncStreamingReply(outbox, m, interval).consume(
+            chunks
+        )
+    except Exception as e:
+        return outbox.reply_to(m, f"Error while getting response, {e}")
+    handlers.save_chat(m, cfg, unique_id, response)
+
+
+async def handle_voice_message(m: telebot.types.Message):
+    """
+    Handler to automatically convert voice messages to text.
+    Should not get triggered if message starts with a command.
+    """
+    cfg = handlers.find_audio_network(outbox, m)
+    if not cfg:
+        return
+    voice = handlers.check_voice(outbox, m, m.voice)
+    if voice:
+        schedule(m, cfg, process_voice_message, voice)
+
+
+async def process_voice_message(
+    m: telebot.types.Message, cfg: model.Network, voice: telebot.types.Voice
+):
+    msg = await outbox.reply_to(m, "Generating text...")
+    try:
+        file = await get_audio_file(voice.file_id)
+    except model.FileTooLargeException as e:
+        return handlers.finish_transcription(outbox, m, msg.id, "", str(e))
+    with file:
+        # Long messages are split into chunks transcribed in parallel instead
+        duration = voice.duration
+        if settings.jobs.enabled and not transcription.should_split(duration):
+            error = await asyncio.to_thread(
+                jobs.JobManager.get_instance().submit,
+                jobs.AUDIO,
+                cfg,
+                m,
+                lambda: integrations.replicate.start_replicate_audio_prediction(
+                    file, "", cfg
+                ),
+                status_message_id=msg.id,
+            )
+            if error:
+                handlers.finish_transcription(outbox, m, msg.id, "", error)
+            return
+        response, error = await transcription.transcribe_async(file, duration, "", cfg)
+    handlers.finish_transcription(outbox, m, msg.id, response, error)
+
+
+async def deliver_image_job(job: jobs.Job, response: str, error: Optional[str]):
+    """
+    Send the result of a finished image job to the chat it came from.
+    """
+    if error:
+        return outbox.send_message(
+            job.chat_id, error, reply_to_message_id=job.message_id
+        )
+    await media.send_photo_async(
+        outbox, job.chat_id, response, reply_to_message_id=job.message_id
+    )
+
+
+async def deliver_audio_job(job: jobs.Job, response: str, error: Optional[str]):
+    handlers.deliver_audio_job(outbox, job, response, error)
+
+
+def start_jobs(loop: asyncio.AbstractEventLoop):
+    """
+    Jobs are delivered by workers of the job manager, in the event loop.
+    """
+
+    def in_loop(deliver):
+        def wrapper(job: jobs.Job, response: str, error: Optional[str]):
+            future = asyncio.run_coroutine_threadsafe(
+                deliver(job, response, error), loop
+            )
+            future.result()
+
+        return wrapper
+
+    job_manager = jobs.JobManager.get_instance()
+    job_manager.register(jobs.IMAGE, in_loop(deliver_image_job))
+    job_manager.register(jobs.AUDIO, in_loop(deliver_audio_job))
+    job_manager.start()
+
+
+async def handle_text_message(m: telebot.types.Message):
+    """
+    This handler is capable of intercepting all text messages coming into the chat.
+    Should not get triggered if message starts with a command.
+    """
+    if m.from_user.id == m.chat.id:
+        return
+    if m.text and m.text.startswith("/"):
+        return
+    cfg = router.find_network_by_name("chat")
+    if not cfg:
+        return outbox.reply_to(m, "Chat network not found")
+    unique_id = handlers.get_conversation_id(m)
+    schedule(m, cfg, process_text_message, unique_id, key=unique_id, notify=False)
+
+
+async def process_text_message(
+    m: telebot.types.Message, cfg: model.Network, unique_id: str
+):
+    if not handlers.remember_conversation(m, cfg, unique_id):
+        return
+    text = utils.get_message_text(m)
+    history = handlers.get_conversation_history(unique_id)
+    response, error = await integrations.openai.get_chat_response_async(
+        history, text, cfg
+    )
+    handlers.finish_conversation(outbox, m, cfg, unique_id, response, error)
+
+
+def create_bot() -> TeleBot:
+    """
+    Build the bot from settings, handlers are registered only
+    for configured networks.
+    """
+    global bot, outbox
+    settings.validate(runtime="async")
+    bot = TeleBot(settings.telegram.bot_token)
+    outbox = sender.AsyncSender(bot)
+    bot.add_custom_filter(utils.AsyncIsAdmin())
+    bot.add_custom_filter(utils.AsyncIsAllowed())
+    bot.add_custom_filter(utils.AsyncWithinRateLimit(outbox))
+    handlers.register_handlers(bot, sys.modules[__name__])
+    return bot
+
+
+async def main():
+    """
+    Blocking Replicate calls are offloaded to the default executor,
+    its size limits how many of them can run at the same time.
+    """
+    create_bot()
+    integrations.warm_up()
+    metrics.start_server(settings.metrics)
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(
+        ThreadPoolExecutor(max_workers=settings.general.async_workers)
+    )
+    if settings.jobs.enabled:
+        start_jobs(loop)
+    async with connections.create_async_session() as session:
+        asyncio_helper.session_manager.session = session
+        if settings.integrations.openai:
+            integrations.openai.set_async_session(session)
+        # Telegram doesn't allow polling while webhook is set
+        await bot.remove_webhook()
+        logger.info(">>> Started async polling")
+        await bot.infinity_polling()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
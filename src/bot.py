@@ -1,96 +1,109 @@
-import random
+import sys
+from typing import BinaryIO
+from typing import Optional
 
 import telebot
-import requests
 
+from . import jobs
+from . import media
 from . import model
+from . import handlers
 from . import utils
 from . import store
 from . import config
-from .integrations.openai import get_chat_response
-from .integrations.openai import get_dalle_response
-from .integrations.openai import get_completion_response
-from .integrations.openai import CHAT_API_NAME, IMAGE_API_NAME, COMPLETION_API_NAME
-from .integrations.replicate import get_replicate_audio_response
-from .integrations.replicate import get_replicate_image_response
+from . import scheduler
+from . import sender
+from . import transcription
+from . import routing
+from . import streaming
+from . import metrics
+from . import webhook
+from . import connections
+from . import integrations
 
 
 logger = config.logger
 settings = config.get_settings()
 dialogs_store = store.DialogsStore.get_instance()
-whitelist_store = store.WhitelistStore.get_instance()
+job_scheduler = scheduler.Scheduler.get_instance()
+router = routing.Router.get_instance()
 
-telebot.apihelper.ENABLE_MIDDLEWARE = True
-bot = telebot.TeleBot(settings.telegram.bot_token)
-bot.add_custom_filter(utils.IsAdmin())
-bot.add_custom_filter(utils.IsAllowed())
+telebot.apihelper.session = connections.get_session()
+if settings.telegram.api_url:
+    telebot.apihelper.API_URL = settings.telegram.api_url.rstrip("/") + "/bot{0}/{1}"
 
 
-@bot.middleware_handler()
-def clean_message(_, update: telebot.types.Update):
+class TeleBot(telebot.TeleBot):
     """
-    Clean message from command.
+    Drops updates no handler would act on before filters.
     """
-    if update.message:
-        update.message.command = utils.get_command(update.message.text)
-        update.message.cleaned = utils.clean_message_from_command(update.message.text)
+
+    def process_new_updates(self, updates: list[telebot.types.Update]):
+        if updates:
+            # Dropped updates have to be confirmed too
+            last_update_id = max(u.update_id or 0 for u in updates)
+            self.last_update_id = max(self.last_update_id, last_update_id)
+        super().process_new_updates(router.filter_updates(updates))
+
+
+# Set by create_bot
+bot: TeleBot
+outbox: sender.Sender
 
 
-@bot.message_handler(commands=["start"], is_allowed=True)
 def handle_start(m: telebot.types.Message):
-    bot.reply_to(m, "Shaka, bruh! Ask me something. /help for more info")
+    handlers.start(outbox, m)
 
 
-@bot.message_handler(commands=["ping"], is_allowed=True)
 def handle_ping(m: telebot.types.Message):
-    bot.reply_to(m, "Pong, bruh!")
+    handlers.ping(outbox, m)
 
 
-@bot.message_handler(commands=["help"], is_allowed=True)
 def handle_help(m: telebot.types.Message):
-    message = utils.get_list_of_commands(m.from_user.id)
-    bot.reply_to(m, message, parse_mode="HTML")
+    handlers.show_help(outbox, m)
 
 
-@bot.message_handler(commands=["whitelist"], is_admin=True)
 def handle_whitelist(m: telebot.types.Message):
-    """
-    Add user or chat to whitelist. Requires admin privileges.
-    """
-    if not m.cleaned:
-        return bot.reply_to(m, "Please specify user id, username or chat id ")
-    entry = m.cleaned.split(" ")[0]
-    error = whitelist_store.whitelist(entry)
-    if error:
-        return bot.reply_to(m, error)
-    bot.reply_to(m, f"Added {entry} to whitelist")
+    handlers.whitelist(outbox, m)
 
 
-@bot.message_handler(commands=["blacklist"], is_admin=True)
 def handle_blacklist(m: telebot.types.Message):
+    handlers.blacklist(outbox, m)
+
+
+def handle_stats(m: telebot.types.Message):
+    handlers.show_stats(outbox, m)
+
+
+def handle_breakers(m: telebot.types.Message):
+    handlers.show_breakers(outbox, m)
+
+
+def get_audio_file(file_id: str) -> BinaryIO:
     """
-    Block user or chat. Requires admin privileges.
+    Download audio file from the message, the file has to be closed.
     """
-    if not m.cleaned:
-        return bot.reply_to(m, "Please specify user id, username or chat id ")
-    entry = m.cleaned.split(" ")[0]
-    error = whitelist_store.blacklist(entry)
-    if error:
-        return bot.reply_to(m, error)
-    bot.reply_to(m, f"Removed {entry} from whitelist")
+    file_info = bot.get_file(file_id)
+    return media.download_telegram_file(file_info.file_path)
 
 
-def get_audio_file(file_id: str) -> requests.Response:
+def schedule(
+    m: telebot.types.Message, cfg: model.Network, fn, *args, key=None, notify=True
+):
     """
-    Download audio file from the message.
+    Run job in the worker pool of the network.
+    Jobs with the same key, e.g. of the same dialog, run one after another.
+    Replies with the position when the job has to wait in the queue.
     """
-    file_info = bot.get_file(file_id)
-    file = requests.get(
-        "https://api.telegram.org/file/bot{0}/{1}".format(
-            settings.telegram.bot_token, file_info.file_path
-        )
-    )
-    return file
+    try:
+        position = job_scheduler.submit(cfg, fn, m, cfg, *args, key=key)
+    except model.QueueFullException:
+        logger.warning(f">>> Queue is full, rejected request to {cfg.name}")
+        if notify:
+            outbox.reply_to(m, "Too many requests, please try again later")
+        return
+    if position and notify:
+        outbox.reply_to(m, f"Queued, position {position}")
 
 
 def handle_replicate_request(m: telebot.types.Message):
@@ -99,26 +112,64 @@ def handle_replicate_request(m: telebot.types.Message):
     Example:
     >>> /m A sunset on the beach
     """
-    cfg = utils.find_config_by_command(m.command)
+    cfg = handlers.find_network(outbox, m)
     if not cfg:
-        return bot.reply_to(m, "Unknown command")
+        return
     if cfg.type == "audio":
-        if m.reply_to_message and m.reply_to_message.voice:
-            file = get_audio_file(m.reply_to_message.voice.file_id)
-            response, error = get_replicate_audio_response(file.content, m.cleaned, cfg)
-            if error:
-                return bot.reply_to(m, error)
-            bot.reply_to(m, response)
-            return
-        bot.reply_to(m, "No voice attachment found")
+        reply_to = m.reply_to_message
+        voice = handlers.check_voice(outbox, m, reply_to.voice if reply_to else None)
+        if voice:
+            schedule(m, cfg, process_replicate_audio_request, voice)
         return
     if cfg.type == "image":
-        response, error = get_replicate_image_response(m.cleaned, cfg)
+        return schedule(m, cfg, process_replicate_image_request)
+    outbox.reply_to(m, "Unknown command type")
+
+
+def process_replicate_audio_request(
+    m: telebot.types.Message, cfg: model.Network, voice: telebot.types.Voice
+):
+    text = utils.get_message_text(m)
+    try:
+        file = get_audio_file(voice.file_id)
+    except model.FileTooLargeException as e:
+        return outbox.reply_to(m, str(e))
+    with file:
+        # Long messages are split into chunks transcribed in parallel instead
+        duration = voice.duration
+        if settings.jobs.enabled and not transcription.should_split(duration):
+            error = jobs.JobManager.get_instance().submit(
+                jobs.AUDIO,
+                cfg,
+                m,
+                lambda: integrations.replicate.start_replicate_audio_prediction(
+                    file, text, cfg
+                ),
+            )
+            if error:
+                outbox.reply_to(m, error)
+            return
+        response, error = transcription.transcribe(file, duration, text, cfg)
+    outbox.reply_to(m, error or response)
+
+
+def process_replicate_image_request(m: telebot.types.Message, cfg: model.Network):
+    text = utils.get_message_text(m)
+    if settings.jobs.enabled:
+        error = jobs.JobManager.get_instance().submit(
+            jobs.IMAGE,
+            cfg,
+            m,
+            lambda: integrations.replicate.start_replicate_image_prediction(text, cfg),
+            key=f"{cfg.command}:{text}",
+        )
         if error:
-            return bot.reply_to(m, error)
-        bot.send_photo(m.chat.id, response, reply_to_message_id=m.message_id)
+            outbox.reply_to(m, error)
         return
-    bot.reply_to(m, "Unknown command type")
+    response, error = integrations.replicate.get_replicate_image_response(text, cfg)
+    if error:
+        return outbox.reply_to(m, error)
+    media.send_photo(outbox, m.chat.id, response, reply_to_message_id=m.message_id)
 
 
 def handle_dalle_request(m: telebot.types.Message):
@@ -127,10 +178,17 @@ def handle_dalle_request(m: telebot.types.Message):
     Example:
     >>> /d A sunset on the beach
     """
-    response, error = get_dalle_response(m.cleaned)
+    cfg = handlers.find_network(outbox, m)
+    if cfg:
+        schedule(m, cfg, process_dalle_request)
+
+
+def process_dalle_request(m: telebot.types.Message, cfg: model.Network):
+    text = utils.get_message_text(m)
+    response, error = integrations.openai.get_dalle_response(text)
     if error:
-        return bot.reply_to(m, error)
-    bot.send_photo(m.chat.id, response, reply_to_message_id=m.message_id)
+        return outbox.reply_to(m, error)
+    media.send_photo(outbox, m.chat.id, response, reply_to_message_id=m.message_id)
 
 
 def handle_completion_request(m: telebot.types.Message):
@@ -141,28 +199,22 @@ def handle_completion_request(m: telebot.types.Message):
     To clean the history:
     >>> /d clear
     """
-    unique_id = f"{m.chat.id}:{m.from_user.id}"
-    dialogs_store.clean_old_completions(unique_id)
-    if m.cleaned.startswith("clear"):
-        dialogs_store.clear_completions(unique_id)
-        return bot.reply_to(m, "History cleared")
-
-    cfg = utils.find_config_by_command(m.command)
+    cfg = handlers.find_network(outbox, m)
     if not cfg:
-        return bot.reply_to(m, "Unknown command")
+        return
+    unique_id = handlers.get_dialog_id(m)
+    schedule(m, cfg, process_completion_request, unique_id, key=unique_id)
+
+
+def process_completion_request(
+    m: telebot.types.Message, cfg: model.Network, unique_id: str
+):
+    if handlers.clean_completion(outbox, m, cfg, unique_id):
+        return
+    text = utils.get_message_text(m)
     history = dialogs_store.get_from_completions(unique_id)
-    response, error = get_completion_response(history, m.cleaned, cfg)
-    if error:
-        return bot.reply_to(m, error)
-    history_entry = model.CompletionHistoryEntry.from_message(
-        m.cleaned, m.date, response
-    )
-    dialogs_store.add_to_completions(unique_id, history_entry)
-    if len(response) > 4095:
-        for x in range(0, len(response), 4095):
-            bot.reply_to(m, text=response[x:x+4095])
-    else:
-        bot.reply_to(m, text=response)
+    response, error = integrations.openai.get_completion_response(history, text, cfg)
+    handlers.finish_completion(outbox, m, cfg, unique_id, response, error)
 
 
 def handle_chat_request(m: telebot.types.Message):
@@ -173,26 +225,41 @@ def handle_chat_request(m: telebot.types.Message):
     To clean the history:
     >>> /c clear
     """
-    unique_id = f"{m.chat.id}:{m.from_user.id}"
-    dialogs_store.clean_old_chats(unique_id)
-    if m.cleaned.startswith("clear"):
-        dialogs_store.clear_chats(unique_id)
-        return bot.reply_to(m, "History cleared")
-
-    cfg = utils.find_config_by_command(m.command)
+    cfg = handlers.find_network(outbox, m)
     if not cfg:
-        return bot.reply_to(m, "Unknown command")
+        return
+    unique_id = handlers.get_dialog_id(m)
+    schedule(m, cfg, process_chat_request, unique_id, key=unique_id)
+
+
+def process_chat_request(m: telebot.types.Message, cfg: model.Network, unique_id: str):
+    if handlers.clean_chat(outbox, m, cfg, unique_id):
+        return
+    text = utils.get_message_text(m)
     history = dialogs_store.get_from_chats(unique_id)
-    response, error = get_chat_response(history, m.cleaned, cfg)
-    if error:
-        return bot.reply_to(m, error)
-    history_entry = model.ChatHistoryEntry.from_message(m.cleaned, m.date, response)
-    dialogs_store.add_to_chats(unique_id, history_entry)
-    if len(response) > 4095:
-        for x in range(0, len(response), 4095):
-            bot.reply_to(m, text=response[x:x+4095])
-    else:
-        bot.reply_to(m, text=response)
+    if settings.integrations.openai and settings.integrations.openai.stream:
+        return process_chat_stream_request(m, history, cfg, unique_id)
+    response, error = integrations.openai.get_chat_response(history, text, cfg)
+    handlers.finish_chat(outbox, m, cfg, unique_id, response, error)
+
+
+def process_chat_stream_request(
+    m: telebot.types.Message,
+    history: list[model.ChatHistoryEntry],
+    cfg: model.Network,
+    unique_id: str,
+):
+    text = utils.get_message_text(m)
+    chunks, error = integrations.openai.get_chat_stream(history, text, cfg)
+    if error or not chunks:
+        return outbox.reply_to(m, error or "Error while getting response")
+    openai_settings = settings.integrations.openai
+    interval = openai_settings.stream_edit_interval if openai_settings else 0
+    try:
+        response = streaming.StreamingReply(outbox, m, interval).consume(chunks)
+    except Exception as e:
+        return outbox.reply_to(m, f"Error while getting response, {e}")
+    handlers.save_chat(m, cfg, unique_id, response)
 
 
 def handle_voice_message(m: telebot.types.Message):
@@ -200,20 +267,55 @@ def handle_voice_message(m: telebot.types.Message):
     Handler to automatically convert voice messages to text.
     Should not get triggered if message starts with a command.
     """
-    if m.text and m.text.startswith("/"):
-        return
-    cfg = utils.find_config_by_type("audio")
+    cfg = handlers.find_audio_network(outbox, m)
     if not cfg:
-        return bot.reply_to(m, "Network to process audio not found")
-    msg = bot.reply_to(m, "Generating text...")
-    file = get_audio_file(m.voice.file_id)
-    response, error = get_replicate_audio_response(file.content, "", cfg)
+        return
+    voice = handlers.check_voice(outbox, m, m.voice)
+    if voice:
+        schedule(m, cfg, process_voice_message, voice)
+
+
+def process_voice_message(
+    m: telebot.types.Message, cfg: model.Network, voice: telebot.types.Voice
+):
+    msg = outbox.reply_to(m, "Generating text...").result()
+    try:
+        file = get_audio_file(voice.file_id)
+    except model.FileTooLargeException as e:
+        return handlers.finish_transcription(outbox, m, msg.id, "", str(e))
+    with file:
+        # Long messages are split into chunks transcribed in parallel instead
+        duration = voice.duration
+        if settings.jobs.enabled and not transcription.should_split(duration):
+            error = jobs.JobManager.get_instance().submit(
+                jobs.AUDIO,
+                cfg,
+                m,
+                lambda: integrations.replicate.start_replicate_audio_prediction(
+                    file, "", cfg
+                ),
+                status_message_id=msg.id,
+            )
+            if error:
+                handlers.finish_transcription(outbox, m, msg.id, "", error)
+            return
+        response, error = transcription.transcribe(file, duration, "", cfg)
+    handlers.finish_transcription(outbox, m, msg.id, response, error)
+
+
+def deliver_image_job(job: jobs.Job, response: str, error: Optional[str]):
+    """
+    Send the result of a finished image job to the chat it came from.
+    """
     if error:
-        bot.edit_message_text(
-            "Couldn't generate text", chat_id=m.chat.id, message_id=msg.id
+        return outbox.send_message(
+            job.chat_id, error, reply_to_message_id=job.message_id
         )
-        return bot.reply_to(m, error)
-    bot.edit_message_text(response, chat_id=m.chat.id, message_id=msg.id)
+    media.send_photo(outbox, job.chat_id, response, reply_to_message_id=job.message_id)
+
+
+def deliver_audio_job(job: jobs.Job, response: str, error: Optional[str]):
+    handlers.deliver_audio_job(outbox, job, response, error)
 
 
 def handle_text_message(m: telebot.types.Message):
@@ -225,68 +327,59 @@ def handle_text_message(m: telebot.types.Message):
         return
     if m.text and m.text.startswith("/"):
         return
-    cfg = utils.find_config_by_name("chat")
+    cfg = router.find_network_by_name("chat")
     if not cfg:
-        return bot.reply_to(m, "Chat network not found")
-    unique_id = f"{m.chat.id}:conversation"
-    dialogs_store.clean_old_chats(unique_id)
-    history = dialogs_store.get_from_chats(unique_id)
-    if len(history) < 5:
-        history_entry = model.ChatHistoryEntry.from_message(m.cleaned, m.date, "")
-        dialogs_store.add_to_chats(unique_id, history_entry)
-        return
-    if random.random() < 0.90:
-        return
-    history = utils.add_conversations_flow(history)
-    response, error = get_chat_response(history, m.cleaned, cfg)
-    if error:
-        return bot.reply_to(m, error)
-    history_entry = model.ChatHistoryEntry.from_message(response, m.date, "")
-    dialogs_store.add_to_chats(unique_id, history_entry)
-    bot.reply_to(m, response.lstrip("AI: "))
+        return outbox.reply_to(m, "Chat network not found")
+    unique_id = handlers.get_conversation_id(m)
+    schedule(m, cfg, process_text_message, unique_id, key=unique_id, notify=False)
 
 
-"""
-Initialize handlers for integrations listed in configuration file.
-"""
-
-if settings.integrations.replicate:
-    networks = settings.integrations.replicate.networks
-    for n in networks:
-        bot.register_message_handler(
-            handle_replicate_request, commands=[n.command], is_allowed=True
-        )
-
+def process_text_message(m: telebot.types.Message, cfg: model.Network, unique_id: str):
+    if not handlers.remember_conversation(m, cfg, unique_id):
+        return
+    text = utils.get_message_text(m)
+    history = handlers.get_conversation_history(unique_id)
+    response, error = integrations.openai.get_chat_response(history, text, cfg)
+    handlers.finish_conversation(outbox, m, cfg, unique_id, response, error)
 
-if settings.integrations.openai:
-    networks = settings.integrations.openai.networks
-    image_cmd = next((n.command for n in networks if n.name == IMAGE_API_NAME), None)
-    if image_cmd:
-        bot.register_message_handler(
-            handle_dalle_request, commands=[image_cmd], is_allowed=True
-        )
-    chat_cmd = next((n.command for n in networks if n.name == CHAT_API_NAME), None)
-    if chat_cmd:
-        bot.register_message_handler(
-            handle_chat_request, commands=[chat_cmd], is_allowed=True
-        )
-    completion_cmd = next(
-        (n.command for n in networks if n.name == COMPLETION_API_NAME), None
-    )
-    if completion_cmd:
-        bot.register_message_handler(
-            handle_completion_request, commands=[completion_cmd], is_allowed=True
-        )
 
+def create_bot() -> TeleBot:
+    """
+    Build the bot from settings, handlers are registered only
+    for configured networks.
+    """
+    global bot, outbox
+    bot = TeleBot(settings.telegram.bot_token)
+    outbox = sender.Sender(bot)
+    bot.add_custom_filter(utils.IsAdmin())
+    bot.add_custom_filter(utils.IsAllowed())
+    bot.add_custom_filter(utils.WithinRateLimit(outbox))
+    handlers.register_handlers(bot, sys.modules[__name__])
+    return bot
 
-"""
-Register global handlers.
-"""
 
-if settings.install_global_handlers:
-    bot.register_message_handler(handle_voice_message, content_types=["voice"])
-    bot.register_message_handler(handle_text_message, content_types=["text"])
+def main():
+    """
+    Build the bot and start receiving updates, integrations are loaded
+    in the background meanwhile.
+    """
+    create_bot()
+    integrations.warm_up()
+    metrics.start_server(settings.metrics)
+    if settings.jobs.enabled:
+        job_manager = jobs.JobManager.get_instance()
+        job_manager.register(jobs.IMAGE, deliver_image_job)
+        job_manager.register(jobs.AUDIO, deliver_audio_job)
+        job_manager.start()
+    if settings.webhook.enabled:
+        logger.info(">>> Started webhook server")
+        webhook.serve(bot, settings.webhook)
+    else:
+        # Telegram doesn't allow polling while webhook is set
+        bot.remove_webhook()
+        logger.info(">>> Started polling")
+        bot.infinity_polling()
 
 
-logger.info(">>> Started polling")
-bot.infinity_polling()
+if __name__ == "__main__":
+    main()
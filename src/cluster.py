@@ -0,0 +1,83 @@
+import zlib
+from typing import Optional
+from urllib.parse import urlparse
+
+from . import config
+from . import metrics
+from . import connections
+
+logger = config.logger
+settings = config.get_settings()
+
+FORWARDED_HEADER = "X-Tg-Ai-Forwarded"
+# Update fields holding an object with "chat" and "from" fields
+MESSAGE_FIELDS = (
+    "message",
+    "edited_message",
+    "channel_post",
+    "edited_channel_post",
+)
+
+
+def is_enabled() -> bool:
+    return settings.cluster.enabled
+
+
+def get_worker_id() -> int:
+    return settings.cluster.get_worker_id()
+
+
+def get_partition_key(update: dict) -> Optional[str]:
+    """
+    Build the key updates are partitioned by, example:
+    >>> get_partition_key({"message": {"chat": {"id": -100}, "from": {"id": 1}}})
+    "-100"
+    Updates are partitioned by chat, so group conversations, chat rate limits
+    and flood limits of the outbox are kept by a single worker.
+    """
+    for field in MESSAGE_FIELDS:
+        message = update.get(field)
+        if message:
+            return str(message.get("chat", {}).get("id"))
+    callback = update.get("callback_query")
+    if callback:
+        return str(callback.get("message", {}).get("chat", {}).get("id"))
+    return None
+
+
+def get_owner(update: dict) -> int:
+    """
+    Find the worker processing the update, updates of the same
+    chat always land on the same worker.
+    Updates without chat and user are processed by any worker.
+    """
+    key = get_partition_key(update)
+    if key is None:
+        return get_worker_id()
+    return zlib.crc32(key.encode()) % len(settings.cluster.peers)
+
+
+def get_listen_port(default: int) -> int:
+    """
+    Port of this worker taken from its url in the list of peers.
+    """
+    if not settings.cluster.enabled:
+        return default
+    return urlparse(settings.cluster.peers[get_worker_id()]).port or default
+
+
+def forward(owner: int, body: bytes) -> int:
+    """
+    Send update to the worker owning it, return status code of the response.
+    """
+    url = settings.cluster.peers[owner].rstrip("/") + settings.webhook.path
+    headers = {FORWARDED_HEADER: "1", "Content-Type": "application/json"}
+    if settings.webhook.secret_token:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = settings.webhook.secret_token
+    try:
+        response = connections.get_session().post(url, data=body, headers=headers)
+    except Exception as e:
+        logger.warning(f">>> Couldn't forward update to worker {owner}: {e}")
+        return 503
+    metrics.FORWARDED_UPDATES.inc(worker=owner)
+    return response.status_code
@@ -1,6 +1,6 @@
 import logging
 from pathlib import Path
-from functools import lru_cache
+from typing import Optional
 
 import toml
 from pydantic import BaseModel
@@ -17,8 +17,19 @@ class Config(BaseModel):
     general: model.GeneralSettings
     telegram: model.TelegramSettings
     integrations: model.Integrations
+    scheduler: model.SchedulerSettings = model.SchedulerSettings()
+    http: model.HttpSettings = model.HttpSettings()
+    storage: model.StorageSettings = model.StorageSettings()
+    metrics: model.MetricsSettings = model.MetricsSettings()
+    resilience: model.ResilienceSettings = model.ResilienceSettings()
+    ratelimit: model.RateLimitSettings = model.RateLimitSettings()
+    sender: model.SenderSettings = model.SenderSettings()
+    webhook: model.WebhookSettings = model.WebhookSettings()
+    cluster: model.ClusterSettings = model.ClusterSettings()
+    jobs: model.JobsSettings = model.JobsSettings()
+    transcription: model.TranscriptionSettings = model.TranscriptionSettings()
 
-    def validate(self):
+    def validate(self, runtime: str = "sync"):
         commands = []
         if self.integrations.openai:
             commands.extend([n.command for n in self.integrations.openai.networks])
@@ -28,15 +39,72 @@ class Config(BaseModel):
             raise model.ConfigException(
                 f"Commands should only repeat once, but found: {commands}"
             )
+        if self.cluster.enabled and not (self.webhook.enabled and self.cluster.peers):
+            raise model.ConfigException("Cluster requires webhook and a list of peers")
+        if self.cluster.enabled and (
+            self.storage.backend == "memory" or self.storage.whitelist == "file"
+        ):
+            raise model.ConfigException(
+                "Cluster requires dialogs and whitelist in sqlite or redis storage"
+            )
+        if self.cluster.enabled:
+            try:
+                worker_id = self.cluster.get_worker_id()
+            except ValueError:
+                raise model.ConfigException("Worker id should be a number")
+            if not 0 <= worker_id < len(self.cluster.peers):
+                raise model.ConfigException(
+                    f"Worker id {worker_id} is out of range "
+                    f"of {len(self.cluster.peers)} peers"
+                )
+        if runtime == "async" and (self.webhook.enabled or self.cluster.enabled):
+            raise model.ConfigException(
+                "Webhook and cluster are only supported by sync runtime"
+            )
+        if self.transcription.chunk_overlap >= self.transcription.chunk_duration:
+            raise model.ConfigException("Chunk overlap should be less than its duration")
         if self.telegram.bot_token == "TG_BOT_TOKEN":
             raise model.ConfigException("Please set your bot token in config.toml")
 
 
-@lru_cache()
+_settings: Optional[Config] = None
+
+
 def get_settings() -> Config:
+    """
+    Settings of the app, read from config.toml unless set_settings was called.
+    Raises ConfigException if they can't be loaded, so modules reading
+    settings at import time never get None.
+    """
+    settings = _settings
+    if settings is None:
+        settings = load_settings()
+        set_settings(settings)
+    return settings
+
+
+def set_settings(settings: Config):
+    """
+    Use the given settings, has to be called before the rest of the app
+    is imported since modules read settings at import time.
+    """
+    global _settings
+    if _settings is not None and _settings is not settings:
+        raise model.ConfigException("Settings are already loaded")
+    _settings = settings
+    if not settings.debug:
+        logging.getLogger("tg-ai-connector").setLevel(logging.INFO)
+        logging.getLogger("urllib3").setLevel(logging.WARNING)
+        logging.getLogger("telebot").setLevel(logging.WARNING)
+        logging.getLogger("PIL").setLevel(logging.WARNING)
+
+
+def load_settings(path: Optional[Path] = None) -> Config:
+    """
+    Read and validate settings, config.toml in the working directory by default.
+    """
     try:
-        p = Path.cwd() / "config.toml"
-        settings = toml.load(p)
+        settings = toml.load(path or Path.cwd() / "config.toml")
     except FileNotFoundError:
         raise model.ConfigException("Config file not found")
     try:
@@ -54,10 +122,5 @@ logging.basicConfig(
     datefmt="%H:%M:%S",
     level=logging.DEBUG,
 )
-if not get_settings().debug:
-    logging.getLogger("tg-ai-connector").setLevel(logging.INFO)
-    logging.getLogger("urllib3").setLevel(logging.WARNING)
-    logging.getLogger("telebot").setLevel(logging.WARNING)
-    logging.getLogger("PIL").setLevel(logging.WARNING)
 
 logger = logging.getLogger("tg-ai-connector")
@@ -0,0 +1,149 @@
+import threading
+from typing import Optional
+from typing import TYPE_CHECKING
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.adapters import DEFAULT_RETRIES
+
+from . import model
+from . import config
+from . import metrics
+
+if TYPE_CHECKING:
+    import aiohttp
+
+logger = config.logger
+settings = config.get_settings()
+
+_session: Optional[requests.Session] = None
+_mounted: list[requests.Session] = []
+_lock = threading.Lock()
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter that applies default timeout to requests sent without one.
+    """
+
+    def __init__(self, timeout: float, *args, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(
+        self,
+        request,
+        stream=False,
+        timeout=None,
+        verify=True,
+        cert=None,
+        proxies=None,
+    ):
+        if timeout is None:
+            timeout = self.timeout
+        return super().send(request, stream, timeout, verify, cert, proxies)
+
+
+def get_session() -> requests.Session:
+    """
+    Shared session used by every outbound call: Telegram, OpenAI and Replicate.
+    Connections are kept alive and reused between requests.
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            mount(_session)
+            _session.hooks["response"].append(metrics.observe_telegram_response)
+            if not settings.http.keep_alive:
+                _session.headers["Connection"] = "close"
+        return _session
+
+
+def mount(session: requests.Session):
+    """
+    Mount pooled adapters to the session: default one and one per configured host.
+    Retry policy already mounted to the session is kept.
+    """
+    adapter = session.get_adapter("https://")
+    max_retries = DEFAULT_RETRIES
+    if isinstance(adapter, HTTPAdapter):
+        max_retries = adapter.max_retries
+    _mounted.append(session)
+    for prefix in ("http://", "https://"):
+        session.mount(prefix, _create_adapter(settings.http, max_retries))
+    for host, host_settings in settings.http.hosts.items():
+        for prefix in ("http://", "https://"):
+            session.mount(
+                f"{prefix}{host}", _create_adapter(host_settings, max_retries)
+            )
+
+
+def get_stats() -> dict[str, dict]:
+    """
+    Return connection pool statistics per host across all mounted sessions, example:
+    >>> get_stats()
+    {"api.telegram.org": {"requests": 10, "hits": 9, "misses": 1}}
+    Hit means a request was sent over an already opened connection.
+    """
+    stats: dict[str, dict] = {}
+    adapters = {
+        id(a): a for session in _mounted for a in session.adapters.values()
+    }.values()
+    for adapter in adapters:
+        if not isinstance(adapter, HTTPAdapter):
+            continue
+        pools = getattr(adapter.poolmanager, "pools", None)
+        if pools is None:
+            continue
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host_stats = stats.setdefault(
+                pool.host, {"requests": 0, "hits": 0, "misses": 0}
+            )
+            host_stats["requests"] += pool.num_requests
+            host_stats["misses"] += pool.num_connections
+            host_stats["hits"] += max(0, pool.num_requests - pool.num_connections)
+    return stats
+
+
+def create_async_session() -> "aiohttp.ClientSession":
+    """
+    Pooled aiohttp session for the async runtime, shared by Telegram and OpenAI.
+    Has to be created inside of the running event loop.
+    """
+    # aiohttp takes a while to import and only the async runtime needs it
+    import aiohttp
+
+    connector = aiohttp.TCPConnector(
+        limit_per_host=settings.http.pool_maxsize,
+        force_close=not settings.http.keep_alive,
+    )
+    timeout = aiohttp.ClientTimeout(total=settings.http.timeout)
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=timeout,
+        trace_configs=[metrics.create_trace_config()],
+    )
+
+
+def _create_adapter(
+    pool_settings: model.HttpSettings | model.HostPoolSettings, max_retries
+) -> TimeoutHTTPAdapter:
+    return TimeoutHTTPAdapter(
+        timeout=pool_settings.timeout or settings.http.timeout,
+        pool_connections=settings.http.pool_connections,
+        pool_maxsize=pool_settings.pool_maxsize or settings.http.pool_maxsize,
+        max_retries=max_retries,
+    )
+
+
+def _collect_stats():
+    for host, host_stats in get_stats().items():
+        metrics.HTTP_POOL_REQUESTS.set(host_stats["requests"], host=host)
+        metrics.HTTP_POOL_MISSES.set(host_stats["misses"], host=host)
+
+
+metrics.on_collect(_collect_stats)
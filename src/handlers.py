@@ -0,0 +1,381 @@
+"""
+Parts of handlers both runtimes share: parsing of commands, history of dialogs
+and replies. Replies go through the outbox, which is the same for both runtimes,
+so a runtime only adds its own calls to Telegram and networks. History is only
+read and changed in jobs scheduled with the dialog as the key, so requests
+of a dialog see each other's answers in the order they came, example:
+>>> history = dialogs_store.get_from_chats(unique_id)
+>>> response, error = integrations.openai.get_chat_response(history, text, cfg)
+>>> handlers.finish_chat(outbox, m, cfg, unique_id, response, error)
+"""
+import random
+from types import ModuleType
+from typing import Optional
+
+import telebot
+
+from . import jobs
+from . import media
+from . import model
+from . import utils
+from . import store
+from . import config
+from . import sender
+from . import routing
+from . import resilience
+from . import connections
+from .streaming import MESSAGE_LIMIT
+from .integrations import CHAT_API_NAME, IMAGE_API_NAME, COMPLETION_API_NAME
+
+logger = config.logger
+settings = config.get_settings()
+dialogs_store = store.DialogsStore.get_instance()
+whitelist_store = store.WhitelistStore.get_instance()
+router = routing.Router.get_instance()
+
+TRANSCRIPTION_FAILED = "Couldn't generate text"
+# Group conversations are answered only when there's enough context
+CONVERSATION_MIN_HISTORY = 5
+CONVERSATION_ANSWER_CHANCE = 0.1
+
+
+def start(outbox: sender.Outbox, m: telebot.types.Message):
+    outbox.reply_to(m, "Shaka, bruh! Ask me something. /help for more info")
+
+
+def ping(outbox: sender.Outbox, m: telebot.types.Message):
+    outbox.reply_to(m, "Pong, bruh!")
+
+
+def show_help(outbox: sender.Outbox, m: telebot.types.Message):
+    message = utils.get_list_of_commands(m.from_user.id)
+    outbox.reply_to(m, message, parse_mode="HTML")
+
+
+def whitelist(outbox: sender.Outbox, m: telebot.types.Message):
+    """
+    Add user or chat to whitelist. Requires admin privileges.
+    """
+    text = utils.get_message_text(m)
+    if not text:
+        return outbox.reply_to(m, "Please specify user id, username or chat id ")
+    entry = text.split(" ")[0]
+    error = whitelist_store.whitelist(entry)
+    if error:
+        return outbox.reply_to(m, error)
+    outbox.reply_to(m, f"Added {entry} to whitelist")
+
+
+def blacklist(outbox: sender.Outbox, m: telebot.types.Message):
+    """
+    Block user or chat. Requires admin privileges.
+    """
+    text = utils.get_message_text(m)
+    if not text:
+        return outbox.reply_to(m, "Please specify user id, username or chat id ")
+    entry = text.split(" ")[0]
+    error = whitelist_store.blacklist(entry)
+    if error:
+        return outbox.reply_to(m, error)
+    outbox.reply_to(m, f"Removed {entry} from whitelist")
+
+
+def show_stats(outbox: sender.Outbox, m: telebot.types.Message):
+    """
+    Show connection pool statistics. Requires admin privileges.
+    """
+    message = utils.format_connection_stats(connections.get_stats())
+    outbox.reply_to(m, message, parse_mode="HTML")
+
+
+def show_breakers(outbox: sender.Outbox, m: telebot.types.Message):
+    """
+    Show state of circuit breakers of networks. Requires admin privileges.
+    """
+    message = utils.format_breakers_state(resilience.get_breakers_state())
+    outbox.reply_to(m, message, parse_mode="HTML")
+
+
+def find_network(
+    outbox: sender.Outbox, m: telebot.types.Message
+) -> Optional[model.Network]:
+    """
+    Network of the command, user is told when there's none.
+    """
+    cfg = router.find_network_by_command(utils.get_message_command(m))
+    if not cfg:
+        outbox.reply_to(m, "Unknown command")
+    return cfg
+
+
+def find_audio_network(
+    outbox: sender.Outbox, m: telebot.types.Message
+) -> Optional[model.Network]:
+    """
+    Network to transcribe a voice message with, None if it should be ignored.
+    """
+    if m.text and m.text.startswith("/"):
+        return None
+    cfg = router.find_network_by_type("audio")
+    if not cfg:
+        outbox.reply_to(m, "Network to process audio not found")
+    return cfg
+
+
+def check_voice(
+    outbox: sender.Outbox,
+    m: telebot.types.Message,
+    voice: Optional[telebot.types.Voice],
+) -> Optional[telebot.types.Voice]:
+    """
+    Voice if it can be transcribed, otherwise user is told why it can't.
+    """
+    if not voice:
+        outbox.reply_to(m, "No voice attachment found")
+        return None
+    if media.is_too_large(voice.file_size):
+        outbox.reply_to(m, media.get_too_large_message())
+        return None
+    return voice
+
+
+def finish_transcription(
+    outbox: sender.Outbox,
+    m: telebot.types.Message,
+    status_message_id: int,
+    response: str,
+    error: Optional[str],
+):
+    """
+    Show transcribed text in the status message, or the error in a reply.
+    """
+    if error:
+        outbox.edit_message_text(
+            TRANSCRIPTION_FAILED, chat_id=m.chat.id, message_id=status_message_id
+        )
+        return outbox.reply_to(m, error)
+    outbox.edit_message_text(response, chat_id=m.chat.id, message_id=status_message_id)
+
+
+def get_dialog_id(m: telebot.types.Message) -> str:
+    """
+    Dialog of the user with the bot in the chat, example:
+    >>> get_dialog_id(message)
+    "-1001:42"
+    """
+    return f"{m.chat.id}:{m.from_user.id}"
+
+
+def get_conversation_id(m: telebot.types.Message) -> str:
+    """
+    Conversation of all users of a group chat.
+    """
+    return f"{m.chat.id}:conversation"
+
+
+def clean_chat(
+    outbox: sender.Outbox, m: telebot.types.Message, cfg: model.Network, unique_id: str
+) -> bool:
+    """
+    Forget old messages of the dialog, True if the message cleared it.
+    """
+    dialogs_store.clean_old_chats(unique_id, cfg)
+    if utils.get_message_text(m).startswith("clear"):
+        dialogs_store.clear_chats(unique_id)
+        outbox.reply_to(m, "History cleared")
+        return True
+    return False
+
+
+def clean_completion(
+    outbox: sender.Outbox, m: telebot.types.Message, cfg: model.Network, unique_id: str
+) -> bool:
+    dialogs_store.clean_old_completions(unique_id, cfg)
+    if utils.get_message_text(m).startswith("clear"):
+        dialogs_store.clear_completions(unique_id)
+        outbox.reply_to(m, "History cleared")
+        return True
+    return False
+
+
+def save_chat(
+    m: telebot.types.Message, cfg: model.Network, unique_id: str, response: str
+):
+    text = utils.get_message_text(m)
+    history_entry = model.ChatHistoryEntry.from_message(text, m.date, response)
+    dialogs_store.add_to_chats(unique_id, history_entry, cfg)
+
+
+def finish_chat(
+    outbox: sender.Outbox,
+    m: telebot.types.Message,
+    cfg: model.Network,
+    unique_id: str,
+    response: str,
+    error: Optional[str],
+):
+    """
+    Remember the answer of chat network and send it.
+    """
+    if error:
+        return outbox.reply_to(m, error)
+    save_chat(m, cfg, unique_id, response)
+    reply_in_parts(outbox, m, response)
+
+
+def finish_completion(
+    outbox: sender.Outbox,
+    m: telebot.types.Message,
+    cfg: model.Network,
+    unique_id: str,
+    response: str,
+    error: Optional[str],
+):
+    if error:
+        return outbox.reply_to(m, error)
+    text = utils.get_message_text(m)
+    history_entry = model.CompletionHistoryEntry.from_message(text, m.date, response)
+    dialogs_store.add_to_completions(unique_id, history_entry, cfg)
+    reply_in_parts(outbox, m, response)
+
+
+def remember_conversation(
+    m: telebot.types.Message, cfg: model.Network, unique_id: str
+) -> bool:
+    """
+    Add the message to the conversation of the group until there's enough
+    context, True if the bot should answer it.
+    """
+    dialogs_store.clean_old_chats(unique_id, cfg)
+    history = dialogs_store.get_from_chats(unique_id)
+    if len(history) < CONVERSATION_MIN_HISTORY:
+        text = utils.get_message_text(m)
+        history_entry = model.ChatHistoryEntry.from_message(text, m.date, "")
+        dialogs_store.add_to_chats(unique_id, history_entry, cfg)
+        return False
+    return random.random() < CONVERSATION_ANSWER_CHANCE
+
+
+def get_conversation_history(unique_id: str) -> list[model.ChatHistoryEntry]:
+    history = dialogs_store.get_from_chats(unique_id)
+    return utils.add_conversations_flow(history)
+
+
+def finish_conversation(
+    outbox: sender.Outbox,
+    m: telebot.types.Message,
+    cfg: model.Network,
+    unique_id: str,
+    response: str,
+    error: Optional[str],
+):
+    if error:
+        return outbox.reply_to(m, error)
+    history_entry = model.ChatHistoryEntry.from_message(response, m.date, "")
+    dialogs_store.add_to_chats(unique_id, history_entry, cfg)
+    outbox.reply_to(m, response.lstrip("AI: "))
+
+
+def reply_in_parts(outbox: sender.Outbox, m: telebot.types.Message, text: str):
+    """
+    Send text longer than a message in several replies.
+    """
+    for x in range(0, max(len(text), 1), MESSAGE_LIMIT):
+        outbox.reply_to(m, text=text[x : x + MESSAGE_LIMIT])
+
+
+def deliver_audio_job(
+    outbox: sender.Outbox, job: jobs.Job, response: str, error: Optional[str]
+):
+    """
+    Show the text of a finished audio job in its status message,
+    or send it in a reply when there's none.
+    """
+    if job.status_message_id:
+        text = TRANSCRIPTION_FAILED if error else response
+        outbox.edit_message_text(
+            text, chat_id=job.chat_id, message_id=job.status_message_id
+        )
+        if not error:
+            return
+    outbox.send_message(
+        job.chat_id, error or response, reply_to_message_id=job.message_id
+    )
+
+
+def register_handlers(bot, runtime: ModuleType):
+    """
+    Register handle_* functions of the runtime module, bot or async_bot,
+    handlers of networks only for configured networks.
+    """
+    bot.register_message_handler(
+        runtime.handle_start, commands=["start"], is_allowed=True
+    )
+    bot.register_message_handler(
+        runtime.handle_ping, commands=["ping"], is_allowed=True
+    )
+    bot.register_message_handler(
+        runtime.handle_help, commands=["help"], is_allowed=True
+    )
+    bot.register_message_handler(
+        runtime.handle_whitelist, commands=["whitelist"], is_admin=True
+    )
+    bot.register_message_handler(
+        runtime.handle_blacklist, commands=["blacklist"], is_admin=True
+    )
+    bot.register_message_handler(
+        runtime.handle_stats, commands=["stats"], is_admin=True
+    )
+    bot.register_message_handler(
+        runtime.handle_breakers, commands=["breakers"], is_admin=True
+    )
+
+    if settings.integrations.replicate:
+        networks = settings.integrations.replicate.networks
+        for n in networks:
+            bot.register_message_handler(
+                runtime.handle_replicate_request,
+                commands=[n.command],
+                is_allowed=True,
+                within_rate_limit=True,
+            )
+
+    if settings.integrations.openai:
+        networks = settings.integrations.openai.networks
+        image_cmd = next(
+            (n.command for n in networks if n.name == IMAGE_API_NAME), None
+        )
+        if image_cmd:
+            bot.register_message_handler(
+                runtime.handle_dalle_request,
+                commands=[image_cmd],
+                is_allowed=True,
+                within_rate_limit=True,
+            )
+        chat_cmd = next((n.command for n in networks if n.name == CHAT_API_NAME), None)
+        if chat_cmd:
+            bot.register_message_handler(
+                runtime.handle_chat_request,
+                commands=[chat_cmd],
+                is_allowed=True,
+                within_rate_limit=True,
+            )
+        completion_cmd = next(
+            (n.command for n in networks if n.name == COMPLETION_API_NAME), None
+        )
+        if completion_cmd:
+            bot.register_message_handler(
+                runtime.handle_completion_request,
+                commands=[completion_cmd],
+                is_allowed=True,
+                within_rate_limit=True,
+            )
+
+    if settings.install_global_handlers:
+        bot.register_message_handler(
+            runtime.handle_voice_message, content_types=["voice"]
+        )
+        bot.register_message_handler(
+            runtime.handle_text_message, content_types=["text"]
+        )
+    router.index_handlers(bot.message_handlers)
@@ -0,0 +1,49 @@
+"""
+Integrations are imported on first use, so clients of networks
+that aren't configured are never loaded. Example:
+>>> from src import integrations
+>>> integrations.openai.get_chat_response(history, text, cfg)  # imported here
+"""
+import importlib
+import threading
+
+from .. import config
+
+logger = config.logger
+settings = config.get_settings()
+
+# Names of OpenAI networks, needed to register handlers before openai is imported
+CHAT_API_NAME = "chat"
+IMAGE_API_NAME = "image"
+COMPLETION_API_NAME = "completion"
+INTEGRATIONS = ("openai", "replicate")
+
+
+def __getattr__(name: str):
+    if name in INTEGRATIONS:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__} has no attribute {name}")
+
+
+def get_configured() -> list[str]:
+    return [name for name in INTEGRATIONS if getattr(settings.integrations, name)]
+
+
+def warm_up():
+    """
+    Import configured integrations and resolve Replicate versions
+    in a background thread, so the bot starts receiving updates right away.
+    A request arriving earlier waits for the import to finish.
+    """
+
+    def load():
+        for name in get_configured():
+            try:
+                module = importlib.import_module(f".{name}", __name__)
+            except Exception as e:
+                logger.exception(f">>> Couldn't import {name} integration: {e}")
+                continue
+            if name == "replicate":
+                module.warm_versions_cache()
+
+    threading.Thread(target=load, name="integrations-warmup", daemon=True).start()
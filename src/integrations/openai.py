@@ -1,22 +1,64 @@
 import re
-import time
+import json
+import hashlib
 from typing import Tuple
+from typing import Iterator
 from typing import Optional
+from typing import AsyncIterator
 
 import openai
 import openai.error
 
 from .. import model
+from .. import cache
 from .. import config
+from .. import metrics
+from .. import resilience
+from .. import singleflight
+from .. import connections
+from . import CHAT_API_NAME, IMAGE_API_NAME, COMPLETION_API_NAME
 
 settings = config.get_settings()
 if settings.integrations.openai:
     openai.api_key = settings.integrations.openai.api_key
+    openai.requestssession = connections.get_session()
 
-CHAT_API_NAME = "chat"
-IMAGE_API_NAME = "image"
-COMPLETION_API_NAME = "completion"
 REMOVE_ANSWER_RE = re.compile(r"Answer\d+:")
+TEMPERATURE = 0.2
+
+response_caches: dict[str, cache.TTLCache] = {}
+# Identical requests in flight share a single call to OpenAI
+flights = singleflight.SingleFlight("openai")
+async_flights = singleflight.AsyncSingleFlight("openai")
+
+
+def _is_retryable_status(e: Exception) -> bool:
+    """
+    APIError comes for any unexpected status, only 5xx are worth retrying.
+    Status is unknown for malformed responses, usually coming from proxies.
+    """
+    if isinstance(e, openai.error.APIError):
+        return e.http_status is None or e.http_status >= 500
+    return True
+
+
+retry_policy = resilience.RetryPolicy(
+    (
+        openai.error.APIError,
+        openai.error.APIConnectionError,
+        openai.error.Timeout,
+        openai.error.RateLimitError,
+        openai.error.ServiceUnavailableError,
+    ),
+    retry_if=_is_retryable_status,
+)
+
+
+def set_async_session(session):
+    """
+    Make async requests share the pooled session of the async runtime.
+    """
+    openai.aiosession.set(session)
 
 
 def send_completion_request(version: str, prompt: str):
@@ -26,13 +68,14 @@ def send_completion_request(version: str, prompt: str):
         model=version,
         prompt=prompt,
         max_tokens=settings.integrations.openai.max_tokens,
-        temperature=0.2,
+        temperature=TEMPERATURE,
         timeout=10,
         n=1,
     )
     return response
 
 
+@metrics.track()
 def get_completion_response(
     history: list[model.CompletionHistoryEntry], text: str, cfg: model.Network
 ) -> Tuple[str, Optional[str]]:
@@ -42,16 +85,73 @@ def get_completion_response(
     if not text:
         return "", "No text provided"
     text = _format_text_completion_request_with_context(history, text)
-    response = None
-    for _ in range(2):
-        try:
-            response = send_completion_request(cfg.version, text)
-        except openai.error.APIConnectionError:
-            time.sleep(1)
-            continue
-        except Exception as e:
-            return "", f"Error while getting response, {e}"
-        break
+    cache_key = _get_cache_key(cfg, text)
+    cached = _get_cached_response(cfg, cache_key)
+    if cached is not None:
+        return cached, None
+    try:
+        response = flights.do(
+            cache_key,
+            retry_policy.call,
+            cfg.command,
+            send_completion_request,
+            cfg.version,
+            text,
+        )
+    except Exception as e:
+        return "", f"Error while getting response, {e}"
+    text, error = _parse_completion_response(response)
+    if not error:
+        _set_cached_response(cfg, cache_key, text)
+    return text, error
+
+
+async def send_completion_request_async(version: str, prompt: str):
+    if not settings.integrations.openai:
+        raise Exception("OpenAI integration is not configured")
+    response = await openai.Completion.acreate(
+        model=version,
+        prompt=prompt,
+        max_tokens=settings.integrations.openai.max_tokens,
+        temperature=TEMPERATURE,
+        timeout=10,
+        n=1,
+    )
+    return response
+
+
+@metrics.track()
+async def get_completion_response_async(
+    history: list[model.CompletionHistoryEntry], text: str, cfg: model.Network
+) -> Tuple[str, Optional[str]]:
+    """
+    Async version of get_completion_response.
+    """
+    if not text:
+        return "", "No text provided"
+    text = _format_text_completion_request_with_context(history, text)
+    cache_key = _get_cache_key(cfg, text)
+    cached = _get_cached_response(cfg, cache_key)
+    if cached is not None:
+        return cached, None
+    try:
+        response = await async_flights.do(
+            cache_key,
+            retry_policy.call_async,
+            cfg.command,
+            send_completion_request_async,
+            cfg.version,
+            text,
+        )
+    except Exception as e:
+        return "", f"Error while getting response, {e}"
+    text, error = _parse_completion_response(response)
+    if not error:
+        _set_cached_response(cfg, cache_key, text)
+    return text, error
+
+
+def _parse_completion_response(response) -> Tuple[str, Optional[str]]:
     if not response:
         return "", "Error while getting response"
     if not isinstance(response, dict) or "choices" not in response:
@@ -77,13 +177,14 @@ def send_chat_request(version: str, messages: list[dict]):
         model=version,
         messages=messages,
         max_tokens=settings.integrations.openai.max_tokens,
-        temperature=0.2,
+        temperature=TEMPERATURE,
         timeout=10,
         n=1,
     )
     return response
 
 
+@metrics.track()
 def get_chat_response(
     history: list[model.ChatHistoryEntry], text: str, cfg: model.Network
 ) -> Tuple[str, Optional[str]]:
@@ -93,16 +194,73 @@ def get_chat_response(
     if not text:
         return "", "No text provided"
     messages = _format_chat_request(history, text)
-    response = None
-    for _ in range(2):
-        try:
-            response = send_chat_request(cfg.version, messages)
-        except openai.error.APIConnectionError:
-            time.sleep(1)
-            continue
-        except Exception as e:
-            return "", f"Error while getting response, {e}"
-        break
+    cache_key = _get_cache_key(cfg, messages)
+    cached = _get_cached_response(cfg, cache_key)
+    if cached is not None:
+        return cached, None
+    try:
+        response = flights.do(
+            cache_key,
+            retry_policy.call,
+            cfg.command,
+            send_chat_request,
+            cfg.version,
+            messages,
+        )
+    except Exception as e:
+        return "", f"Error while getting response, {e}"
+    content, error = _parse_chat_response(response)
+    if not error:
+        _set_cached_response(cfg, cache_key, content)
+    return content, error
+
+
+async def send_chat_request_async(version: str, messages: list[dict]):
+    if not settings.integrations.openai:
+        raise Exception("OpenAI integration is not configured")
+    response = await openai.ChatCompletion.acreate(
+        model=version,
+        messages=messages,
+        max_tokens=settings.integrations.openai.max_tokens,
+        temperature=TEMPERATURE,
+        timeout=10,
+        n=1,
+    )
+    return response
+
+
+@metrics.track()
+async def get_chat_response_async(
+    history: list[model.ChatHistoryEntry], text: str, cfg: model.Network
+) -> Tuple[str, Optional[str]]:
+    """
+    Async version of get_chat_response.
+    """
+    if not text:
+        return "", "No text provided"
+    messages = _format_chat_request(history, text)
+    cache_key = _get_cache_key(cfg, messages)
+    cached = _get_cached_response(cfg, cache_key)
+    if cached is not None:
+        return cached, None
+    try:
+        response = await async_flights.do(
+            cache_key,
+            retry_policy.call_async,
+            cfg.command,
+            send_chat_request_async,
+            cfg.version,
+            messages,
+        )
+    except Exception as e:
+        return "", f"Error while getting response, {e}"
+    content, error = _parse_chat_response(response)
+    if not error:
+        _set_cached_response(cfg, cache_key, content)
+    return content, error
+
+
+def _parse_chat_response(response) -> Tuple[str, Optional[str]]:
     if not response:
         return "", "Error while getting response"
     if not isinstance(response, dict) or "choices" not in response:
@@ -119,19 +277,137 @@ def get_chat_response(
     return message["content"], None
 
 
+def send_chat_stream_request(version: str, messages: list[dict]):
+    if not settings.integrations.openai:
+        raise Exception("OpenAI integration is not configured")
+    response = openai.ChatCompletion.create(
+        model=version,
+        messages=messages,
+        max_tokens=settings.integrations.openai.max_tokens,
+        temperature=TEMPERATURE,
+        timeout=10,
+        n=1,
+        stream=True,
+    )
+    return response
+
+
+@metrics.track()
+def get_chat_stream(
+    history: list[model.ChatHistoryEntry], text: str, cfg: model.Network
+) -> Tuple[Optional[Iterator[str]], Optional[str]]:
+    """
+    Request an answer from a Chat model, answer comes in pieces as they get generated.
+    """
+    if not text:
+        return None, "No text provided"
+    messages = _format_chat_request(history, text)
+    try:
+        response = retry_policy.call(
+            cfg.command,
+            send_chat_stream_request,
+            cfg.version,
+            messages,
+        )
+    except Exception as e:
+        return None, f"Error while getting response, {e}"
+    if not response:
+        return None, "Error while getting response"
+    return (_parse_chat_chunk(chunk) for chunk in response), None
+
+
+async def send_chat_stream_request_async(version: str, messages: list[dict]):
+    if not settings.integrations.openai:
+        raise Exception("OpenAI integration is not configured")
+    response = await openai.ChatCompletion.acreate(
+        model=version,
+        messages=messages,
+        max_tokens=settings.integrations.openai.max_tokens,
+        temperature=TEMPERATURE,
+        timeout=10,
+        n=1,
+        stream=True,
+    )
+    return response
+
+
+@metrics.track()
+async def get_chat_stream_async(
+    history: list[model.ChatHistoryEntry], text: str, cfg: model.Network
+) -> Tuple[Optional[AsyncIterator[str]], Optional[str]]:
+    """
+    Async version of get_chat_stream.
+    """
+    if not text:
+        return None, "No text provided"
+    messages = _format_chat_request(history, text)
+    try:
+        response = await retry_policy.call_async(
+            cfg.command,
+            send_chat_stream_request_async,
+            cfg.version,
+            messages,
+        )
+    except Exception as e:
+        return None, f"Error while getting response, {e}"
+    if not response:
+        return None, "Error while getting response"
+    return (_parse_chat_chunk(chunk) async for chunk in response), None
+
+
+def _parse_chat_chunk(chunk) -> str:
+    """
+    Extract content from a streamed piece of the answer, example:
+    >>> _parse_chat_chunk({"choices": [{"delta": {"content": "Hel"}}]})
+    "Hel"
+    """
+    choices = chunk.get("choices") or [{}]
+    delta = choices[0].get("delta") or {}
+    return delta.get("content") or ""
+
+
+@metrics.track(network=IMAGE_API_NAME)
 def get_dalle_response(text: str) -> Tuple[str, Optional[str]]:
     if not text:
         return "", "No text provided"
-    response = None
-    for _ in range(2):
-        try:
-            response = openai.Image.create(prompt=text, n=1, size="1024x1024")
-        except openai.error.APIConnectionError:
-            time.sleep(1)
-            continue
-        except Exception as e:
-            return "", f"Error while getting image: {e}"
-        break
+    try:
+        response = flights.do(
+            (IMAGE_API_NAME, text),
+            retry_policy.call,
+            IMAGE_API_NAME,
+            openai.Image.create,
+            prompt=text,
+            n=1,
+            size="1024x1024",
+        )
+    except Exception as e:
+        return "", f"Error while getting image: {e}"
+    return _parse_dalle_response(response)
+
+
+@metrics.track(network=IMAGE_API_NAME)
+async def get_dalle_response_async(text: str) -> Tuple[str, Optional[str]]:
+    """
+    Async version of get_dalle_response.
+    """
+    if not text:
+        return "", "No text provided"
+    try:
+        response = await async_flights.do(
+            (IMAGE_API_NAME, text),
+            retry_policy.call_async,
+            IMAGE_API_NAME,
+            openai.Image.acreate,
+            prompt=text,
+            n=1,
+            size="1024x1024",
+        )
+    except Exception as e:
+        return "", f"Error while getting image: {e}"
+    return _parse_dalle_response(response)
+
+
+def _parse_dalle_response(response) -> Tuple[str, Optional[str]]:
     if not response:
         return "", "Error while getting image: no response"
     if not isinstance(response, dict) or "data" not in response:
@@ -145,6 +421,38 @@ def get_dalle_response(text: str) -> Tuple[str, Optional[str]]:
     return value["url"], None
 
 
+def _get_cache_key(cfg: model.Network, prompt: str | list[dict]) -> str:
+    """
+    Hash everything the answer depends on: model version, prompt,
+    max tokens and temperature.
+    """
+    openai_settings = settings.integrations.openai
+    max_tokens = openai_settings.max_tokens if openai_settings else None
+    payload = json.dumps(
+        [cfg.version, prompt, max_tokens, TEMPERATURE], ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _get_cached_response(cfg: model.Network, key: str) -> Optional[str]:
+    """
+    Return cached answer if caching is enabled for the network.
+    """
+    if not cfg.cache_size:
+        return None
+    if cfg.command not in response_caches:
+        response_caches[cfg.command] = cache.TTLCache(cfg.cache_size, cfg.cache_ttl)
+    value = response_caches[cfg.command].get(key)
+    result = "miss" if value is None else "hit"
+    metrics.RESPONSE_CACHE.inc(network=cfg.command, result=result)
+    return value
+
+
+def _set_cached_response(cfg: model.Network, key: str, value: str):
+    if cfg.command in response_caches:
+        response_caches[cfg.command].set(key, value)
+
+
 def _format_text_completion_request_with_context(
     history: list[model.CompletionHistoryEntry], text: str
 ) -> str:
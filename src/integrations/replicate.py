@@ -1,32 +1,351 @@
 import io
 import os
 import time
+import asyncio
 from typing import Tuple
+from typing import BinaryIO
 from typing import Optional
 
+import requests
+import replicate
+from replicate.exceptions import ModelError
 from replicate.exceptions import ReplicateError
 from replicate import models as replicate_models
 
 from .. import model
+from .. import cache
 from .. import config
+from .. import metrics
+from .. import resilience
+from .. import singleflight
+from .. import connections
 
 logger = config.logger
 settings = config.get_settings()
+
+FINISHED_STATUSES = ("succeeded", "failed", "canceled")
+
+
+def _raise_for_retryable_status(response: requests.Response, *args, **kwargs):
+    """
+    Response hook of Replicate sessions. Client turns every error response
+    into ReplicateError without status code, so responses worth retrying,
+    429 and 5xx, are raised as HTTPError before it gets them.
+    """
+    if response.status_code == 429 or response.status_code >= 500:
+        response.raise_for_status()
+
+
 if settings.integrations.replicate:
     os.environ["REPLICATE_API_TOKEN"] = settings.integrations.replicate.api_key
+    for session in (
+        replicate.default_client.read_session,
+        replicate.default_client.write_session,
+    ):
+        connections.mount(session)
+        session.hooks["response"].append(_raise_for_retryable_status)
+    versions_cache = cache.TTLCache(
+        maxsize=max(len(settings.integrations.replicate.networks), 1),
+        ttl=settings.integrations.replicate.version_cache_ttl,
+    )
+else:
+    versions_cache = cache.TTLCache()
+# Identical prompts in flight share a single prediction
+flights = singleflight.SingleFlight("replicate")
+async_flights = singleflight.AsyncSingleFlight("replicate")
+# Other errors, e.g. invalid token or inputs, come as ReplicateError
+# and aren't retried nor counted as failures of the network.
+# Only creation of predictions is retried, see _predict
+retry_policy = resilience.RetryPolicy(
+    (requests.ConnectionError, requests.Timeout, requests.HTTPError)
+)
 
 
+@metrics.track()
 def get_replicate_image_response(
     text: str, cfg: model.Network
 ) -> Tuple[str, Optional[str]]:
     if not text:
         return "", "No text provided"
     try:
-        model = replicate_models.get(cfg.name)
-        version = model.versions.get(cfg.version)
+        _get_version(cfg)
+    except Exception as e:
+        return "", f"Error while initializing Replicate model: {e}"
+    inputs = _get_image_inputs(text)
+    try:
+        if settings.debug:
+            logger.debug(f">>> Replicate image request for: {text}")
+        output = flights.do((cfg.name, cfg.version, text), _predict, cfg, inputs)
+        logger.debug(f">>> Replicate image response: {output}")
+    except Exception as e:
+        return "", f"Error while getting image: {e}"
+    return parse_image_output(output)
+
+
+@metrics.track()
+async def get_replicate_image_response_async(
+    text: str, cfg: model.Network
+) -> Tuple[str, Optional[str]]:
+    """
+    Async version of get_replicate_image_response.
+    Replicate client is blocking, so its calls are offloaded to the executor.
+    """
+    if not text:
+        return "", "No text provided"
+    try:
+        await asyncio.to_thread(_get_version, cfg)
     except Exception as e:
         return "", f"Error while initializing Replicate model: {e}"
-    inputs = {
+    inputs = _get_image_inputs(text)
+    try:
+        if settings.debug:
+            logger.debug(f">>> Replicate image request for: {text}")
+        output = await async_flights.do(
+            (cfg.name, cfg.version, text), asyncio.to_thread, _predict, cfg, inputs
+        )
+        logger.debug(f">>> Replicate image response: {output}")
+    except Exception as e:
+        return "", f"Error while getting image: {e}"
+    return parse_image_output(output)
+
+
+@metrics.track()
+def get_replicate_audio_response(
+    file: BinaryIO, text: str, cfg: model.Network
+) -> Tuple[str, Optional[str]]:
+    output, error = _get_audio_output(file, text, cfg)
+    if error:
+        return "", error
+    return parse_audio_output(output)
+
+
+@metrics.track()
+async def get_replicate_audio_response_async(
+    file: BinaryIO, text: str, cfg: model.Network
+) -> Tuple[str, Optional[str]]:
+    """
+    Async version of get_replicate_audio_response.
+    """
+    output, error = await _get_audio_output_async(file, text, cfg)
+    if error:
+        return "", error
+    return parse_audio_output(output)
+
+
+@metrics.track()
+def get_replicate_audio_segments(
+    file: BinaryIO, text: str, cfg: model.Network
+) -> Tuple[list[dict], Optional[str]]:
+    """
+    Transcribe audio keeping segments with their timestamps, example:
+    >>> get_replicate_audio_segments(file, "", cfg)
+    ([{"start": 0.0, "end": 2.5, "text": " Hello"}, ...], None)
+    """
+    output, error = _get_audio_output(file, text, cfg)
+    if error:
+        return [], error
+    return parse_audio_segments(output)
+
+
+@metrics.track()
+async def get_replicate_audio_segments_async(
+    file: BinaryIO, text: str, cfg: model.Network
+) -> Tuple[list[dict], Optional[str]]:
+    """
+    Async version of get_replicate_audio_segments.
+    """
+    output, error = await _get_audio_output_async(file, text, cfg)
+    if error:
+        return [], error
+    return parse_audio_segments(output)
+
+
+def start_replicate_image_prediction(
+    text: str, cfg: model.Network
+) -> Tuple[str, Optional[str]]:
+    """
+    Start image generation without waiting for it, return prediction id.
+    """
+    if not text:
+        return "", "No text provided"
+    try:
+        prediction = retry_policy.call(
+            cfg.command,
+            _create_prediction,
+            cfg,
+            _get_image_inputs(text),
+            settings.jobs.webhook_url or None,
+        )
+    except Exception as e:
+        return "", f"Error while starting image generation: {e}"
+    return prediction.id, None
+
+
+def start_replicate_audio_prediction(
+    file: BinaryIO, text: str, cfg: model.Network
+) -> Tuple[str, Optional[str]]:
+    """
+    Start audio transcription without waiting for it, return prediction id.
+    """
+    try:
+        prediction = retry_policy.call(
+            cfg.command,
+            _create_prediction,
+            cfg,
+            _get_audio_inputs(file, text),
+            settings.jobs.webhook_url or None,
+        )
+    except Exception as e:
+        return "", f"Error while starting audio transcription: {e}"
+    return prediction.id, None
+
+
+def get_replicate_prediction(prediction_id: str):
+    return replicate.predictions.get(prediction_id)
+
+
+def cancel_replicate_prediction(prediction):
+    _cancel(prediction)
+
+
+def warm_versions_cache():
+    """
+    Resolve versions of all configured networks, so the first requests
+    don't have to wait for it.
+    """
+    if not settings.integrations.replicate:
+        return
+    for cfg in settings.integrations.replicate.networks:
+        try:
+            _get_version(cfg)
+        except Exception as e:
+            logger.warning(f">>> Couldn't resolve Replicate model {cfg.name}: {e}")
+
+
+def _get_version(cfg: model.Network):
+    """
+    Resolving a version takes two requests to Replicate API,
+    resolved versions are cached until TTL expires or a request fails.
+    """
+    key = (cfg.name, cfg.version)
+    version = versions_cache.get(key)
+    if version is not None:
+        return version
+    replicate_model = replicate_models.get(cfg.name)
+    version = replicate_model.versions.get(cfg.version)
+    versions_cache.set(key, version)
+    return version
+
+
+def _predict(cfg: model.Network, inputs: dict):
+    """
+    Run a prediction and wait for its output. Only creating it is retried,
+    errors while waiting are retried by polling the same prediction again,
+    so they never start a duplicate one. A prediction that can't be polled
+    anymore is canceled.
+    """
+    prediction = retry_policy.call(cfg.command, _create_prediction, cfg, inputs)
+    try:
+        _wait(prediction)
+    except Exception:
+        _cancel(prediction)
+        raise
+    if prediction.status != "succeeded":
+        raise ModelError(prediction.error or f"Prediction {prediction.status}")
+    return prediction.output
+
+
+def _create_prediction(cfg: model.Network, inputs: dict, webhook: Optional[str] = None):
+    """
+    Create a prediction without waiting for it, cached version is dropped
+    on Replicate errors, so the next attempt resolves it again.
+    """
+    version = _get_version(cfg)
+    for value in inputs.values():
+        if isinstance(value, io.IOBase):
+            value.seek(0)  # file could be read by the previous attempt
+    try:
+        return replicate.predictions.create(
+            version=version,
+            input=inputs,
+            webhook=webhook,
+            webhook_events_filter=["completed"] if webhook else None,
+        )
+    except (ReplicateError, requests.HTTPError):
+        _invalidate_version(cfg)
+        raise
+
+
+def _wait(prediction):
+    """
+    Poll the prediction until it's finished. Failed polls are repeated
+    with the backoff of retries, up to max_attempts in a row.
+    """
+    failures = 0
+    while prediction.status not in FINISHED_STATUSES:
+        time.sleep(replicate.default_client.poll_interval)
+        try:
+            prediction.reload()
+        except Exception as e:
+            if not retry_policy.is_retryable(e):
+                raise
+            failures += 1
+            if failures >= settings.resilience.max_attempts:
+                raise
+            logger.warning(f">>> Couldn't poll prediction {prediction.id}: {e}")
+            time.sleep(resilience.get_backoff(failures - 1))
+            continue
+        failures = 0
+
+
+def _cancel(prediction):
+    """
+    Stop a running prediction, so it isn't billed anymore, errors are logged.
+    """
+    try:
+        prediction.cancel()
+    except Exception as e:
+        logger.warning(f">>> Couldn't cancel prediction {prediction.id}: {e}")
+
+
+def _invalidate_version(cfg: model.Network):
+    versions_cache.invalidate((cfg.name, cfg.version))
+
+
+def _get_audio_output(file: BinaryIO, text: str, cfg: model.Network):
+    try:
+        _get_version(cfg)
+    except Exception as e:
+        return None, f"Error while initializing Replicate model: {e}"
+    inputs = _get_audio_inputs(file, text)
+    try:
+        if settings.debug:
+            logger.debug(f">>> Replicate audio request")
+        output = _predict(cfg, inputs)
+        logger.debug(f">>> Replicate audio response: {output}")
+    except Exception as e:
+        return None, f"Error while getting audio: {e}"
+    return output, None
+
+
+async def _get_audio_output_async(file: BinaryIO, text: str, cfg: model.Network):
+    try:
+        await asyncio.to_thread(_get_version, cfg)
+    except Exception as e:
+        return None, f"Error while initializing Replicate model: {e}"
+    inputs = _get_audio_inputs(file, text)
+    try:
+        if settings.debug:
+            logger.debug(f">>> Replicate audio request")
+        output = await asyncio.to_thread(_predict, cfg, inputs)
+        logger.debug(f">>> Replicate audio response: {output}")
+    except Exception as e:
+        return None, f"Error while getting audio: {e}"
+    return output, None
+
+
+def _get_image_inputs(text: str) -> dict:
+    return {
         "prompt": text,
         "width": 768,
         "height": 768,
@@ -36,18 +355,16 @@ def get_replicate_image_response(
         "guidance_scale": 7.5,
         "scheduler": "DPMSolverMultistep",
     }
-    output = None
-    for _ in range(2):
-        try:
-            if settings.debug:
-                logger.debug(f">>> Replicate image request for: {text}")
-            output = version.predict(**inputs)
-            logger.debug(f">>> Replicate image response: {output}")
-        except ReplicateError as e:
-            time.sleep(1)
-        except Exception as e:
-            return "", f"Error while getting image: {e}"
-        break
+
+
+def _get_audio_inputs(file: BinaryIO, text: str) -> dict:
+    inputs = {"audio": file, "transcription": "plain text"}
+    if len(text) == "2":
+        inputs["language"] = text
+    return inputs
+
+
+def parse_image_output(output) -> Tuple[str, Optional[str]]:
     if not output:
         return "", "Error while getting image response"
     if isinstance(output, list):
@@ -55,32 +372,26 @@ def get_replicate_image_response(
     return output or "", None
 
 
-def get_replicate_audio_response(
-    file_data: bytes, text: str, cfg: model.Network
-) -> Tuple[str, Optional[str]]:
-    try:
-        model = replicate_models.get(cfg.name)
-        version = model.versions.get(cfg.version)
-    except Exception as e:
-        return "", f"Error while initializing Replicate model: {e}"
-    f = io.BytesIO(file_data)
-    inputs = {"audio": f, "transcription": "plain text"}
-    if len(text) == "2":
-        inputs["language"] = text
-    output = None
-    for _ in range(2):
-        try:
-            if settings.debug:
-                logger.debug(f">>> Replicate audio request")
-            output = version.predict(**inputs)
-            logger.debug(f">>> Replicate audio response: {output}")
-        except ReplicateError as e:
-            time.sleep(1)
-        except Exception as e:
-            return "", f"Error while getting audio: {e}"
-        break
+def parse_audio_output(output) -> Tuple[str, Optional[str]]:
+    segments, error = parse_audio_segments(output)
+    if error:
+        return "", error
+    return join_segments(segments), None
+
+
+def parse_audio_segments(output) -> Tuple[list[dict], Optional[str]]:
     if not output:
-        return "", "Error while getting audio response"
+        return [], "Error while getting audio response"
     if not isinstance(output, dict) or "segments" not in output:
-        return "", "Error while getting audio response"
-    return output["segments"][0]["text"] or "", None
+        return [], "Error while getting audio response"
+    return output["segments"] or [], None
+
+
+def join_segments(segments: list[dict]) -> str:
+    """
+    Example:
+    >>> join_segments([{"text": " Hello"}, {"text": " world."}])
+    "Hello world."
+    """
+    texts = [(segment.get("text") or "").strip() for segment in segments]
+    return " ".join(text for text in texts if text)
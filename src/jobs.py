@@ -0,0 +1,370 @@
+import json
+import time
+import sqlite3
+import threading
+from typing import Callable
+from typing import Optional
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import telebot
+
+from . import model
+from . import config
+from . import metrics
+from . import singleflight
+from . import integrations
+
+logger = config.logger
+settings = config.get_settings()
+
+IMAGE = "image"
+AUDIO = "audio"
+FINISHED = ("succeeded", "failed", "canceled")
+
+
+@dataclass(slots=True)
+class Job:
+    id: int
+    prediction_id: str
+    kind: str  # IMAGE or AUDIO
+    network: str  # network command
+    chat_id: int
+    message_id: int  # message to reply to
+    status_message_id: Optional[int]  # message to replace with the result
+    key: Optional[str]  # identical requests share a prediction
+    created_at: float
+    next_poll_at: float
+    poll_interval: float
+
+
+# Receives the job with the parsed output or the error
+Deliverer = Callable[[Job, str, Optional[str]], None]
+# Fields of a new job: kind, network, chat_id, message_id, status_message_id, key
+NewJob = tuple[str, str, int, int, Optional[int], Optional[str]]
+
+
+class JobManager:
+    """
+    Tracks Replicate predictions started without waiting for them.
+    Jobs are kept in SQLite, so pending ones are resumed after restart.
+    A single thread polls predictions with growing intervals and hands
+    finished ones to the deliverer of their kind, run by a pool of workers.
+    Replicate webhook makes the prediction get polled right away.
+    """
+
+    __instance = None
+    deliverers: dict[str, Deliverer]
+
+    def __init__(self):
+        if JobManager.__instance is not None:
+            raise Exception("This class is a singleton!")
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.deliverers = {}
+        # Identical requests arriving at once wait for a single prediction to start
+        self.flights = singleflight.SingleFlight("jobs")
+        self.executor = ThreadPoolExecutor(
+            max_workers=settings.jobs.deliver_workers, thread_name_prefix="jobs-deliver"
+        )
+        self.conn = sqlite3.connect(settings.jobs.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    prediction_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    network TEXT NOT NULL,
+                    chat_id INTEGER NOT NULL,
+                    message_id INTEGER NOT NULL,
+                    status_message_id INTEGER,
+                    key TEXT,
+                    created_at REAL NOT NULL,
+                    next_poll_at REAL NOT NULL,
+                    poll_interval REAL NOT NULL
+                )
+                """
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_next_poll_at ON jobs (next_poll_at)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key)")
+        JobManager.__instance = self
+
+    @staticmethod
+    def get_instance():
+        if JobManager.__instance is None:
+            return JobManager()
+        return JobManager.__instance
+
+    def register(self, kind: str, fn: Deliverer):
+        self.deliverers[kind] = fn
+
+    def start(self):
+        """
+        Start polling, jobs left from the previous run are resumed.
+        """
+        # Jobs being delivered when the previous run stopped are delivered again
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE jobs SET next_poll_at = 0")
+        threading.Thread(target=self._poll, name="jobs-poller", daemon=True).start()
+        start_receiver(settings.jobs)
+        logger.info(f">>> Started jobs poller, {self.count()} pending jobs")
+
+    def submit(
+        self,
+        kind: str,
+        cfg: model.Network,
+        m: telebot.types.Message,
+        start: Callable[[], tuple[str, Optional[str]]],
+        key: Optional[str] = None,
+        status_message_id: Optional[int] = None,
+    ) -> Optional[str]:
+        """
+        Start prediction with start() returning (prediction id, error)
+        and track it, return error if it couldn't be started.
+        A pending prediction with the same key is reused.
+        """
+        job = (kind, cfg.command, m.chat.id, m.message_id, status_message_id, key)
+        if key is None:
+            prediction_id, error = start()
+            if error:
+                return error
+            self._insert(prediction_id, job)
+            return None
+        prediction_id, error, inserted = self.flights.do(
+            key, self._find_or_start, start, job
+        )
+        if error:
+            return error
+        if inserted is not job:
+            # Joined an identical request that was starting the prediction
+            self._insert(prediction_id, job)
+        return None
+
+    def nudge(self, prediction_id: str):
+        """
+        Poll prediction right away, used when Replicate reports it's finished.
+        """
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE jobs SET next_poll_at = 0 WHERE prediction_id = ?",
+                (prediction_id,),
+            )
+        self.wakeup.set()
+
+    def count(self) -> int:
+        with self.lock:
+            (count,) = self.conn.execute("SELECT COUNT(*) FROM jobs").fetchone()
+        return count
+
+    def _find_or_start(
+        self, start: Callable[[], tuple[str, Optional[str]]], job: NewJob
+    ) -> tuple[str, Optional[str], Optional[NewJob]]:
+        """
+        Reuse a pending prediction or start a new one and insert the job,
+        return (prediction id, error, inserted job).
+        """
+        key = job[-1]
+        prediction_id = self._find_prediction(key) if key else None
+        if prediction_id:
+            metrics.COALESCED.inc(integration="jobs")
+        else:
+            prediction_id, error = start()
+            if error:
+                return prediction_id, error, None
+        self._insert(prediction_id, job)
+        return prediction_id, None, job
+
+    def _insert(self, prediction_id: str, job: NewJob):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                """
+                INSERT INTO jobs (
+                    prediction_id, kind, network, chat_id, message_id,
+                    status_message_id, key, created_at, next_poll_at, poll_interval
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    prediction_id,
+                    *job,
+                    now,
+                    now + settings.jobs.poll_interval,
+                    settings.jobs.poll_interval,
+                ),
+            )
+        self.wakeup.set()
+
+    def _find_prediction(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT prediction_id FROM jobs WHERE key = ? LIMIT 1", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def _get_due_jobs(self, now: float) -> list[Job]:
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT * FROM jobs WHERE next_poll_at <= ? ORDER BY next_poll_at",
+                (now,),
+            ).fetchall()
+        return [Job(*row) for row in rows]
+
+    def _get_next_poll_at(self) -> Optional[float]:
+        with self.lock:
+            (next_poll_at,) = self.conn.execute(
+                "SELECT MIN(next_poll_at) FROM jobs"
+            ).fetchone()
+        return next_poll_at
+
+    def _poll(self):
+        while True:
+            try:
+                self._poll_due_jobs()
+                next_poll_at = self._get_next_poll_at()
+            except Exception as e:
+                logger.exception(f">>> Couldn't poll jobs: {e}")
+                next_poll_at = time.time() + settings.jobs.poll_interval
+            metrics.JOBS_PENDING.set(self.count())
+            timeout = None if next_poll_at is None else next_poll_at - time.time()
+            if timeout is None or timeout > 0:
+                self.wakeup.wait(timeout)
+            self.wakeup.clear()
+
+    def _poll_due_jobs(self):
+        now = time.time()
+        jobs_by_prediction: dict[str, list[Job]] = {}
+        for job in self._get_due_jobs(now):
+            jobs_by_prediction.setdefault(job.prediction_id, []).append(job)
+        for prediction_id, jobs in jobs_by_prediction.items():
+            try:
+                prediction = integrations.replicate.get_replicate_prediction(
+                    prediction_id
+                )
+            except Exception as e:
+                logger.warning(f">>> Couldn't get prediction {prediction_id}: {e}")
+                self._reschedule(jobs, now)
+                continue
+            if prediction.status in FINISHED:
+                self._finish(jobs, prediction)
+            elif now - jobs[0].created_at > settings.jobs.timeout:
+                integrations.replicate.cancel_replicate_prediction(prediction)
+                self._fail(jobs, "Error while getting response: timed out")
+            else:
+                self._reschedule(jobs, now)
+
+    def _reschedule(self, jobs: list[Job], now: float):
+        with self.lock, self.conn:
+            for job in jobs:
+                interval = min(job.poll_interval * 1.5, settings.jobs.max_poll_interval)
+                self.conn.execute(
+                    "UPDATE jobs SET next_poll_at = ?, poll_interval = ? WHERE id = ?",
+                    (now + interval, interval, job.id),
+                )
+
+    def _finish(self, jobs: list[Job], prediction):
+        for job in jobs:
+            if prediction.status == "succeeded":
+                output, error = _parse_output(job.kind, prediction.output)
+            else:
+                output, error = "", f"Prediction {prediction.status}: {prediction.error}"
+            self._deliver(job, output, error)
+
+    def _fail(self, jobs: list[Job], error: str):
+        for job in jobs:
+            self._deliver(job, "", error)
+
+    def _deliver(self, job: Job, output: str, error: Optional[str]):
+        deliverer = self.deliverers.get(job.kind)
+        if deliverer is None:
+            logger.warning(f">>> No deliverer for job {job.id} of kind {job.kind}")
+            self._done(job, error)
+            return
+        # Sending results takes a while, the poller keeps polling other jobs
+        # meanwhile. The job is only removed once its result is sent
+        self._postpone(job, settings.jobs.timeout)
+        self.executor.submit(self._run_deliverer, deliverer, job, output, error)
+
+    def _run_deliverer(
+        self, deliverer: Deliverer, job: Job, output: str, error: Optional[str]
+    ):
+        """
+        Send the result, a failed delivery is retried with the next poll
+        until the job times out.
+        """
+        try:
+            deliverer(job, output, error)
+        except Exception as e:
+            logger.exception(f">>> Couldn't deliver job {job.id}: {e}")
+            if time.time() - job.created_at <= settings.jobs.timeout:
+                self._postpone(job, settings.jobs.max_poll_interval)
+                return
+        self._done(job, error)
+
+    def _postpone(self, job: Job, delay: float):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE jobs SET next_poll_at = ? WHERE id = ?",
+                (time.time() + delay, job.id),
+            )
+        self.wakeup.set()
+
+    def _done(self, job: Job, error: Optional[str]):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM jobs WHERE id = ?", (job.id,))
+        metrics.REQUEST_LATENCY.observe(
+            time.time() - job.created_at, function=f"job_{job.kind}", network=job.network
+        )
+        if error:
+            metrics.REQUEST_ERRORS.inc(function=f"job_{job.kind}", network=job.network)
+
+
+def _parse_output(kind: str, output) -> tuple[str, Optional[str]]:
+    if kind == IMAGE:
+        return integrations.replicate.parse_image_output(output)
+    return integrations.replicate.parse_audio_output(output)
+
+
+class ReplicateWebhookHandler(BaseHTTPRequestHandler):
+    """
+    Receives finished predictions from Replicate. Payload is not trusted,
+    the prediction is fetched from the API by its id.
+    """
+
+    def do_POST(self):
+        if self.path.split("?")[0] != settings.jobs.webhook_path:
+            self.send_error(404)
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            prediction = json.loads(self.rfile.read(length))
+            prediction_id = prediction["id"]
+        except Exception as e:
+            logger.warning(f">>> Couldn't parse Replicate webhook: {e}")
+            self.send_error(400)
+            return
+        JobManager.get_instance().nudge(prediction_id)
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_receiver(jobs: model.JobsSettings) -> Optional[ThreadingHTTPServer]:
+    """
+    Serve Replicate webhook at http://host:port/webhook_path in a background thread.
+    """
+    if not jobs.webhook_url:
+        return None
+    server = ThreadingHTTPServer((jobs.host, jobs.port), ReplicateWebhookHandler)
+    threading.Thread(
+        target=server.serve_forever, name="jobs-receiver", daemon=True
+    ).start()
+    logger.info(f">>> Receiving Replicate webhooks on {jobs.host}:{jobs.port}")
+    return server
@@ -0,0 +1,213 @@
+import io
+import asyncio
+import hashlib
+import tempfile
+from typing import BinaryIO
+from typing import Optional
+
+import telebot
+
+from . import model
+from . import cache
+from . import sender
+from . import config
+from . import metrics
+from . import singleflight
+from . import connections
+
+logger = config.logger
+settings = config.get_settings()
+
+API_URL = "https://api.telegram.org"
+CHUNK_SIZE = 64 * 1024
+
+# Telegram file ids of uploaded images by hash of their url
+file_ids = cache.TTLCache(
+    settings.general.image_cache_size, settings.general.image_cache_ttl
+)
+# Identical images sent at the same time are uploaded once
+flights = singleflight.SingleFlight("telegram")
+async_flights = singleflight.AsyncSingleFlight("telegram")
+
+
+def download_telegram_file(file_path: str) -> BinaryIO:
+    """
+    Download file from Telegram in chunks. Small files are kept in memory,
+    larger ones are moved to a temporary file once they exceed voice_spool_size.
+    Raises FileTooLargeException as soon as voice_max_size is exceeded.
+    Returned file is positioned at the start and has to be closed by the caller.
+    """
+    max_size = settings.general.voice_max_size
+    api_url = (settings.telegram.api_url or API_URL).rstrip("/")
+    url = f"{api_url}/file/bot{settings.telegram.bot_token}/{file_path}"
+    buffer: BinaryIO = io.BytesIO()
+    try:
+        with connections.get_session().get(url, stream=True) as response:
+            response.raise_for_status()
+            if int(response.headers.get("Content-Length") or 0) > max_size:
+                raise model.FileTooLargeException(get_too_large_message())
+            size = 0
+            for chunk in response.iter_content(CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_size:
+                    raise model.FileTooLargeException(get_too_large_message())
+                if size > settings.general.voice_spool_size and isinstance(
+                    buffer, io.BytesIO
+                ):
+                    buffer = _spool(buffer)
+                buffer.write(chunk)
+    except Exception:
+        buffer.close()
+        raise
+    buffer.seek(0)
+    return buffer
+
+
+def is_too_large(file_size: int | None) -> bool:
+    """
+    Check size reported by Telegram before downloading anything.
+    """
+    return bool(file_size) and file_size > settings.general.voice_max_size
+
+
+def get_too_large_message() -> str:
+    """
+    Example:
+    >>> get_too_large_message()
+    "File is too large, max size is 20 MB"
+    """
+    max_size = settings.general.voice_max_size // 2**20
+    return f"File is too large, max size is {max_size} MB"
+
+
+def _spool(buffer: io.BytesIO) -> BinaryIO:
+    """
+    Move buffered data to a temporary file on disk.
+    It's a regular file object, so Replicate client can upload it.
+    """
+    f = tempfile.TemporaryFile()
+    with buffer.getbuffer() as view:
+        f.write(view)
+    buffer.close()
+    return f
+
+
+def send_photo(
+    outbox: sender.Sender,
+    chat_id: int,
+    url: str,
+    reply_to_message_id: Optional[int] = None,
+) -> telebot.types.Message:
+    """
+    Send image generated by a provider. It's downloaded and uploaded
+    to Telegram once, then sent by its file id.
+    """
+    key = get_image_key(url)
+    file_id = _get_file_id(key)
+    if file_id:
+        try:
+            return outbox.send_photo(
+                chat_id, file_id, reply_to_message_id=reply_to_message_id
+            ).result()
+        except telebot.apihelper.ApiTelegramException as e:
+            logger.warning(f">>> Couldn't send cached image: {e}")
+            file_ids.invalidate(key)
+    sent = []  # message sent by this call if it did the upload
+
+    def upload() -> str:
+        sent.append(None)
+        try:
+            photo = download_image(url)
+        except Exception as e:
+            # Let Telegram try to fetch it
+            logger.warning(f">>> Couldn't download image: {e}")
+            photo = url
+        message = outbox.send_photo(
+            chat_id, photo, reply_to_message_id=reply_to_message_id
+        ).result()
+        sent[0] = message
+        file_ids.set(key, message.photo[-1].file_id)
+        return message.photo[-1].file_id
+
+    try:
+        file_id = flights.do(key, upload)
+    except Exception:
+        if sent:
+            raise
+        # Upload to another chat has failed, this one can still succeed
+        file_id = upload()
+    if sent:
+        return sent[0]
+    return outbox.send_photo(
+        chat_id, file_id, reply_to_message_id=reply_to_message_id
+    ).result()
+
+
+async def send_photo_async(
+    outbox: sender.AsyncSender,
+    chat_id: int,
+    url: str,
+    reply_to_message_id: Optional[int] = None,
+) -> telebot.types.Message:
+    """
+    Async version of send_photo.
+    """
+    from telebot.asyncio_helper import ApiTelegramException as AsyncApiTelegramException
+
+    key = get_image_key(url)
+    file_id = _get_file_id(key)
+    if file_id:
+        try:
+            return await outbox.send_photo(
+                chat_id, file_id, reply_to_message_id=reply_to_message_id
+            )
+        except AsyncApiTelegramException as e:
+            logger.warning(f">>> Couldn't send cached image: {e}")
+            file_ids.invalidate(key)
+    sent = []  # message sent by this call if it did the upload
+
+    async def upload() -> str:
+        sent.append(None)
+        try:
+            photo = await asyncio.to_thread(download_image, url)
+        except Exception as e:
+            logger.warning(f">>> Couldn't download image: {e}")
+            photo = url
+        message = await outbox.send_photo(
+            chat_id, photo, reply_to_message_id=reply_to_message_id
+        )
+        sent[0] = message
+        file_ids.set(key, message.photo[-1].file_id)
+        return message.photo[-1].file_id
+
+    try:
+        file_id = await async_flights.do(key, upload)
+    except Exception:
+        if sent:
+            raise
+        # Upload to another chat has failed, this one can still succeed
+        file_id = await upload()
+    if sent:
+        return sent[0]
+    return await outbox.send_photo(
+        chat_id, file_id, reply_to_message_id=reply_to_message_id
+    )
+
+
+def download_image(url: str) -> bytes:
+    response = connections.get_session().get(url)
+    response.raise_for_status()
+    return response.content
+
+
+def get_image_key(url: str) -> str:
+    """
+    Identical results of coalesced and cached requests share the key.
+    """
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
+def _get_file_id(key: str) -> Optional[str]:
+    file_id = file_ids.get(key)
+    metrics.IMAGE_CACHE.inc(result="hit" if file_id else "miss")
+    return file_id
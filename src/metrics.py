@@ -0,0 +1,413 @@
+import time
+import inspect
+import threading
+import functools
+from typing import Callable
+from typing import Optional
+from typing import TYPE_CHECKING
+from urllib.parse import urlparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from . import model
+from . import config
+
+if TYPE_CHECKING:
+    import aiohttp
+
+logger = config.logger
+
+PREFIX = "tg_ai_"
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TELEGRAM_API_URL = "https://api.telegram.org"
+
+
+class Metric:
+    """
+    Base class for metrics exposed in Prometheus text format.
+    Values are stored per combination of label values.
+    """
+
+    type = ""
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        self.name = PREFIX + name
+        self.description = description
+        self.labels = labels
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def _format_labels(self, key: tuple, extra: str = "") -> str:
+        pairs = [f'{label}="{_escape(value)}"' for label, value in zip(self.labels, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.type}",
+            *self._render_samples(),
+        ]
+
+    def _render_samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, description, labels)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, *, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def _render_samples(self) -> list[str]:
+        with self.lock:
+            values = list(self.values.items())
+        return [f"{self.name}{self._format_labels(k)} {v}" for k, v in values]
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, description, labels)
+        self.values: dict[tuple, float] = {}
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def inc(self, *, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, *, amount: float = 1, **labels):
+        self.inc(amount=-amount, **labels)
+
+    def _render_samples(self) -> list[str]:
+        with self.lock:
+            values = list(self.values.items())
+        return [f"{self.name}{self._format_labels(k)} {v}" for k, v in values]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+        # label values -> (counts per bucket, sum, count)
+        self.values: dict[tuple, tuple[list[int], float, int]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, total, count = self.values.get(
+                key, ([0] * len(self.buckets), 0.0, 0)
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    def _render_samples(self) -> list[str]:
+        with self.lock:
+            values = [(k, list(c), t, n) for k, (c, t, n) in self.values.items()]
+        lines = []
+        for key, counts, total, count in values:
+            for bound, bucket_count in zip(self.buckets, counts):
+                labels = self._format_labels(key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+            labels = self._format_labels(key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {count}")
+        return lines
+
+
+REGISTRY: list[Metric] = []
+COLLECTORS: list[Callable[[], None]] = []
+
+REQUEST_LATENCY = Histogram(
+    "request_duration_seconds",
+    "Duration of requests to integrations",
+    ("function", "network"),
+)
+REQUEST_ERRORS = Counter(
+    "request_errors_total",
+    "Requests to integrations finished with an error",
+    ("function", "network"),
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "requests_in_flight",
+    "Requests to integrations waiting for response",
+    ("function", "network"),
+)
+RETRIES = Counter(
+    "retries_total",
+    "Retried requests to integrations",
+    ("network",),
+)
+REJECTED = Counter(
+    "rejected_messages_total",
+    "Messages rejected before processing",
+    ("reason",),
+)
+TELEGRAM_LATENCY = Histogram(
+    "telegram_request_duration_seconds",
+    "Duration of requests to Telegram API",
+    ("method",),
+)
+DIALOGS_EVICTED = Counter(
+    "dialogs_evicted_total",
+    "Idle dialogs removed by the sweeper",
+)
+HTTP_POOL_REQUESTS = Gauge(
+    "http_pool_requests",
+    "Requests sent through connection pools",
+    ("host",),
+)
+HTTP_POOL_MISSES = Gauge(
+    "http_pool_misses",
+    "Requests that had to open a new connection",
+    ("host",),
+)
+RESPONSE_CACHE = Counter(
+    "response_cache_requests_total",
+    "Lookups in the cache of answers by result: hit or miss",
+    ("network", "result"),
+)
+IMAGE_CACHE = Counter(
+    "image_cache_requests_total",
+    "Lookups of uploaded images in the cache of Telegram file ids by result",
+    ("result",),
+)
+COALESCED = Counter(
+    "coalesced_requests_total",
+    "Requests that joined an identical request already in flight",
+    ("integration",),
+)
+CIRCUIT_STATE = Gauge(
+    "circuit_breaker_state",
+    "State of circuit breakers: 0 closed, 1 half-open, 2 open",
+    ("network",),
+)
+OUTBOX_PENDING = Gauge(
+    "outbox_pending",
+    "Messages waiting to be sent to Telegram",
+)
+FLOOD_WAITS = Counter(
+    "flood_waits_total",
+    "Messages sent again after Telegram asked to retry later",
+)
+WEBHOOK_UPDATES = Counter(
+    "webhook_updates_total",
+    "Updates received by webhook server by result",
+    ("result",),
+)
+FORWARDED_UPDATES = Counter(
+    "forwarded_updates_total",
+    "Updates forwarded to the worker owning them",
+    ("worker",),
+)
+JOBS_PENDING = Gauge(
+    "jobs_pending",
+    "Replicate predictions waiting to be finished",
+)
+QUEUE_DEPTH = Gauge(
+    "queue_depth",
+    "Jobs waiting or running in the worker pool",
+    ("pool",),
+)
+LANES_ACTIVE = Gauge(
+    "lanes_active",
+    "Conversations with a job running in the worker pool",
+    ("pool",),
+)
+LANE_WAITING = Gauge(
+    "lane_waiting",
+    "Jobs waiting for the previous job of the same conversation",
+    ("pool",),
+)
+
+
+def track(network: str = "") -> Callable:
+    """
+    Decorator measuring latency, errors and in-flight requests of
+    an integration function returning (response, error) tuple.
+    Network label is the command of the Network argument if it's given.
+    Async versions of functions share metrics with sync ones.
+    """
+
+    def decorator(fn: Callable) -> Callable:
+        function = fn.__name__.removesuffix("_async")
+
+        def get_network(args, kwargs) -> str:
+            for arg in (*args, *kwargs.values()):
+                if isinstance(arg, model.Network):
+                    return arg.command
+            return network
+
+        def get_labels(args, kwargs) -> dict:
+            return {"function": function, "network": get_network(args, kwargs)}
+
+        def observe(labels: dict, started: float, result):
+            REQUESTS_IN_FLIGHT.dec(**labels)
+            REQUEST_LATENCY.observe(time.monotonic() - started, **labels)
+            if isinstance(result, tuple) and len(result) == 2 and result[1]:
+                REQUEST_ERRORS.inc(**labels)
+
+        if inspect.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                labels = get_labels(args, kwargs)
+                REQUESTS_IN_FLIGHT.inc(**labels)
+                started = time.monotonic()
+                result = None
+                try:
+                    result = await fn(*args, **kwargs)
+                    return result
+                except Exception as e:
+                    result = (None, str(e))
+                    raise
+                finally:
+                    observe(labels, started, result)
+
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            labels = get_labels(args, kwargs)
+            REQUESTS_IN_FLIGHT.inc(**labels)
+            started = time.monotonic()
+            result = None
+            try:
+                result = fn(*args, **kwargs)
+                return result
+            except Exception as e:
+                result = (None, str(e))
+                raise
+            finally:
+                observe(labels, started, result)
+
+        return wrapper
+
+    return decorator
+
+
+def observe_telegram_response(response, *args, **kwargs):
+    """
+    Response hook for requests session, measures Telegram API latency.
+    """
+    observe_telegram_request(response.url, response.elapsed.total_seconds())
+
+
+def create_trace_config() -> "aiohttp.TraceConfig":
+    """
+    Trace config for aiohttp sessions, measures Telegram API latency
+    of the async runtime.
+    """
+    # aiohttp takes a while to import and only the async runtime needs it
+    import aiohttp
+
+    async def on_request_start(session, context, params):
+        context.started = time.monotonic()
+
+    async def on_request_end(session, context, params):
+        observe_telegram_request(str(params.url), time.monotonic() - context.started)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    return trace_config
+
+
+def observe_telegram_request(url: str, seconds: float):
+    """
+    Record latency of a request if it was sent to the configured Bot API server.
+    Long polling requests are skipped, they're slow by design.
+    """
+    parsed = urlparse(url)
+    api_url = _get_telegram_api_url()
+    if parsed.netloc != api_url.netloc or not parsed.path.startswith(api_url.path):
+        return
+    path = parsed.path[len(api_url.path) :].split("/")
+    method = "downloadFile" if len(path) > 1 and path[1] == "file" else path[-1]
+    if method == "getUpdates":
+        return
+    TELEGRAM_LATENCY.observe(seconds, method=method)
+
+
+@functools.cache
+def _get_telegram_api_url():
+    api_url = config.get_settings().telegram.api_url or TELEGRAM_API_URL
+    return urlparse(api_url.rstrip("/"))
+
+
+def on_collect(fn: Callable[[], None]):
+    """
+    Register function updating metrics right before they are rendered.
+    """
+    COLLECTORS.append(fn)
+
+
+def render() -> str:
+    for collector in COLLECTORS:
+        try:
+            collector()
+        except Exception as e:
+            logger.warning(f">>> Couldn't collect metrics: {e}")
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(settings: model.MetricsSettings) -> Optional[ThreadingHTTPServer]:
+    """
+    Serve metrics at http://host:port/metrics in a background thread.
+    """
+    if not settings.enabled:
+        return None
+    server = ThreadingHTTPServer((settings.host, settings.port), MetricsHandler)
+    threading.Thread(
+        target=server.serve_forever, name="metrics-server", daemon=True
+    ).start()
+    logger.info(f">>> Serving metrics on {settings.host}:{settings.port}")
+    return server
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -1,29 +1,34 @@
+import os
+import sys
 from typing import Optional
+from dataclasses import field
 from dataclasses import dataclass
 
 from pydantic import BaseModel
 
 
-@dataclass
+@dataclass(slots=True)
 class HistoryEntry:
     timestamp: int
 
 
-@dataclass
+@dataclass(slots=True)
 class CompletionHistoryEntry(HistoryEntry):
     message: str
     response: str
+    tokens: Optional[int] = field(default=None, compare=False)  # cached token count
 
     @classmethod
     def from_message(cls, message: str, timestamp: int, response: str):
         return cls(message=message, response=response, timestamp=timestamp)
 
 
-@dataclass
+@dataclass(slots=True)
 class ChatHistoryEntry(HistoryEntry):
     message: str
     message_role: str  # "user" or "system"
     response: str
+    tokens: Optional[int] = field(default=None, compare=False)  # cached token count
 
     @classmethod
     def from_message(
@@ -32,7 +37,10 @@ class ChatHistoryEntry(HistoryEntry):
         if message.lower().startswith("you are"):
             role = "system"
         return cls(
-            message=message, message_role=role, response=response, timestamp=timestamp
+            message=message,
+            message_role=sys.intern(role),
+            response=response,
+            timestamp=timestamp,
         )
 
 
@@ -41,16 +49,22 @@ class Network(BaseModel):
     command: str
     version: str
     type: str
+    history_tokens: Optional[int]  # history budget in tokens
+    cache_size: int = 0  # amount of cached answers, 0 disables the cache
+    cache_ttl: int = 3600
 
 
 class OpenAIIntegration(BaseModel):
     api_key: str
     max_tokens: int = 500
+    stream: bool = False
+    stream_edit_interval: float = 1.5
     networks: list[Network]
 
 
 class ReplicateIntegration(BaseModel):
     api_key: str
+    version_cache_ttl: int = 3600
     networks: list[Network]
 
 
@@ -64,12 +78,146 @@ class TelegramSettings(BaseModel):
     admin_id: Optional[int]
     allowed_users: list[int] = []
     allowed_chats: list[int] = []
+    api_url: str = ""  # Bot API server, e.g. a local one, https://api.telegram.org if empty
 
 
 class GeneralSettings(BaseModel):
     text_history_size: int = 10
     text_history_ttl: int = 300
+    text_history_sweep_interval: int = 60
+    async_workers: int = 100
+    voice_max_size: int = 20 * 2**20  # larger voice messages are rejected, in bytes
+    voice_spool_size: int = 2**20  # larger voice messages are kept on disk, in bytes
+    image_cache_size: int = 1000  # how many uploaded images to remember
+    image_cache_ttl: int = 86400  # for how long to reuse uploaded images, in seconds
+
+
+class HostPoolSettings(BaseModel):
+    pool_maxsize: Optional[int]
+    timeout: Optional[float]
+
+
+class HttpSettings(BaseModel):
+    timeout: float = 30
+    keep_alive: bool = True
+    pool_connections: int = 10  # how many hosts to keep pools for
+    pool_maxsize: int = 10  # how many connections to keep per host
+    hosts: dict[str, HostPoolSettings] = {}
+
+
+class MetricsSettings(BaseModel):
+    enabled: bool = False
+    host: str = "127.0.0.1"
+    port: int = 9090
+
+
+class StorageSettings(BaseModel):
+    backend: str = "memory"  # "memory", "sqlite" or "redis"
+    path: str = "dialogs.db"
+    batch_size: int = 50  # how many appends to buffer before writing
+    flush_interval: float = 1.0  # how often to write buffered appends, in seconds
+    redis_url: str = "redis://localhost:6379/0"
+    whitelist: str = "file"  # "file", "sqlite" or "redis"
+    whitelist_path: str = "whitelist.txt"
+    whitelist_reload_interval: float = 1.0  # how often to check for changes, in seconds
+
+
+class PoolSettings(BaseModel):
+    workers: int = 4
+    queue_size: int = 16
+
+
+class SchedulerSettings(BaseModel):
+    # Pools are keyed by network command or network type
+    pools: dict[str, PoolSettings] = {}
+    lane_size: int = 4  # jobs of a single conversation waiting for the running one
+
+
+class ResilienceSettings(BaseModel):
+    max_attempts: int = 3  # attempts per request including the first one
+    backoff_base: float = 0.5  # seconds, doubled after every attempt
+    backoff_max: float = 8.0
+    retry_budget_ratio: float = 0.2  # retries allowed per request
+    retry_budget_max: float = 20.0
+    failure_threshold: int = 5  # failures in a row that open the breaker
+    reset_timeout: float = 30.0  # seconds until a trial request
+
+
+class RateLimit(BaseModel):
+    per_minute: float  # how fast tokens are refilled
+    burst: int  # how many tokens a bucket holds
+
+
+class RateLimitSettings(BaseModel):
+    enabled: bool = False
+    user: Optional[RateLimit] = RateLimit(per_minute=20, burst=5)
+    chat: Optional[RateLimit] = RateLimit(per_minute=60, burst=20)
+    # Limits of a single user by network command
+    networks: dict[str, RateLimit] = {}
+
+
+class SenderSettings(BaseModel):
+    enabled: bool = True  # send replies from a queue within Telegram flood limits
+    workers: int = 4  # how many messages are sent at once
+    queue_size: int = 100  # messages waiting to be sent to a single chat
+    max_retries: int = 5  # how many times to wait for retry_after of a flood error
+    total: RateLimit = RateLimit(per_minute=1800, burst=30)
+    private: RateLimit = RateLimit(per_minute=60, burst=3)
+    group: RateLimit = RateLimit(per_minute=20, burst=3)
+
+
+class WebhookSettings(BaseModel):
+    enabled: bool = False  # receive updates with webhook instead of polling
+    url: str = ""  # public url, webhook is registered in Telegram if it's set
+    host: str = "0.0.0.0"
+    port: int = 8443
+    path: str = "/webhook"
+    secret_token: str = ""  # checked in every request if it's set
+    max_connections: int = 40  # parallel requests from Telegram
+    queue_size: int = 1000  # updates waiting for processing
+
+
+class ClusterSettings(BaseModel):
+    enabled: bool = False
+    worker_id: int = 0  # can be overridden with BOT_WORKER_ID environment variable
+    # Base urls of webhook servers of all workers, index is worker id
+    peers: list[str] = []
+
+    def get_worker_id(self) -> int:
+        return int(os.environ.get("BOT_WORKER_ID", self.worker_id))
+
+
+class JobsSettings(BaseModel):
+    enabled: bool = False  # start Replicate predictions without waiting for them
+    path: str = "jobs.db"
+    poll_interval: float = 1.0  # first poll delay, grows with every poll
+    max_poll_interval: float = 10.0
+    timeout: float = 600.0  # give up on predictions running longer, in seconds
+    deliver_workers: int = 4  # how many results are sent at once
+    webhook_url: str = ""  # public url of the receiver, Replicate calls it when done
+    host: str = "0.0.0.0"
+    port: int = 8444
+    webhook_path: str = "/replicate"
+
+
+class TranscriptionSettings(BaseModel):
+    chunk_duration: int = 60  # longer voice messages are split into chunks, in seconds
+    chunk_overlap: int = 2  # chunks overlap, so words on the edges aren't lost
+    workers: int = 4  # how many chunks of all messages are transcribed at once
+    ffmpeg: str = "ffmpeg"  # path to ffmpeg, voice messages aren't split without it
 
 
 class ConfigException(Exception):
     pass
+
+
+class QueueFullException(Exception):
+    pass
+
+
+class CircuitOpenException(Exception):
+    pass
+
+
+class FileTooLargeException(Exception):
+    pass
@@ -0,0 +1,115 @@
+import time
+import threading
+from typing import Optional
+
+from . import model
+from . import cache
+from . import config
+
+logger = config.logger
+settings = config.get_settings()
+
+# Idle buckets are forgotten, a new bucket starts full
+BUCKETS_MAXSIZE = 100_000
+BUCKETS_TTL = 3600
+
+
+class TokenBucket:
+    """
+    Holds up to burst tokens, refilled at per_minute tokens per minute.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated_at")
+
+    def __init__(self, limit: model.RateLimit, now: float):
+        self.rate = limit.per_minute / 60
+        self.burst = limit.burst
+        self.tokens = float(limit.burst)
+        self.updated_at = now
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self) -> float:
+        """
+        Seconds until a token is available.
+        """
+        if self.tokens >= 1:
+            return 0
+        if not self.rate:
+            return float("inf")
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """
+    Token buckets for users, chats and networks used by a user.
+    A message is let through only if every bucket it falls into has a token,
+    then a token is taken from each of them.
+    """
+
+    __instance = None
+
+    def __init__(self):
+        if RateLimiter.__instance is not None:
+            raise Exception("This class is a singleton!")
+        self.lock = threading.Lock()
+        self.buckets = cache.TTLCache(BUCKETS_MAXSIZE, BUCKETS_TTL)
+        RateLimiter.__instance = self
+
+    @staticmethod
+    def get_instance():
+        if RateLimiter.__instance is None:
+            return RateLimiter()
+        return RateLimiter.__instance
+
+    def acquire(self, user_id: int, chat_id: int, command: str) -> float:
+        """
+        Take tokens for a message, return 0 if it's allowed
+        or how many seconds to wait otherwise, example:
+        >>> RateLimiter.get_instance().acquire(1, -100, "m")
+        12.0
+        """
+        limits = get_limits(user_id, chat_id, command)
+        if not limits:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            buckets = []
+            for key, limit in limits:
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    bucket = TokenBucket(limit, now)
+                bucket.refill(now)
+                # Set on every message, so active buckets don't expire
+                self.buckets.set(key, bucket)
+                buckets.append(bucket)
+            wait = max(bucket.wait_time() for bucket in buckets)
+            if wait:
+                return wait
+            for bucket in buckets:
+                bucket.tokens -= 1
+        return 0
+
+
+def get_limits(
+    user_id: int, chat_id: int, command: str
+) -> list[tuple[str, model.RateLimit]]:
+    """
+    Find buckets a message falls into, example:
+    >>> get_limits(1, -100, "m")
+    [("user:1", RateLimit(...)), ("chat:-100", RateLimit(...)), ("m:1", RateLimit(...))]
+    """
+    ratelimit = settings.ratelimit
+    if not ratelimit.enabled or user_id == settings.telegram.admin_id:
+        return []
+    limits = []
+    if ratelimit.user:
+        limits.append((f"user:{user_id}", ratelimit.user))
+    if ratelimit.chat and chat_id != user_id:
+        limits.append((f"chat:{chat_id}", ratelimit.chat))
+    network_limit: Optional[model.RateLimit] = ratelimit.networks.get(command)
+    if network_limit:
+        limits.append((f"{command}:{user_id}", network_limit))
+    return limits
@@ -0,0 +1,247 @@
+import time
+import random
+import asyncio
+import threading
+from typing import Any
+from typing import Callable
+from typing import Optional
+from typing import Coroutine
+
+from . import model
+from . import config
+from . import metrics
+
+logger = config.logger
+settings = config.get_settings()
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to a network after too many failures in a row.
+    Every reset_timeout one trial request is let through,
+    the breaker closes if it succeeds and opens again if it fails.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+        metrics.CIRCUIT_STATE.set(STATES[CLOSED], network=name)
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.retry_in() == 0:
+                # Let a single trial request through, another one is let through
+                # after reset_timeout in case this one never finishes
+                self.opened_at = time.monotonic()
+                self._set_state(HALF_OPEN)
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            if self.state != CLOSED:
+                logger.info(f">>> Circuit breaker {self.name} is closed")
+                self._set_state(CLOSED)
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    logger.warning(f">>> Circuit breaker {self.name} is open")
+                self.opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+    def retry_in(self) -> float:
+        """
+        Seconds left until the next trial request.
+        """
+        if self.state == CLOSED:
+            return 0
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def _set_state(self, state: str):
+        self.state = state
+        metrics.CIRCUIT_STATE.set(STATES[state], network=self.name)
+
+
+class RetryBudget:
+    """
+    Limits retries to a share of requests, so an outage doesn't multiply load.
+    Every request deposits ratio tokens, every retry withdraws one.
+    """
+
+    def __init__(self, ratio: float, max_tokens: float):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class RetryPolicy:
+    """
+    Calls a function with retries on errors from retry_on, example:
+    >>> policy = RetryPolicy((openai.error.APIConnectionError,))
+    >>> policy.call("c", openai.ChatCompletion.create, model="gpt-4", messages=[])
+    Delays grow exponentially with full jitter, retries are limited by
+    the global budget and calls fail fast while the network's breaker is open.
+    Only errors from retry_on are counted as failures of the network,
+    retry_if narrows them down when the type isn't enough, e.g. by status code.
+    """
+
+    def __init__(
+        self,
+        retry_on: tuple[type[Exception], ...],
+        retry_if: Optional[Callable[[Exception], bool]] = None,
+    ):
+        self.retry_on = retry_on
+        self.retry_if = retry_if
+
+    def is_retryable(self, e: Exception) -> bool:
+        return isinstance(e, self.retry_on) and (
+            self.retry_if is None or self.retry_if(e)
+        )
+
+    def call(self, network: str, fn: Callable, *args, **kwargs) -> Any:
+        breaker = _before_call(network)
+        attempt = 0
+        while True:
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                if not self.is_retryable(e):
+                    # Network has responded, the error is not its failure
+                    breaker.record_success()
+                    raise
+                breaker.record_failure()
+                delay = _get_retry_delay(network, attempt, breaker, e)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            breaker.record_success()
+            return result
+
+    async def call_async(
+        self, network: str, fn: Callable[..., Coroutine], *args, **kwargs
+    ) -> Any:
+        breaker = _before_call(network)
+        attempt = 0
+        while True:
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as e:
+                if not self.is_retryable(e):
+                    # Network has responded, the error is not its failure
+                    breaker.record_success()
+                    raise
+                breaker.record_failure()
+                delay = _get_retry_delay(network, attempt, breaker, e)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            breaker.record_success()
+            return result
+
+
+breakers: dict[str, CircuitBreaker] = {}
+breakers_lock = threading.Lock()
+retry_budget = RetryBudget(
+    settings.resilience.retry_budget_ratio, settings.resilience.retry_budget_max
+)
+
+
+def get_breaker(network: str) -> CircuitBreaker:
+    with breakers_lock:
+        if network not in breakers:
+            breakers[network] = CircuitBreaker(
+                network,
+                settings.resilience.failure_threshold,
+                settings.resilience.reset_timeout,
+            )
+        return breakers[network]
+
+
+def get_breakers_state() -> dict[str, dict]:
+    """
+    State of circuit breakers by network, example:
+    >>> get_breakers_state()
+    {"c": {"state": "open", "failures": 5, "retry_in": 12.5}}
+    """
+    with breakers_lock:
+        items = list(breakers.items())
+    return {
+        network: {
+            "state": breaker.state,
+            "failures": breaker.failures,
+            "retry_in": breaker.retry_in(),
+        }
+        for network, breaker in items
+    }
+
+
+def get_backoff(attempt: int) -> float:
+    """
+    Exponential backoff with full jitter, example:
+    >>> get_backoff(2)  # random value between 0 and backoff_base * 2 ** 2
+    1.3
+    """
+    cap = min(
+        settings.resilience.backoff_max,
+        settings.resilience.backoff_base * 2**attempt,
+    )
+    return random.uniform(0, cap)
+
+
+def _before_call(network: str) -> CircuitBreaker:
+    breaker = get_breaker(network)
+    if not breaker.allow():
+        raise model.CircuitOpenException(
+            f"{network} is unavailable, try again in {breaker.retry_in():.0f}s"
+        )
+    retry_budget.deposit()
+    return breaker
+
+
+def _get_retry_delay(
+    network: str, attempt: int, breaker: CircuitBreaker, e: Exception
+) -> float | None:
+    """
+    Delay before the next attempt or None if the call shouldn't be retried.
+    """
+    if attempt + 1 >= settings.resilience.max_attempts:
+        return None
+    if breaker.state == OPEN:
+        return None
+    if not retry_budget.withdraw():
+        logger.warning(f">>> Retry budget is exhausted, not retrying {network}: {e}")
+        return None
+    metrics.RETRIES.inc(network=network)
+    return get_backoff(attempt)
@@ -0,0 +1,147 @@
+"""
+Routing of incoming updates, built once from settings and registered handlers.
+Updates no handler would act on, e.g. chatter in groups without global handlers,
+unknown commands or service messages, are dropped before filters.
+"""
+from typing import Optional
+
+import telebot
+
+from . import model
+from . import cache
+from . import store
+from . import config
+from . import metrics
+
+logger = config.logger
+settings = config.get_settings()
+
+# Decisions of idle users are forgotten, they are recomputed on the next message
+DECISIONS_MAXSIZE = 100_000
+DECISIONS_TTL = 3600
+
+
+class Router:
+    """
+    Index of networks by command, name and type and a cache of
+    whitelist decisions by (user, chat, username), cleared whenever
+    the whitelist changes. Example:
+    >>> router = Router.get_instance()
+    >>> router.find_network_by_command("m")
+    Network(name="tstramer/midjourney-diffusion", command="m", ...)
+    """
+
+    __instance = None
+
+    def __init__(self):
+        if Router.__instance is not None:
+            raise Exception("This class is a singleton!")
+        self.by_command: dict[str, model.Network] = {}
+        self.by_name: dict[str, model.Network] = {}
+        self.by_type: dict[str, model.Network] = {}
+        replicate = settings.integrations.replicate
+        openai = settings.integrations.openai
+        # Replicate networks win over OpenAI ones with the same name
+        for network in (replicate.networks if replicate else []) + (
+            openai.networks if openai else []
+        ):
+            self.by_command.setdefault(network.command, network)
+            self.by_name.setdefault(network.name, network)
+        # Only Replicate networks are looked up by type
+        for network in replicate.networks if replicate else []:
+            self.by_type.setdefault(network.type, network)
+        self.allowed_users = set(settings.telegram.allowed_users)
+        self.allowed_chats = set(settings.telegram.allowed_chats)
+        if settings.telegram.admin_id:
+            self.allowed_users.add(settings.telegram.admin_id)
+        # Commands and content types handlers are registered for
+        self.commands: set[str] = set()
+        self.content_types: set[str] = set()
+        self.decisions = cache.TTLCache(DECISIONS_MAXSIZE, DECISIONS_TTL)
+        store.WhitelistStore.get_instance().subscribe(self.decisions.clear)
+        Router.__instance = self
+
+    @staticmethod
+    def get_instance():
+        if Router.__instance is None:
+            return Router()
+        return Router.__instance
+
+    def index_handlers(self, handlers: list[dict]):
+        """
+        Remember what registered message handlers react to.
+        """
+        for handler in handlers:
+            filters = handler["filters"]
+            if filters.get("commands"):
+                self.commands.update(filters["commands"])
+            else:
+                self.content_types.update(filters.get("content_types") or ["text"])
+
+    def find_network_by_command(self, command: str) -> Optional[model.Network]:
+        return self.by_command.get(command)
+
+    def find_network_by_name(self, name: str) -> Optional[model.Network]:
+        return self.by_name.get(name)
+
+    def find_network_by_type(self, network_type: str) -> Optional[model.Network]:
+        return self.by_type.get(network_type)
+
+    def filter_updates(
+        self, updates: list[telebot.types.Update]
+    ) -> list[telebot.types.Update]:
+        relevant = [u for u in updates if self.is_relevant(u)]
+        if len(relevant) < len(updates):
+            metrics.REJECTED.inc(
+                amount=len(updates) - len(relevant), reason="irrelevant"
+            )
+        return relevant
+
+    def is_relevant(self, update: telebot.types.Update) -> bool:
+        """
+        Check if any handler would act on the update, without regexes.
+        """
+        m = update.message
+        if m is None:
+            return False
+        if m.content_type == "text" and m.text.startswith("/"):
+            # Same parsing as command filters of handlers
+            return telebot.util.extract_command(m.text) in self.commands
+        if m.content_type == "text" and m.from_user.id == m.chat.id:
+            # Chatter is only kept in group conversations
+            return False
+        return m.content_type in self.content_types
+
+    def is_allowed(self, user_id: int, chat_id: int, username: Optional[str]) -> bool:
+        """
+        Check config and whitelist, decision is cached until the whitelist
+        changes, so a blocked user is logged once instead of every message.
+        """
+        key = (user_id, chat_id, username)
+        allowed = self.decisions.get(key)
+        if allowed is None:
+            allowed = (
+                user_id in self.allowed_users
+                or chat_id in self.allowed_chats
+                or allowed_whitelist(user_id, chat_id, username)
+            )
+            self.decisions.set(key, allowed)
+            if not allowed:
+                logger.warning(
+                    f">>> Messages from user {user_id}, chat {chat_id} are blocked"
+                )
+        if not allowed:
+            metrics.REJECTED.inc(reason="whitelist")
+        return allowed
+
+
+def allowed_whitelist(user_id: int, chat_id: int, username: Optional[str]) -> bool:
+    whitelist_store = store.WhitelistStore.get_instance()
+    if whitelist_store.is_whitelisted(user_id):
+        return True
+    if whitelist_store.is_whitelisted(chat_id):
+        return True
+    if username and whitelist_store.is_whitelisted(username.lower()):
+        return True
+    return False
+
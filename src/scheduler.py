@@ -0,0 +1,251 @@
+import queue
+import asyncio
+import threading
+from typing import Callable
+from typing import Hashable
+from typing import Optional
+from typing import Coroutine
+from collections import deque
+
+from . import model
+from . import config
+from . import metrics
+
+logger = config.logger
+settings = config.get_settings()
+
+DEFAULT_POOL = "default"
+DEFAULT_POOLS = {
+    "text": model.PoolSettings(workers=8, queue_size=32),
+    "image": model.PoolSettings(workers=2, queue_size=8),
+    "audio": model.PoolSettings(workers=2, queue_size=8),
+    DEFAULT_POOL: model.PoolSettings(),
+}
+
+
+class WorkerPool:
+    """
+    Fixed amount of worker threads consuming jobs from a bounded queue.
+    """
+
+    def __init__(self, name: str, workers: int, queue_size: int):
+        self.name = name
+        self.workers = workers
+        self.queue_size = queue_size
+        self.pending = 0  # queued and running jobs
+        self.lock = threading.Lock()
+        self.jobs: queue.Queue = queue.Queue()
+        for i in range(workers):
+            t = threading.Thread(
+                target=self._work, name=f"pool-{name}-{i}", daemon=True
+            )
+            t.start()
+
+    def submit(self, fn: Callable, *args, **kwargs) -> int:
+        """
+        Put job into the queue.
+        Returns position in the queue, 0 means the job has started right away.
+        """
+        with self.lock:
+            if self.pending >= self.workers + self.queue_size:
+                raise model.QueueFullException(f"Pool {self.name} is full")
+            position = max(0, self.pending - self.workers + 1)
+            self.pending += 1
+            metrics.QUEUE_DEPTH.set(self.pending, pool=self.name)
+        self.jobs.put((fn, args, kwargs))
+        return position
+
+    def _work(self):
+        while True:
+            fn, args, kwargs = self.jobs.get()
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                logger.exception(f">>> Job failed in pool {self.name}: {e}")
+            finally:
+                with self.lock:
+                    self.pending -= 1
+                    metrics.QUEUE_DEPTH.set(self.pending, pool=self.name)
+
+
+class AsyncWorkerPool:
+    """
+    Same as WorkerPool but for coroutines running in the event loop.
+    """
+
+    def __init__(self, name: str, workers: int, queue_size: int):
+        self.name = name
+        self.workers = workers
+        self.queue_size = queue_size
+        self.pending = 0
+        self.semaphore = asyncio.Semaphore(workers)
+        self.tasks: set[asyncio.Task] = set()
+
+    def submit(self, fn: Callable[..., Coroutine], *args, **kwargs) -> int:
+        if self.pending >= self.workers + self.queue_size:
+            raise model.QueueFullException(f"Pool {self.name} is full")
+        position = max(0, self.pending - self.workers + 1)
+        self.pending += 1
+        metrics.QUEUE_DEPTH.set(self.pending, pool=self.name)
+        task = asyncio.create_task(self._run(fn, *args, **kwargs))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return position
+
+    async def _run(self, fn: Callable[..., Coroutine], *args, **kwargs):
+        try:
+            async with self.semaphore:
+                await fn(*args, **kwargs)
+        except Exception as e:
+            logger.exception(f">>> Job failed in pool {self.name}: {e}")
+        finally:
+            self.pending -= 1
+            metrics.QUEUE_DEPTH.set(self.pending, pool=self.name)
+
+
+class Scheduler:
+    """
+    Routes jobs to worker pools.
+    A pool is picked by network command first, then by network type,
+    so image bursts can't starve text requests.
+    Jobs submitted with a key, e.g. "chat_id:user_id", form a lane:
+    they run one after another in the order they came, while jobs
+    with different keys run in parallel.
+    """
+
+    __instance = None
+    pools: dict[str, WorkerPool]
+    async_pools: dict[str, AsyncWorkerPool]
+    # Jobs waiting for the running job of the same key, by pool name and key
+    lanes: dict[tuple[str, Hashable], deque]
+    async_lanes: dict[tuple[str, Hashable], deque]
+
+    def __init__(self):
+        if Scheduler.__instance is not None:
+            raise Exception("This class is a singleton!")
+        self.pools = {}
+        self.async_pools = {}
+        self.lanes = {}
+        self.async_lanes = {}
+        self.lock = threading.Lock()
+        Scheduler.__instance = self
+
+    @staticmethod
+    def get_instance():
+        if Scheduler.__instance is None:
+            return Scheduler()
+        return Scheduler.__instance
+
+    def submit(
+        self,
+        cfg: model.Network,
+        fn: Callable,
+        *args,
+        key: Optional[Hashable] = None,
+        **kwargs,
+    ) -> int:
+        """
+        Returns position in the pool queue, or in the lane
+        if a job with the same key is already running.
+        """
+        name, pool_settings = get_pool_settings(cfg)
+        with self.lock:
+            if name not in self.pools:
+                self.pools[name] = WorkerPool(
+                    name, pool_settings.workers, pool_settings.queue_size
+                )
+            pool = self.pools[name]
+        if key is None:
+            return pool.submit(fn, *args, **kwargs)
+        lane_key = (name, key)
+        with self.lock:
+            lane = self.lanes.get(lane_key)
+            if lane is not None:
+                return self._enqueue(lane, name, key, fn, args, kwargs)
+            position = pool.submit(self._run_lane, lane_key, fn, args, kwargs)
+            self.lanes[lane_key] = deque()
+            metrics.LANES_ACTIVE.inc(pool=name)
+        return position
+
+    def submit_async(
+        self,
+        cfg: model.Network,
+        fn: Callable[..., Coroutine],
+        *args,
+        key: Optional[Hashable] = None,
+        **kwargs,
+    ) -> int:
+        name, pool_settings = get_pool_settings(cfg)
+        if name not in self.async_pools:
+            self.async_pools[name] = AsyncWorkerPool(
+                name, pool_settings.workers, pool_settings.queue_size
+            )
+        pool = self.async_pools[name]
+        if key is None:
+            return pool.submit(fn, *args, **kwargs)
+        lane_key = (name, key)
+        lane = self.async_lanes.get(lane_key)
+        if lane is not None:
+            return self._enqueue(lane, name, key, fn, args, kwargs)
+        position = pool.submit(self._run_lane_async, lane_key, fn, args, kwargs)
+        self.async_lanes[lane_key] = deque()
+        metrics.LANES_ACTIVE.inc(pool=name)
+        return position
+
+    def _enqueue(
+        self, lane: deque, name: str, key: Hashable, fn: Callable, args, kwargs
+    ) -> int:
+        if len(lane) >= settings.scheduler.lane_size:
+            raise model.QueueFullException(f"Lane {key} in pool {name} is full")
+        lane.append((fn, args, kwargs))
+        metrics.LANE_WAITING.inc(pool=name)
+        return len(lane)
+
+    def _run_lane(self, lane_key: tuple[str, Hashable], fn: Callable, args, kwargs):
+        """
+        Run jobs of the lane until it's empty, the lane keeps its worker.
+        """
+        name, _ = lane_key
+        while True:
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                logger.exception(f">>> Job failed in pool {name}: {e}")
+            with self.lock:
+                lane = self.lanes[lane_key]
+                if not lane:
+                    del self.lanes[lane_key]
+                    metrics.LANES_ACTIVE.dec(pool=name)
+                    return
+                fn, args, kwargs = lane.popleft()
+                metrics.LANE_WAITING.dec(pool=name)
+
+    async def _run_lane_async(
+        self, lane_key: tuple[str, Hashable], fn: Callable[..., Coroutine], args, kwargs
+    ):
+        name, _ = lane_key
+        while True:
+            try:
+                await fn(*args, **kwargs)
+            except Exception as e:
+                logger.exception(f">>> Job failed in pool {name}: {e}")
+            lane = self.async_lanes[lane_key]
+            if not lane:
+                del self.async_lanes[lane_key]
+                metrics.LANES_ACTIVE.dec(pool=name)
+                return
+            fn, args, kwargs = lane.popleft()
+            metrics.LANE_WAITING.dec(pool=name)
+
+
+def get_pool_settings(cfg: model.Network) -> tuple[str, model.PoolSettings]:
+    """
+    Find pool for the network, example:
+    >>> get_pool_settings(Network(command="m", type="image", ...))
+    ("image", PoolSettings(workers=2, queue_size=8))
+    """
+    pools = {**DEFAULT_POOLS, **settings.scheduler.pools}
+    for name in (cfg.command, cfg.type):
+        if name in pools:
+            return name, pools[name]
+    return DEFAULT_POOL, pools[DEFAULT_POOL]
@@ -0,0 +1,333 @@
+import time
+import heapq
+import asyncio
+import threading
+import itertools
+import concurrent.futures
+from abc import ABC
+from abc import abstractmethod
+from typing import Any
+from typing import Callable
+from typing import Hashable
+from typing import Optional
+from typing import TYPE_CHECKING
+from collections import deque
+
+import telebot
+
+from . import model
+from . import cache
+from . import config
+from . import metrics
+from .ratelimit import TokenBucket
+
+if TYPE_CHECKING:
+    from telebot.async_telebot import AsyncTeleBot
+
+logger = config.logger
+settings = config.get_settings()
+
+# Buckets of idle chats are forgotten, a new bucket starts full
+BUCKETS_MAXSIZE = 100_000
+BUCKETS_TTL = 3600
+
+
+class Send:
+    """
+    Call to Telegram API waiting in the queue of a chat.
+    """
+
+    __slots__ = ("key", "fn", "args", "kwargs", "future", "attempts")
+
+    def __init__(self, key: Optional[Hashable], fn: Callable, args, kwargs, future):
+        self.key = key
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.attempts = 0
+
+
+class Outbox(ABC):
+    """
+    Queues of outgoing messages, one per chat, sent in order.
+    A chat is sent to only when both its bucket and the global bucket
+    have a token, retry_after of Telegram flood errors pauses the chat.
+    Handlers get a future and don't wait for the message to be sent.
+    Pending edits of the same message are merged, only the last text is sent.
+    """
+
+    bot: Any  # TeleBot or AsyncTeleBot making the calls
+
+    def __init__(self, sender: model.SenderSettings):
+        self.settings = sender
+        self.queues: dict[int, deque[Send]] = {}
+        # (ready_at, seq, chat_id) of chats with queued messages and nothing in flight
+        self.ready: list[tuple[float, int, int]] = []
+        self.seq = itertools.count()
+        self.buckets = cache.TTLCache(BUCKETS_MAXSIZE, BUCKETS_TTL)
+        self.bucket = TokenBucket(sender.total, time.monotonic())
+        self.pending = 0
+
+    @abstractmethod
+    def submit(
+        self, chat_id: int, key: Optional[Hashable], fn: Callable, /, *args, **kwargs
+    ) -> Any:
+        """
+        Queue the call of fn to the chat, return a future of its result.
+        """
+
+    def reply_to(self, m: telebot.types.Message, text: str, **kwargs):
+        return self.submit(m.chat.id, None, self.bot.reply_to, m, text, **kwargs)
+
+    def send_message(self, chat_id: int, text: str, **kwargs):
+        return self.submit(
+            chat_id, None, self.bot.send_message, chat_id, text, **kwargs
+        )
+
+    def send_photo(self, chat_id: int, photo: Any, **kwargs):
+        return self.submit(chat_id, None, self.bot.send_photo, chat_id, photo, **kwargs)
+
+    def edit_message_text(self, text: str, chat_id: int, message_id: int, **kwargs):
+        return self.submit(
+            chat_id,
+            ("edit", message_id),
+            self.bot.edit_message_text,
+            text,
+            chat_id=chat_id,
+            message_id=message_id,
+            **kwargs,
+        )
+
+    def _put(self, chat_id: int, send: Send) -> Send:
+        """
+        Queue the call, return the call it was merged into if any.
+        """
+        queue = self.queues.get(chat_id)
+        if queue is None:
+            queue = self.queues[chat_id] = deque()
+            heapq.heappush(self.ready, (time.monotonic(), next(self.seq), chat_id))
+        if send.key is not None:
+            for queued in queue:
+                if queued.key == send.key:
+                    queued.fn = send.fn
+                    queued.args = send.args
+                    queued.kwargs = send.kwargs
+                    return queued
+        if len(queue) >= self.settings.queue_size:
+            raise model.QueueFullException(f"Outbox of chat {chat_id} is full")
+        queue.append(send)
+        self.pending += 1
+        metrics.OUTBOX_PENDING.set(self.pending)
+        return send
+
+    def _take(
+        self, now: float
+    ) -> tuple[Optional[tuple[int, Send]], Optional[float]]:
+        """
+        Find the next call to make, return chat id with the call
+        or how many seconds to wait for it.
+        """
+        while self.ready:
+            ready_at, _, chat_id = self.ready[0]
+            if ready_at > now:
+                return None, ready_at - now
+            self.bucket.refill(now)
+            wait = self.bucket.wait_time()
+            if wait:
+                return None, wait
+            bucket = self._get_bucket(chat_id, now)
+            wait = bucket.wait_time()
+            if wait:
+                heapq.heapreplace(self.ready, (now + wait, next(self.seq), chat_id))
+                continue
+            heapq.heappop(self.ready)
+            bucket.tokens -= 1
+            self.bucket.tokens -= 1
+            self.pending -= 1
+            metrics.OUTBOX_PENDING.set(self.pending)
+            return (chat_id, self.queues[chat_id].popleft()), None
+        return None, None
+
+    def _done(self, chat_id: int, retry: Optional[Send] = None, delay: float = 0):
+        """
+        Let the next call of the chat go, the failed one goes first after delay.
+        """
+        queue = self.queues[chat_id]
+        if retry is not None:
+            queue.appendleft(retry)
+            self.pending += 1
+            metrics.OUTBOX_PENDING.set(self.pending)
+        if not queue:
+            del self.queues[chat_id]
+            return
+        ready_at = time.monotonic() + delay
+        heapq.heappush(self.ready, (ready_at, next(self.seq), chat_id))
+
+    def _get_bucket(self, chat_id: int, now: float) -> TokenBucket:
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            # Private chats have positive ids, groups and channels negative
+            limit = self.settings.private if chat_id > 0 else self.settings.group
+            bucket = TokenBucket(limit, now)
+        bucket.refill(now)
+        self.buckets.set(chat_id, bucket)
+        return bucket
+
+    def _get_retry_delay(self, send: Send, e: Exception) -> Optional[float]:
+        """
+        Seconds to wait before sending again if Telegram asked for it.
+        """
+        if getattr(e, "error_code", None) != 429:
+            return None
+        if send.attempts >= self.settings.max_retries:
+            return None
+        send.attempts += 1
+        metrics.FLOOD_WAITS.inc()
+        parameters = (getattr(e, "result_json", None) or {}).get("parameters") or {}
+        return float(parameters.get("retry_after", 1))
+
+
+class Sender(Outbox):
+    """
+    Outbox sending messages from a few background threads, example:
+    >>> outbox = Sender(bot)
+    >>> outbox.reply_to(m, "Hello")  # returns right away
+    >>> msg = outbox.reply_to(m, "Generating text...").result()  # waits for the message
+    """
+
+    def __init__(
+        self, bot: telebot.TeleBot, sender: Optional[model.SenderSettings] = None
+    ):
+        super().__init__(sender or settings.sender)
+        self.bot = bot
+        self.condition = threading.Condition()
+        if not self.settings.enabled:
+            return
+        for i in range(self.settings.workers):
+            threading.Thread(target=self._work, name=f"sender-{i}", daemon=True).start()
+
+    def submit(
+        self, chat_id: int, key: Optional[Hashable], fn: Callable, /, *args, **kwargs
+    ) -> concurrent.futures.Future:
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        if not self.settings.enabled:
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        with self.condition:
+            try:
+                send = self._put(chat_id, Send(key, fn, args, kwargs, future))
+            except model.QueueFullException as e:
+                logger.warning(f">>> {e}, message dropped")
+                future.set_exception(e)
+                return future
+            self.condition.notify()
+        return send.future
+
+    def _work(self):
+        while True:
+            with self.condition:
+                item, wait = self._take(time.monotonic())
+                while item is None:
+                    self.condition.wait(wait)
+                    item, wait = self._take(time.monotonic())
+            chat_id, send = item
+            delay = None
+            try:
+                result = send.fn(*send.args, **send.kwargs)
+            except Exception as e:
+                delay = self._get_retry_delay(send, e)
+                if delay is None:
+                    logger.warning(f">>> Couldn't send message to {chat_id}: {e}")
+                    send.future.set_exception(e)
+            else:
+                send.future.set_result(result)
+            with self.condition:
+                if delay is None:
+                    self._done(chat_id)
+                else:
+                    self._done(chat_id, send, delay)
+                self.condition.notify()
+
+
+class AsyncSender(Outbox):
+    """
+    Same as Sender but for the async runtime, futures are awaited:
+    >>> msg = await outbox.reply_to(m, "Generating text...")
+    Workers are started with the first message, when the loop is running.
+    """
+
+    def __init__(
+        self, bot: "AsyncTeleBot", sender: Optional[model.SenderSettings] = None
+    ):
+        super().__init__(sender or settings.sender)
+        self.bot = bot
+        # Bound to the running loop on first use
+        self.condition = asyncio.Condition()
+        self.workers: list[asyncio.Task] = []
+
+    def submit(
+        self, chat_id: int, key: Optional[Hashable], fn: Callable, /, *args, **kwargs
+    ) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        if not self.settings.enabled:
+            future = asyncio.ensure_future(fn(*args, **kwargs))
+            future.add_done_callback(_retrieve_exception)
+            return future
+        if not self.workers:
+            self.workers = [
+                loop.create_task(self._work()) for _ in range(self.settings.workers)
+            ]
+        future = loop.create_future()
+        try:
+            send = self._put(chat_id, Send(key, fn, args, kwargs, future))
+        except model.QueueFullException as e:
+            logger.warning(f">>> {e}, message dropped")
+            future.set_exception(e)
+            future.exception()
+            return future
+        loop.create_task(self._notify())
+        return send.future
+
+    async def _notify(self):
+        async with self.condition:
+            self.condition.notify()
+
+    async def _work(self):
+        while True:
+            async with self.condition:
+                item, wait = self._take(time.monotonic())
+                while item is None:
+                    try:
+                        await asyncio.wait_for(self.condition.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+                    item, wait = self._take(time.monotonic())
+            chat_id, send = item
+            delay = None
+            try:
+                result = await send.fn(*send.args, **send.kwargs)
+            except Exception as e:
+                delay = self._get_retry_delay(send, e)
+                if delay is None:
+                    logger.warning(f">>> Couldn't send message to {chat_id}: {e}")
+                    send.future.set_exception(e)
+                    # Mark exception as retrieved in case nobody is waiting
+                    send.future.exception()
+            else:
+                send.future.set_result(result)
+            async with self.condition:
+                if delay is None:
+                    self._done(chat_id)
+                else:
+                    self._done(chat_id, send, delay)
+                self.condition.notify()
+
+
+def _retrieve_exception(future: asyncio.Future):
+    # Mark exception as retrieved in case nobody is waiting
+    if not future.cancelled():
+        future.exception()
@@ -0,0 +1,108 @@
+import asyncio
+import functools
+import threading
+from typing import Any
+from typing import Callable
+from typing import Hashable
+from typing import Optional
+from typing import Coroutine
+
+from . import metrics
+
+
+class Call:
+    """
+    Call in flight, followers wait for it to finish and get the same result.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    Makes concurrent calls with the same key share a single execution, example:
+    >>> flights = SingleFlight("replicate")
+    >>> flights.do(("m", "a cat"), version.predict, prompt="a cat")
+    The first caller runs the function, the others block until it's finished
+    and get its result or its exception. Nothing is kept after the call is done.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = threading.Lock()
+        self.calls: dict[Hashable, Call] = {}
+
+    def do(self, key: Hashable, fn: Callable, *args, **kwargs) -> Any:
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+        if not leader:
+            metrics.COALESCED.inc(integration=self.name)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+
+class AsyncCall:
+    """
+    Task of a call in flight and how many callers wait for it.
+    """
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class AsyncSingleFlight:
+    """
+    Same as SingleFlight but for coroutines running in the event loop.
+    The function runs in its own task, so a cancelled caller, the first one
+    included, doesn't cancel it for the others. It's cancelled only when
+    every caller is gone.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls: dict[Hashable, AsyncCall] = {}
+
+    async def do(
+        self, key: Hashable, fn: Callable[..., Coroutine], *args, **kwargs
+    ) -> Any:
+        call = self.calls.get(key)
+        if call is None:
+            call = self.calls[key] = AsyncCall(asyncio.create_task(fn(*args, **kwargs)))
+            call.task.add_done_callback(functools.partial(self._done, key, call))
+        else:
+            metrics.COALESCED.inc(integration=self.name)
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            if call.waiters == 1:
+                call.task.cancel()
+            raise
+        finally:
+            call.waiters -= 1
+
+    def _done(self, key: Hashable, call: AsyncCall, task: asyncio.Task):
+        if self.calls.get(key) is call:
+            del self.calls[key]
+        # Mark exception as retrieved in case nobody else was waiting
+        if not task.cancelled():
+            task.exception()
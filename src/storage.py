@@ -0,0 +1,574 @@
+import os
+import sys
+import json
+import heapq
+import sqlite3
+import pathlib
+import threading
+from typing import Union
+from typing import TYPE_CHECKING
+
+from . import model
+from . import config
+
+if TYPE_CHECKING:
+    import redis  # type: ignore[import]
+
+logger = config.logger
+
+CHATS = "chats"
+COMPLETIONS = "completions"
+
+Entry = Union[model.ChatHistoryEntry, model.CompletionHistoryEntry]
+
+
+class DialogsBackend:
+    """
+    Interface of storage used by DialogsStore.
+    Entries are grouped by kind ("chats" or "completions") and unique id.
+    """
+
+    def append(self, kind: str, key: str, entry: Entry):
+        raise NotImplementedError
+
+    def get(self, kind: str, key: str) -> list[Entry]:
+        raise NotImplementedError
+
+    def clear(self, kind: str, key: str):
+        raise NotImplementedError
+
+    def delete_older_than(self, kind: str, key: str, timestamp: float):
+        raise NotImplementedError
+
+    def keep_latest(self, kind: str, key: str, count: int):
+        raise NotImplementedError
+
+    def evict_idle(self, timestamp: float) -> int:
+        """
+        Remove dialogs without entries newer than timestamp,
+        return amount of removed dialogs.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MemoryDialogsBackend(DialogsBackend):
+    """
+    Keeps dialogs in process memory, data is lost on restart.
+    Every dialog is a list capped at limit entries, trimmed in place on append.
+    Dialogs are indexed in a heap by the time they were last known to be active,
+    so idle ones can be found without scanning all of them.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.data: dict[str, dict[str, list[Entry]]] = {CHATS: {}, COMPLETIONS: {}}
+        self.lock = threading.Lock()
+        # One (timestamp, kind, key) item per dialog, timestamp is updated lazily
+        self.activity: list[tuple[float, str, str]] = []
+        self.tracked: set[tuple[str, str]] = set()  # dialogs having an item
+
+    def append(self, kind: str, key: str, entry: Entry):
+        with self.lock:
+            entries = self.data[kind].get(key)
+            if entries is None:
+                entries = self.data[kind][key] = []
+            if (kind, key) not in self.tracked:
+                # A cleared dialog may still have its item
+                heapq.heappush(self.activity, (entry.timestamp, kind, key))
+                self.tracked.add((kind, key))
+            entries.append(entry)
+            if len(entries) > self.limit:
+                del entries[0]
+
+    def get(self, kind: str, key: str) -> list[Entry]:
+        with self.lock:
+            return list(self.data[kind].get(key, ()))
+
+    def clear(self, kind: str, key: str):
+        with self.lock:
+            self.data[kind].pop(key, None)
+
+    def delete_older_than(self, kind: str, key: str, timestamp: float):
+        with self.lock:
+            entries = self.data[kind].get(key)
+            if not entries:
+                return
+            # Entries are ordered by time, only expired ones at the start are touched
+            expired = 0
+            for entry in entries:
+                if entry.timestamp > timestamp:
+                    break
+                expired += 1
+            del entries[:expired]
+
+    def keep_latest(self, kind: str, key: str, count: int):
+        with self.lock:
+            entries = self.data[kind].get(key)
+            if entries and len(entries) > count:
+                del entries[: len(entries) - count]
+
+    def evict_idle(self, timestamp: float) -> int:
+        evicted = 0
+        with self.lock:
+            while self.activity and self.activity[0][0] <= timestamp:
+                _, kind, key = heapq.heappop(self.activity)
+                entries = self.data[kind].get(key)
+                if entries is None:
+                    self.tracked.discard((kind, key))
+                    continue  # dialog was cleared
+                if entries and entries[-1].timestamp > timestamp:
+                    # Dialog got newer entries, check it again when they expire
+                    heapq.heappush(self.activity, (entries[-1].timestamp, kind, key))
+                    continue
+                del self.data[kind][key]
+                self.tracked.discard((kind, key))
+                evicted += 1
+        return evicted
+
+
+class SQLiteDialogsBackend(DialogsBackend):
+    """
+    Keeps dialogs in SQLite database, so they survive restarts.
+    Appends are buffered and written in batches, buffer is flushed
+    when it's full, periodically and before every read.
+    """
+
+    def __init__(self, path: str, batch_size: int = 50, flush_interval: float = 1.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.lock = threading.RLock()
+        self.pending: list[tuple[str, str, Entry]] = []
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS {CHATS} (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    unique_id TEXT NOT NULL,
+                    timestamp INTEGER NOT NULL,
+                    message TEXT NOT NULL,
+                    message_role TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    tokens INTEGER
+                )
+                """
+            )
+            self.conn.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS {COMPLETIONS} (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    unique_id TEXT NOT NULL,
+                    timestamp INTEGER NOT NULL,
+                    message TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    tokens INTEGER
+                )
+                """
+            )
+            for table in (CHATS, COMPLETIONS):
+                columns = self.conn.execute(f"PRAGMA table_info({table})").fetchall()
+                if "tokens" not in [c[1] for c in columns]:
+                    # Databases created before token counts were stored
+                    self.conn.execute(f"ALTER TABLE {table} ADD COLUMN tokens INTEGER")
+                self.conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS {table}_unique_id_timestamp "
+                    f"ON {table} (unique_id, timestamp)"
+                )
+                self.conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS {table}_timestamp "
+                    f"ON {table} (timestamp)"
+                )
+        self.stopped = threading.Event()
+        self.flusher = threading.Thread(
+            target=self._flush_periodically, name="sqlite-flusher", daemon=True
+        )
+        self.flusher.start()
+
+    def append(self, kind: str, key: str, entry: Entry):
+        with self.lock:
+            self.pending.append((kind, key, entry))
+            if len(self.pending) >= self.batch_size:
+                self.flush()
+
+    def get(self, kind: str, key: str) -> list[Entry]:
+        with self.lock:
+            self.flush()
+            if kind == CHATS:
+                rows = self.conn.execute(
+                    "SELECT timestamp, message, message_role, response, tokens "
+                    f"FROM {CHATS} WHERE unique_id = ? ORDER BY timestamp, id",
+                    (key,),
+                ).fetchall()
+                return [
+                    model.ChatHistoryEntry(
+                        timestamp=t,
+                        message=m,
+                        message_role=sys.intern(role),
+                        response=r,
+                        tokens=n,
+                    )
+                    for t, m, role, r, n in rows
+                ]
+            rows = self.conn.execute(
+                f"SELECT timestamp, message, response, tokens FROM {COMPLETIONS} "
+                "WHERE unique_id = ? ORDER BY timestamp, id",
+                (key,),
+            ).fetchall()
+            return [
+                model.CompletionHistoryEntry(
+                    timestamp=t, message=m, response=r, tokens=n
+                )
+                for t, m, r, n in rows
+            ]
+
+    def clear(self, kind: str, key: str):
+        with self.lock, self.conn:
+            self.flush()
+            self.conn.execute(f"DELETE FROM {_table(kind)} WHERE unique_id = ?", (key,))
+
+    def delete_older_than(self, kind: str, key: str, timestamp: float):
+        with self.lock, self.conn:
+            self.flush()
+            self.conn.execute(
+                f"DELETE FROM {_table(kind)} WHERE unique_id = ? AND timestamp <= ?",
+                (key, timestamp),
+            )
+
+    def keep_latest(self, kind: str, key: str, count: int):
+        table = _table(kind)
+        with self.lock, self.conn:
+            self.flush()
+            self.conn.execute(
+                f"""
+                DELETE FROM {table} WHERE unique_id = ? AND id NOT IN (
+                    SELECT id FROM {table} WHERE unique_id = ?
+                    ORDER BY timestamp DESC, id DESC LIMIT ?
+                )
+                """,
+                (key, key, count),
+            )
+
+    def evict_idle(self, timestamp: float) -> int:
+        evicted = 0
+        with self.lock, self.conn:
+            self.flush()
+            for table in (CHATS, COMPLETIONS):
+                (idle,) = self.conn.execute(
+                    f"""
+                    SELECT COUNT(*) FROM (
+                        SELECT unique_id FROM {table} GROUP BY unique_id
+                        HAVING MAX(timestamp) <= ?
+                    )
+                    """,
+                    (timestamp,),
+                ).fetchone()
+                self.conn.execute(
+                    f"DELETE FROM {table} WHERE timestamp <= ?", (timestamp,)
+                )
+                evicted += idle
+        return evicted
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            chats = []
+            completions = []
+            for _, key, entry in self.pending:
+                if isinstance(entry, model.ChatHistoryEntry):
+                    chats.append(
+                        (
+                            key,
+                            entry.timestamp,
+                            entry.message,
+                            entry.message_role,
+                            entry.response,
+                            entry.tokens,
+                        )
+                    )
+                else:
+                    completions.append(
+                        (
+                            key,
+                            entry.timestamp,
+                            entry.message,
+                            entry.response,
+                            entry.tokens,
+                        )
+                    )
+            with self.conn:
+                self.conn.executemany(
+                    f"INSERT INTO {CHATS} "
+                    "(unique_id, timestamp, message, message_role, response, tokens) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    chats,
+                )
+                self.conn.executemany(
+                    f"INSERT INTO {COMPLETIONS} "
+                    "(unique_id, timestamp, message, response, tokens) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    completions,
+                )
+            self.pending = []
+
+    def close(self):
+        self.stopped.set()
+        self.flush()
+        self.conn.close()
+
+    def _flush_periodically(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception(f">>> Couldn't write dialogs to SQLite: {e}")
+
+
+class RedisDialogsBackend(DialogsBackend):
+    """
+    Keeps dialogs in Redis, so they are shared by all bot processes.
+    Every dialog is a list of JSON entries, capped at limit entries
+    and expiring after ttl seconds without new entries.
+    """
+
+    def __init__(self, url: str, limit: int, ttl: int):
+        self.client = _get_redis_client(url)
+        self.limit = limit
+        self.ttl = ttl
+
+    def append(self, kind: str, key: str, entry: Entry):
+        name = _redis_key(kind, key)
+        pipeline = self.client.pipeline()
+        pipeline.rpush(name, _dump_entry(entry))
+        pipeline.ltrim(name, -self.limit, -1)
+        if self.ttl:
+            pipeline.expire(name, self.ttl)
+        pipeline.execute()
+
+    def get(self, kind: str, key: str) -> list[Entry]:
+        values = self.client.lrange(_redis_key(kind, key), 0, -1)
+        return [_load_entry(kind, value) for value in values]
+
+    def clear(self, kind: str, key: str):
+        self.client.delete(_redis_key(kind, key))
+
+    def delete_older_than(self, kind: str, key: str, timestamp: float):
+        expired = 0
+        for entry in self.get(kind, key):
+            if entry.timestamp > timestamp:
+                break
+            expired += 1
+        if expired:
+            self.client.ltrim(_redis_key(kind, key), expired, -1)
+
+    def keep_latest(self, kind: str, key: str, count: int):
+        if count == 0:
+            self.clear(kind, key)
+            return
+        self.client.ltrim(_redis_key(kind, key), -count, -1)
+
+    def evict_idle(self, timestamp: float) -> int:
+        return 0  # idle dialogs are expired by Redis
+
+    def close(self):
+        self.client.close()
+
+
+class WhitelistBackend:
+    """
+    Interface of storage used by WhitelistStore.
+    Version changes whenever entries are changed by any process,
+    so the store knows when to reload them.
+    """
+
+    def load(self) -> set[str]:
+        raise NotImplementedError
+
+    def add(self, entry: str):
+        raise NotImplementedError
+
+    def remove(self, entry: str):
+        raise NotImplementedError
+
+    def get_version(self):
+        raise NotImplementedError
+
+
+class FileWhitelistBackend(WhitelistBackend):
+    """
+    Keeps entries in a text file, one per line.
+    Can be shared by processes running on the same host.
+    """
+
+    def __init__(self, path: str):
+        self.path = pathlib.Path(path)
+        self.lock = threading.Lock()
+        if not self.path.exists():
+            self.path.touch()
+
+    def load(self) -> set[str]:
+        with self.lock, open(self.path) as f:
+            return {line.strip() for line in f if line.strip()}
+
+    def add(self, entry: str):
+        with self.lock, open(self.path, "a") as f:
+            f.write(f"{entry}\n")
+
+    def remove(self, entry: str):
+        with self.lock:
+            with open(self.path) as f:
+                entries = [line.strip() for line in f if line.strip()]
+            with open(self.path, "w") as f:
+                f.writelines(f"{e}\n" for e in entries if e != entry)
+
+    def get_version(self) -> int:
+        return os.stat(self.path).st_mtime_ns
+
+
+class SQLiteWhitelistBackend(WhitelistBackend):
+    """
+    Keeps entries in SQLite database, can be shared by processes
+    running on the same host.
+    """
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS whitelist (entry TEXT PRIMARY KEY)"
+            )
+
+    def load(self) -> set[str]:
+        with self.lock:
+            rows = self.conn.execute("SELECT entry FROM whitelist").fetchall()
+        return {entry for (entry,) in rows}
+
+    def add(self, entry: str):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO whitelist (entry) VALUES (?)", (entry,)
+            )
+
+    def remove(self, entry: str):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM whitelist WHERE entry = ?", (entry,))
+
+    def get_version(self) -> int:
+        # Changes when the database is modified by another connection,
+        # own changes are applied by the store directly
+        with self.lock:
+            (version,) = self.conn.execute("PRAGMA data_version").fetchone()
+        return version
+
+
+class RedisWhitelistBackend(WhitelistBackend):
+    """
+    Keeps entries in a Redis set shared by all bot processes.
+    """
+
+    key = "tg-ai:whitelist"
+    version_key = "tg-ai:whitelist:version"
+
+    def __init__(self, url: str):
+        self.client = _get_redis_client(url)
+
+    def load(self) -> set[str]:
+        return set(self.client.smembers(self.key))
+
+    def add(self, entry: str):
+        pipeline = self.client.pipeline()
+        pipeline.sadd(self.key, entry)
+        pipeline.incr(self.version_key)
+        pipeline.execute()
+
+    def remove(self, entry: str):
+        pipeline = self.client.pipeline()
+        pipeline.srem(self.key, entry)
+        pipeline.incr(self.version_key)
+        pipeline.execute()
+
+    def get_version(self) -> int:
+        return int(self.client.get(self.version_key) or 0)
+
+
+def create_dialogs_backend(
+    storage: model.StorageSettings, limit: int, ttl: int = 0
+) -> DialogsBackend:
+    if storage.backend == "sqlite":
+        return SQLiteDialogsBackend(
+            storage.path, storage.batch_size, storage.flush_interval
+        )
+    if storage.backend == "redis":
+        return RedisDialogsBackend(storage.redis_url, limit, ttl)
+    if storage.backend == "memory":
+        return MemoryDialogsBackend(limit)
+    raise model.ConfigException(f"Unknown storage backend: {storage.backend}")
+
+
+def create_whitelist_backend(storage: model.StorageSettings) -> WhitelistBackend:
+    if storage.whitelist == "file":
+        return FileWhitelistBackend(storage.whitelist_path)
+    if storage.whitelist == "sqlite":
+        return SQLiteWhitelistBackend(storage.path)
+    if storage.whitelist == "redis":
+        return RedisWhitelistBackend(storage.redis_url)
+    raise model.ConfigException(f"Unknown whitelist backend: {storage.whitelist}")
+
+
+def _table(kind: str) -> str:
+    if kind not in (CHATS, COMPLETIONS):
+        raise ValueError(f"Unknown kind of dialogs: {kind}")
+    return kind
+
+
+def _get_redis_client(url: str) -> "redis.Redis":
+    try:
+        import redis  # type: ignore[import]
+    except ImportError:
+        raise model.ConfigException("Redis backend requires redis package")
+    return redis.Redis.from_url(url, decode_responses=True)
+
+
+def _redis_key(kind: str, key: str) -> str:
+    return f"tg-ai:{_table(kind)}:{key}"
+
+
+def _dump_entry(entry: Entry) -> str:
+    """
+    Example:
+    >>> _dump_entry(ChatHistoryEntry(1, "Hi", "user", "Hello", tokens=3))
+    '[1, "Hi", "Hello", "user", 3]'
+    """
+    values: list = [entry.timestamp, entry.message, entry.response]
+    if isinstance(entry, model.ChatHistoryEntry):
+        values.append(entry.message_role)
+    values.append(entry.tokens)
+    return json.dumps(values, ensure_ascii=False)
+
+
+def _load_entry(kind: str, value: str) -> Entry:
+    values = json.loads(value)
+    if kind == CHATS:
+        # Entries written before token counts were stored don't have them
+        timestamp, message, response, role, *count = values
+        return model.ChatHistoryEntry(
+            timestamp=timestamp,
+            message=message,
+            message_role=sys.intern(role),
+            response=response,
+            tokens=count[0] if count else None,
+        )
+    timestamp, message, response, *count = values
+    return model.CompletionHistoryEntry(
+        timestamp=timestamp,
+        message=message,
+        response=response,
+        tokens=count[0] if count else None,
+    )
@@ -1,29 +1,43 @@
 import time
-import pathlib
+import threading
+from typing import cast
+from typing import Callable
+from typing import Optional
 
 from . import model
 from . import config
+from . import metrics
+from . import tokens
+from . import storage
 
+logger = config.logger
 settings = config.get_settings()
 
 
 class DialogsStore:
     """
-    Stores whitelisted users, dialogs and usernames.
-    Data is stored in memory.
+    Stores dialogs of users and chats.
+    Data is stored in the configured backend, memory by default.
     """
 
     __instance = None
     ttl = settings.general.text_history_ttl
     limit = settings.general.text_history_size
-    chats: dict[str, list[model.ChatHistoryEntry]]
-    completions: dict[str, list[model.CompletionHistoryEntry]]
+    sweep_interval = settings.general.text_history_sweep_interval
+    backend: storage.DialogsBackend
+    evicted: int  # total amount of dialogs removed by the sweeper
 
     def __init__(self):
         if DialogsStore.__instance is not None:
             raise Exception("This class is a singleton!")
-        self.chats = {}
-        self.completions = {}
+        self.backend = storage.create_dialogs_backend(
+            settings.storage, self.limit, self.ttl
+        )
+        self.evicted = 0
+        if self.sweep_interval > 0:
+            threading.Thread(
+                target=self._sweep_periodically, name="dialogs-sweeper", daemon=True
+            ).start()
         DialogsStore.__instance = self
 
     @staticmethod
@@ -32,64 +46,129 @@ class DialogsStore:
             return DialogsStore()
         return DialogsStore.__instance
 
-    def add_to_chats(self, chat_id: str, value: model.ChatHistoryEntry):
-        if chat_id not in self.chats:
-            self.chats[chat_id] = []
-        self.chats[chat_id].append(value)
-
-    def add_to_completions(self, chat_id: str, value: model.CompletionHistoryEntry):
-        if chat_id not in self.completions:
-            self.completions[chat_id] = []
-        self.completions[chat_id].append(value)
+    def add_to_chats(
+        self,
+        chat_id: str,
+        value: model.ChatHistoryEntry,
+        cfg: Optional[model.Network] = None,
+    ):
+        self.count_tokens(value, cfg)
+        self.backend.append(storage.CHATS, chat_id, value)
+
+    def add_to_completions(
+        self,
+        chat_id: str,
+        value: model.CompletionHistoryEntry,
+        cfg: Optional[model.Network] = None,
+    ):
+        self.count_tokens(value, cfg)
+        self.backend.append(storage.COMPLETIONS, chat_id, value)
 
     def get_from_chats(self, chat_id: str) -> list[model.ChatHistoryEntry]:
-        return self.chats.get(chat_id, [])
+        entries = self.backend.get(storage.CHATS, chat_id)
+        return cast(list[model.ChatHistoryEntry], entries)
 
     def get_from_completions(self, chat_id: str) -> list[model.CompletionHistoryEntry]:
-        return self.completions.get(chat_id, [])
-
-    def clean_old_completions(self, key: str):
-        if key not in self.completions:
-            return
-        filtered = []
-        for item in self.completions[key]:
-            if item.timestamp > (time.time() - self.ttl):
-                filtered.append(item)
-        self.completions[key] = filtered[-self.limit :]
-
-    def clean_old_chats(self, key: str):
-        if key not in self.chats:
-            return
-        filtered = []
-        for item in self.chats[key]:
-            if item.timestamp > (time.time() - self.ttl):
-                filtered.append(item)
-        self.chats[key] = filtered[-self.limit :]
+        entries = self.backend.get(storage.COMPLETIONS, chat_id)
+        return cast(list[model.CompletionHistoryEntry], entries)
+
+    def clean_old_completions(self, key: str, cfg: Optional[model.Network] = None):
+        self.clean(storage.COMPLETIONS, key, cfg)
+
+    def clean_old_chats(self, key: str, cfg: Optional[model.Network] = None):
+        self.clean(storage.CHATS, key, cfg)
+
+    def clean(self, kind: str, key: str, cfg: Optional[model.Network] = None):
+        self.backend.delete_older_than(kind, key, time.time() - self.ttl)
+        entries = self.backend.get(kind, key)
+        keep = self.count_to_keep(entries, cfg)
+        if keep < len(entries):
+            self.backend.keep_latest(kind, key, keep)
 
     def clear_chats(self, chat_id: str):
-        self.chats[chat_id] = []
+        self.backend.clear(storage.CHATS, chat_id)
 
     def clear_completions(self, chat_id: str):
-        self.completions[chat_id] = []
+        self.backend.clear(storage.COMPLETIONS, chat_id)
+
+    def sweep(self) -> int:
+        """
+        Remove dialogs that had no activity for longer than TTL.
+        """
+        evicted = self.backend.evict_idle(time.time() - self.ttl)
+        self.evicted += evicted
+        metrics.DIALOGS_EVICTED.inc(amount=evicted)
+        if evicted:
+            logger.info(f">>> Removed {evicted} idle dialogs")
+        return evicted
+
+    def _sweep_periodically(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.exception(f">>> Couldn't remove idle dialogs: {e}")
+
+    def count_to_keep(self, entries: list, cfg: Optional[model.Network] = None) -> int:
+        """
+        Count the latest entries that fit into the token budget of the network.
+        Not more than text_history_size entries are kept in any case.
+        """
+        if not cfg or not cfg.history_tokens:
+            return min(len(entries), self.limit)
+        budget = cfg.history_tokens
+        keep = 0
+        for entry in reversed(entries):
+            if keep == self.limit:
+                break
+            count = self.count_tokens(entry, cfg)
+            if count is None or count > budget:
+                break
+            budget -= count
+            keep += 1
+        return keep
+
+    def count_tokens(
+        self, entry: storage.Entry, cfg: Optional[model.Network] = None
+    ) -> Optional[int]:
+        """
+        Count tokens of the entry once, the count is stored with the entry,
+        so it isn't counted again after being read from SQLite or Redis.
+        Only networks with a history budget need it.
+        """
+        if entry.tokens is None and cfg and cfg.history_tokens:
+            entry.tokens = tokens.count_tokens(
+                entry.message, cfg.version
+            ) + tokens.count_tokens(entry.response, cfg.version)
+        return entry.tokens
 
 
 class WhitelistStore:
     """
     Stores whitelisted users, chats and usernames.
-    Uses local file to store the data.
+    Entries are kept in memory and in the configured backend, a local file by default.
+    Backend is checked for changes made by other processes in the background.
     """
 
     __instance = None
     entries: set[str]
-    filepath = pathlib.Path(__name__).parent / "whitelist.txt"
+    backend: storage.WhitelistBackend
+    listeners: list[Callable[[], None]]
+    reload_interval = settings.storage.whitelist_reload_interval
 
     def __init__(self):
         if WhitelistStore.__instance is not None:
             raise Exception("This class is a singleton!")
-        if not self.filepath.exists():
-            self.filepath.touch()
-        with open(self.filepath) as f:
-            self.entries = set([l.strip() for l in f.readlines()])
+        self.backend = storage.create_whitelist_backend(settings.storage)
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.version = self.backend.get_version()
+        self.entries = self.backend.load()
+        if self.reload_interval > 0:
+            threading.Thread(
+                target=self._reload_periodically, name="whitelist-reloader", daemon=True
+            ).start()
         WhitelistStore.__instance = self
 
     @staticmethod
@@ -104,9 +183,10 @@ class WhitelistStore:
         entry = entry.lower()
         if entry in self.entries:
             return f"{entry} is already whitelisted"
-        self.entries.add(entry)
-        with open(self.filepath, "a") as f:
-            f.write(f"{entry}\n")
+        with self.lock:
+            self.backend.add(entry)
+            self.entries = self.entries | {entry}
+        self._notify()
         return None
 
     def blacklist(self, entry: str | int) -> str | None:
@@ -115,9 +195,10 @@ class WhitelistStore:
         entry = entry.lower()
         if entry not in self.entries:
             return f"{entry} is not whitelisted"
-        self.entries.remove(entry)
-        with open(self.filepath, "w") as f:
-            f.write("\n".join(self.entries))
+        with self.lock:
+            self.backend.remove(entry)
+            self.entries = self.entries - {entry}
+        self._notify()
         return None
 
     def is_whitelisted(self, entry: str | int) -> bool:
@@ -125,3 +206,38 @@ class WhitelistStore:
             entry = str(entry)
         entry = entry.lower()
         return entry in self.entries
+
+    def subscribe(self, fn: Callable[[], None]):
+        """
+        Call fn whenever entries are changed by this or another process.
+        """
+        self.listeners.append(fn)
+
+    def reload(self) -> bool:
+        """
+        Load entries again if they were changed, return True if they were.
+        """
+        with self.lock:
+            version = self.backend.get_version()
+            if version == self.version:
+                return False
+            self.entries = self.backend.load()
+            self.version = version
+        logger.info(">>> Whitelist was changed, reloaded")
+        self._notify()
+        return True
+
+    def _notify(self):
+        for fn in self.listeners:
+            try:
+                fn()
+            except Exception as e:
+                logger.exception(f">>> Whitelist listener failed: {e}")
+
+    def _reload_periodically(self):
+        while True:
+            time.sleep(self.reload_interval)
+            try:
+                self.reload()
+            except Exception as e:
+                logger.exception(f">>> Couldn't reload whitelist: {e}")
@@ -0,0 +1,118 @@
+import time
+from typing import Iterator
+from typing import Optional
+from typing import AsyncIterator
+
+import telebot
+
+from . import config
+from . import sender
+
+logger = config.logger
+
+MESSAGE_LIMIT = 4095
+PLACEHOLDER = "..."
+
+
+class StreamingReply:
+    """
+    Sends a placeholder reply and keeps editing it while the answer is generated.
+    Edits are sent not more often than once per interval, the outbox merges
+    edits still waiting for the chat's flood limits. When the text doesn't fit
+    into a single message, the rest goes to a new reply.
+    """
+
+    def __init__(
+        self, outbox: sender.Sender, m: telebot.types.Message, interval: float
+    ):
+        self.outbox = outbox
+        self.m = m
+        self.interval = interval
+        self.text = ""  # whole answer
+        self.current = ""  # text of the last message
+        self.sent = ""  # what the last message shows now
+        self.message: Optional[telebot.types.Message] = None
+        self.last_edit = 0.0
+
+    def consume(self, chunks: Iterator[str]) -> str:
+        """
+        Stream all chunks into the chat, return the whole answer.
+        """
+        self.message = self.outbox.reply_to(self.m, PLACEHOLDER).result()
+        self.last_edit = time.monotonic()
+        for chunk in chunks:
+            self.feed(chunk)
+        self.flush()
+        return self.text
+
+    def feed(self, chunk: str):
+        self.text += chunk
+        self.current += chunk
+        while len(self.current) > MESSAGE_LIMIT:
+            self._edit(self.current[:MESSAGE_LIMIT])
+            self.current = self.current[MESSAGE_LIMIT:]
+            self.message = self.outbox.reply_to(self.m, PLACEHOLDER).result()
+            self.sent = ""
+        if time.monotonic() - self.last_edit >= self.interval:
+            self._edit(self.current)
+
+    def flush(self):
+        self._edit(self.current)
+
+    def _edit(self, text: str):
+        if not text or text == self.sent or self.message is None:
+            return
+        self.outbox.edit_message_text(
+            text, chat_id=self.m.chat.id, message_id=self.message.message_id
+        )
+        self.sent = text
+        self.last_edit = time.monotonic()
+
+
+class AsyncStreamingReply:
+    """
+    Same as StreamingReply but for the async runtime.
+    """
+
+    def __init__(
+        self, outbox: sender.AsyncSender, m: telebot.types.Message, interval: float
+    ):
+        self.outbox = outbox
+        self.m = m
+        self.interval = interval
+        self.text = ""
+        self.current = ""
+        self.sent = ""
+        self.message: Optional[telebot.types.Message] = None
+        self.last_edit = 0.0
+
+    async def consume(self, chunks: AsyncIterator[str]) -> str:
+        self.message = await self.outbox.reply_to(self.m, PLACEHOLDER)
+        self.last_edit = time.monotonic()
+        async for chunk in chunks:
+            await self.feed(chunk)
+        await self.flush()
+        return self.text
+
+    async def feed(self, chunk: str):
+        self.text += chunk
+        self.current += chunk
+        while len(self.current) > MESSAGE_LIMIT:
+            await self._edit(self.current[:MESSAGE_LIMIT])
+            self.current = self.current[MESSAGE_LIMIT:]
+            self.message = await self.outbox.reply_to(self.m, PLACEHOLDER)
+            self.sent = ""
+        if time.monotonic() - self.last_edit >= self.interval:
+            await self._edit(self.current)
+
+    async def flush(self):
+        await self._edit(self.current)
+
+    async def _edit(self, text: str):
+        if not text or text == self.sent or self.message is None:
+            return
+        self.outbox.edit_message_text(
+            text, chat_id=self.m.chat.id, message_id=self.message.message_id
+        )
+        self.sent = text
+        self.last_edit = time.monotonic()
@@ -0,0 +1,52 @@
+from typing import Optional
+from typing import TYPE_CHECKING
+from functools import lru_cache
+
+from . import config
+
+logger = config.logger
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+if TYPE_CHECKING:
+    from tiktoken import Encoding
+
+DEFAULT_ENCODING = "cl100k_base"
+# Rough amount of characters per token for English text,
+# used when the tokenizer is not available
+CHARS_PER_TOKEN = 4
+
+
+def count_tokens(text: str, version: str) -> int:
+    """
+    Count tokens in text using the tokenizer of the given model, example:
+    >>> count_tokens("hello world", "gpt-4")
+    2
+    """
+    if not text:
+        return 0
+    encoding = _get_encoding(version)
+    if encoding is None:
+        return len(text) // CHARS_PER_TOKEN + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+@lru_cache()
+def _get_encoding(version: str) -> Optional["Encoding"]:
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(version)
+    except KeyError:
+        pass
+    except Exception as e:
+        logger.warning(f">>> Couldn't load tokenizer for {version}: {e}")
+        return None
+    try:
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+    except Exception as e:
+        logger.warning(f">>> Couldn't load tokenizer {DEFAULT_ENCODING}: {e}")
+        return None
@@ -0,0 +1,207 @@
+import math
+import shutil
+import string
+import asyncio
+import functools
+import tempfile
+import subprocess
+from pathlib import Path
+from typing import Tuple
+from typing import BinaryIO
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+
+from . import model
+from . import config
+from . import metrics
+from . import integrations
+
+logger = config.logger
+settings = config.get_settings()
+
+# Chunks of all voice messages share the workers, so a long message
+# can't take more than its share of Replicate capacity
+executor = ThreadPoolExecutor(
+    max_workers=settings.transcription.workers, thread_name_prefix="transcription"
+)
+FFMPEG_TIMEOUT = 60
+# How many words at the edges of neighbouring chunks are compared
+MAX_REPEATED_WORDS = 30
+
+
+def should_split(duration: Optional[int]) -> bool:
+    """
+    Voice messages longer than a chunk are split if ffmpeg is available.
+    """
+    if not duration or duration <= settings.transcription.chunk_duration:
+        return False
+    return has_ffmpeg()
+
+
+@functools.cache
+def has_ffmpeg() -> bool:
+    """
+    Look for ffmpeg once, so its absence is logged once.
+    """
+    if shutil.which(settings.transcription.ffmpeg):
+        return True
+    logger.warning(">>> ffmpeg not found, long voice messages aren't split")
+    return False
+
+
+def get_chunk_starts(duration: float) -> list[float]:
+    """
+    Find where chunks start, neighbouring chunks overlap, example:
+    >>> get_chunk_starts(150)  # chunk_duration = 60, chunk_overlap = 2
+    [0, 58, 116]
+    """
+    chunk_duration = settings.transcription.chunk_duration
+    overlap = settings.transcription.chunk_overlap
+    step = chunk_duration - overlap
+    count = max(1, math.ceil((duration - overlap) / step))
+    return [i * step for i in range(count)]
+
+
+@metrics.track()
+def transcribe(
+    file: BinaryIO, duration: Optional[int], text: str, cfg: model.Network
+) -> Tuple[str, Optional[str]]:
+    """
+    Transcribe voice message, long ones are split into overlapping chunks
+    transcribed in parallel and stitched back in order.
+    """
+    if duration is None or not should_split(duration):
+        return integrations.replicate.get_replicate_audio_response(file, text, cfg)
+    with tempfile.TemporaryDirectory(prefix="voice-") as directory:
+        try:
+            chunks = split(file, duration, Path(directory))
+        except Exception as e:
+            return "", f"Error while splitting audio: {e}"
+        futures = [
+            executor.submit(_transcribe_chunk, path, text, cfg) for _, path in chunks
+        ]
+        results = [future.result() for future in futures]
+    return _stitch(chunks, results)
+
+
+@metrics.track()
+async def transcribe_async(
+    file: BinaryIO, duration: Optional[int], text: str, cfg: model.Network
+) -> Tuple[str, Optional[str]]:
+    """
+    Async version of transcribe.
+    """
+    if duration is None or not should_split(duration):
+        return await integrations.replicate.get_replicate_audio_response_async(
+            file, text, cfg
+        )
+    with tempfile.TemporaryDirectory(prefix="voice-") as directory:
+        try:
+            chunks = await asyncio.to_thread(split, file, duration, Path(directory))
+        except Exception as e:
+            return "", f"Error while splitting audio: {e}"
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(
+            *(
+                loop.run_in_executor(executor, _transcribe_chunk, path, text, cfg)
+                for _, path in chunks
+            )
+        )
+    return _stitch(chunks, results)
+
+
+def split(
+    file: BinaryIO, duration: float, directory: Path
+) -> list[tuple[float, Path]]:
+    """
+    Cut audio into overlapping chunks without re-encoding,
+    return start of every chunk and path to it.
+    """
+    source = directory / "source.ogg"
+    file.seek(0)
+    with source.open("wb") as f:
+        shutil.copyfileobj(file, f)
+    chunks = []
+    for i, start in enumerate(get_chunk_starts(duration)):
+        path = directory / f"chunk-{i}.ogg"
+        subprocess.run(
+            [
+                settings.transcription.ffmpeg,
+                "-v",
+                "error",
+                "-ss",
+                str(start),
+                "-t",
+                str(settings.transcription.chunk_duration),
+                "-i",
+                str(source),
+                "-c",
+                "copy",
+                str(path),
+            ],
+            check=True,
+            capture_output=True,
+            timeout=FFMPEG_TIMEOUT,
+        )
+        chunks.append((start, path))
+    return chunks
+
+
+def _transcribe_chunk(
+    path: Path, text: str, cfg: model.Network
+) -> Tuple[list[dict], Optional[str]]:
+    with path.open("rb") as file:
+        return integrations.replicate.get_replicate_audio_segments(file, text, cfg)
+
+
+def _stitch(
+    chunks: list[tuple[float, Path]], results: list[tuple[list[dict], Optional[str]]]
+) -> Tuple[str, Optional[str]]:
+    """
+    Join segments of all chunks in order. Overlapping part is cut in the middle,
+    a segment is taken from the chunk its middle falls into. A segment crossing
+    the edge of a chunk is cut there, so it's taken from both chunks and words
+    they both heard are kept once.
+    """
+    overlap = settings.transcription.chunk_overlap
+    text = ""
+    for i, ((start, _), (chunk_segments, error)) in enumerate(zip(chunks, results)):
+        if error:
+            return "", error
+        # Previous chunk ends and next chunk starts within the overlap
+        previous_end = start + overlap if i > 0 else -math.inf
+        next_start = chunks[i + 1][0] if i + 1 < len(chunks) else math.inf
+        segments = []
+        for segment in chunk_segments:
+            segment_start = start + segment.get("start", 0)
+            segment_end = start + segment.get("end", segment.get("start", 0))
+            middle = (segment_start + segment_end) / 2
+            if middle < previous_end - overlap / 2 and segment_end <= previous_end:
+                continue  # previous chunk has it whole
+            if middle >= next_start + overlap / 2 and segment_start >= next_start:
+                continue  # next chunk has it whole
+            segments.append(segment)
+        text = _merge_texts(text, integrations.replicate.join_segments(segments))
+    return text, None
+
+
+def _merge_texts(text: str, following: str) -> str:
+    """
+    Join texts of neighbouring chunks, words repeated at the end of
+    the first one and the start of the second one are kept once, example:
+    >>> _merge_texts("I went to the", "to the store.")
+    "I went to the store."
+    """
+    words = text.split()
+    following_words = following.split()
+    size = min(len(words), len(following_words), MAX_REPEATED_WORDS)
+    # A single repeated word may be said twice, only longer repeats are dropped
+    for size in range(size, 1, -1):
+        if _normalize(words[-size:]) == _normalize(following_words[:size]):
+            following_words = following_words[size:]
+            break
+    return " ".join(words + following_words)
+
+
+def _normalize(words: list[str]) -> list[str]:
+    return [word.strip(string.punctuation).lower() for word in words]
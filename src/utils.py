@@ -1,12 +1,20 @@
 import re
+import math
 import time
+import functools
 from typing import Optional
 
 import telebot
+from telebot import custom_filters
+from telebot import asyncio_filters
 
 from . import model
-from . import store
+from . import cache
 from . import config
+from . import metrics
+from . import sender
+from . import routing
+from . import ratelimit
 
 logger = config.logger
 settings = config.get_settings()
@@ -15,60 +23,118 @@ COMMAND_RE = re.compile(r"^(\/\w+)\s?")
 REMOVE_COMMAND_RE = re.compile(r"^\/\w+\s?")
 
 
-class IsAllowed(telebot.custom_filters.SimpleCustomFilter):
+# telebot declares check() of filters returning None, hence the ignores
+class IsAllowed(custom_filters.SimpleCustomFilter):
     key = "is_allowed"
 
-    @staticmethod
-    def check(m: telebot.types.Message):
-        chat_id = m.chat.id
-        user_id = m.from_user.id
-        username = m.from_user.username  # can be None
-        if settings.debug:
-            logger.debug(f">>> Message received from user {user_id}, chat {chat_id}")
-        is_allowed_config = allowed_config(m.from_user.id, m.chat.id)
-        is_allowed_whitelist = allowed_whitelist(m.from_user.id, m.chat.id, username)
-        if not is_allowed_config and not is_allowed_whitelist:
-            logger.warn(
-                f">>> Message from user {m.from_user.id}, chat {m.chat.id} was blocked"
-            )
-        return is_allowed_config or is_allowed_whitelist
+    def check(self, message: telebot.types.Message) -> bool:  # type: ignore
+        return is_allowed(message)
 
 
-class IsAdmin(telebot.custom_filters.SimpleCustomFilter):
+class IsAdmin(custom_filters.SimpleCustomFilter):
     key = "is_admin"
 
-    @staticmethod
-    def check(m: telebot.types.Message):
-        is_admin = m.from_user.id == settings.telegram.admin_id
-        if not is_admin:
-            logger.warn(
-                f">>> Non-admin user {m.from_user.id} tried to use whitelist command, blocked"
-            )
-        return is_admin
+    def check(self, message: telebot.types.Message) -> bool:  # type: ignore
+        return is_admin(message)
 
 
-def allowed_config(user_id: int, chat_id: int) -> bool:
-    allowed = (
-        user_id in settings.telegram.allowed_users
-        or chat_id in settings.telegram.allowed_chats
-        or user_id == settings.telegram.admin_id
-    )
-    if allowed:
-        return True
-    return False
+class AsyncIsAllowed(asyncio_filters.SimpleCustomFilter):
+    key = "is_allowed"
 
+    async def check(self, message: telebot.types.Message) -> bool:  # type: ignore
+        return is_allowed(message)
 
-def allowed_whitelist(user_id: int, chat_id: int, username: Optional[str]) -> bool:
-    whitelist_store = store.WhitelistStore.get_instance()
-    if whitelist_store.is_whitelisted(user_id):
-        return True
-    if whitelist_store.is_whitelisted(chat_id):
-        return True
-    if username and whitelist_store.is_whitelisted(username.lower()):
+
+class AsyncIsAdmin(asyncio_filters.SimpleCustomFilter):
+    key = "is_admin"
+
+    async def check(self, message: telebot.types.Message) -> bool:  # type: ignore
+        return is_admin(message)
+
+
+def is_allowed(m: telebot.types.Message) -> bool:
+    chat_id = m.chat.id
+    user_id = m.from_user.id
+    username = m.from_user.username  # can be None
+    if settings.debug:
+        logger.debug(f">>> Message received from user {user_id}, chat {chat_id}")
+    return routing.Router.get_instance().is_allowed(user_id, chat_id, username)
+
+
+def is_admin(m: telebot.types.Message) -> bool:
+    admin = m.from_user.id == settings.telegram.admin_id
+    if not admin:
+        metrics.REJECTED.inc(reason="admin")
+        logger.warn(
+            f">>> Non-admin user {m.from_user.id} tried to use whitelist command, blocked"
+        )
+    return admin
+
+
+class WithinRateLimit(custom_filters.SimpleCustomFilter):
+    """
+    Drops messages exceeding rate limits before any work is started.
+    User is told when to try again, at most once per minute.
+    """
+
+    key = "within_rate_limit"
+
+    def __init__(self, outbox: sender.Sender):
+        self.outbox = outbox
+        self.notified = cache.TTLCache(maxsize=10_000, ttl=60)
+
+    def check(self, message: telebot.types.Message) -> bool:  # type: ignore
+        return within_rate_limit(self.outbox, self.notified, message)
+
+
+class AsyncWithinRateLimit(asyncio_filters.SimpleCustomFilter):
+    key = "within_rate_limit"
+
+    def __init__(self, outbox: sender.AsyncSender):
+        self.outbox = outbox
+        self.notified = cache.TTLCache(maxsize=10_000, ttl=60)
+
+    async def check(self, message: telebot.types.Message) -> bool:  # type: ignore
+        return within_rate_limit(self.outbox, self.notified, message)
+
+
+def within_rate_limit(
+    outbox: sender.Outbox, notified: cache.TTLCache, m: telebot.types.Message
+) -> bool:
+    wait = check_rate_limit(m)
+    if not wait:
         return True
+    if notified.get(m.from_user.id) is None:
+        notified.set(m.from_user.id, True)
+        outbox.reply_to(m, format_rate_limit_message(wait))
     return False
 
 
+def check_rate_limit(m: telebot.types.Message) -> float:
+    """
+    Return how many seconds the user has to wait, 0 if message is allowed.
+    """
+    limiter = ratelimit.RateLimiter.get_instance()
+    wait = limiter.acquire(m.from_user.id, m.chat.id, get_message_command(m))
+    if wait:
+        metrics.REJECTED.inc(reason="rate_limit")
+        logger.warn(
+            f">>> Message from user {m.from_user.id}, chat {m.chat.id} was rate limited"
+        )
+    return wait
+
+
+def format_rate_limit_message(wait: float) -> str:
+    """
+    Example:
+    >>> format_rate_limit_message(12.3)
+    "Too many requests, please try again in 13s"
+    """
+    if wait == float("inf"):
+        return "Too many requests, this command is disabled"
+    return f"Too many requests, please try again in {math.ceil(wait)}s"
+
+
 def get_command(text: str) -> str:
     """
     Extract command from message, example:
@@ -92,45 +158,37 @@ def clean_message_from_command(text: str) -> str:
     return text
 
 
-def find_config_by_command(cmd: str) -> Optional[model.Network]:
+@functools.lru_cache(maxsize=1024)
+def parse_message(text: Optional[str]) -> tuple[Optional[str], Optional[str]]:
     """
-    Search ReplicateNetworks and OpenAiNetworks for the one that matches the given command.
+    Return command and text without it, regexes are run only for commands
+    and once per text, filters and handlers of a message share the result:
+    >>> parse_message("/m Hello")
+    ("m", "Hello")
+    >>> parse_message(" Hello ")
+    ("", "Hello")
     """
-    if settings.integrations.replicate:
-        for network in settings.integrations.replicate.networks:
-            if network.command == cmd:
-                return network
-    if settings.integrations.openai:
-        for network in settings.integrations.openai.networks:
-            if network.command == cmd:
-                return network
-    return None
+    if not isinstance(text, str):
+        return text, text
+    if not text.startswith("/"):
+        return "", text.strip()
+    return get_command(text), clean_message_from_command(text)
 
 
-def find_config_by_name(name: str) -> Optional[model.Network]:
+def get_message_command(m: telebot.types.Message) -> str:
     """
-    Search ReplicateNetworks and OpenAiNetworks for the one that matches the given name.
+    Command of the message without slash, empty if there is none.
     """
-    if settings.integrations.replicate:
-        for network in settings.integrations.replicate.networks:
-            if network.name == name:
-                return network
-    if settings.integrations.openai:
-        for network in settings.integrations.openai.networks:
-            if network.name == name:
-                return network
-    return None
+    return parse_message(m.text)[0] or ""
 
 
-def find_config_by_type(cmd_type: str) -> Optional[model.Network]:
+def get_message_text(m: telebot.types.Message) -> str:
     """
-    Search ReplicateNetworks and OpenAiNetworks for the one that matches the given type.
+    Text of the message without command, example:
+    >>> get_message_text(message)  # message.text == "/m Hello"
+    "Hello"
     """
-    if settings.integrations.replicate:
-        for network in settings.integrations.replicate.networks:
-            if network.type == cmd_type:
-                return network
-    return None
+    return parse_message(m.text)[1] or ""
 
 
 def get_list_of_commands(user_id: int) -> str:
@@ -144,6 +202,8 @@ def get_list_of_commands(user_id: int) -> str:
     admin_commands = [
         ["whitelist [user_id|username|chat_id]", "Add user or chat to whitelist"],
         ["blacklist [user_id|username|chat_id]", "Remove user or chat from whitelist"],
+        ["stats", "Show connection pool statistics"],
+        ["breakers", "Show state of circuit breakers"],
     ]
     if user_id == settings.telegram.admin_id:
         commands.extend(admin_commands)
@@ -163,6 +223,38 @@ def get_list_of_commands(user_id: int) -> str:
     return "".join(f"<code>/{cmd}</code> - {desc}\n" for cmd, desc in commands)
 
 
+def format_connection_stats(stats: dict[str, dict]) -> str:
+    """
+    Format connection pool statistics, example:
+    >>> format_connection_stats({"api.telegram.org": {"requests": 10, "hits": 9, "misses": 1}})
+    "<code>api.telegram.org</code> - requests: 10, hits: 9, misses: 1"
+    """
+    if not stats:
+        return "No connections yet"
+    return "\n".join(
+        f"<code>{host}</code> - requests: {s['requests']}, "
+        f"hits: {s['hits']}, misses: {s['misses']}"
+        for host, s in stats.items()
+    )
+
+
+def format_breakers_state(state: dict[str, dict]) -> str:
+    """
+    Format state of circuit breakers, example:
+    >>> format_breakers_state({"c": {"state": "open", "failures": 5, "retry_in": 12.5}})
+    "<code>c</code> - open, failures: 5, retry in 12s"
+    """
+    if not state:
+        return "No requests yet"
+    lines = []
+    for network, s in state.items():
+        line = f"<code>{network}</code> - {s['state']}, failures: {s['failures']}"
+        if s["retry_in"]:
+            line += f", retry in {s['retry_in']:.0f}s"
+        lines.append(line)
+    return "\n".join(lines)
+
+
 def add_conversations_flow(
     history: list[model.ChatHistoryEntry],
 ) -> list[model.ChatHistoryEntry]:
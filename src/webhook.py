@@ -0,0 +1,119 @@
+import hmac
+import json
+import queue
+import threading
+from typing import cast
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import telebot
+
+from . import model
+from . import config
+from . import metrics
+from . import cluster
+
+logger = config.logger
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# How many queued updates to hand over to the bot at once
+BATCH_SIZE = 100
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """
+    Accepts updates POSTed by Telegram and puts them into the queue,
+    response is sent right away, handlers run in the background.
+    """
+
+    def do_POST(self):
+        server = cast("WebhookServer", self.server)
+        settings = server.settings
+        if self.path.split("?")[0] != settings.path:
+            self.send_error(404)
+            return
+        secret = self.headers.get(SECRET_HEADER, "")
+        if settings.secret_token and not hmac.compare_digest(
+            secret, settings.secret_token
+        ):
+            metrics.WEBHOOK_UPDATES.inc(result="forbidden")
+            self.send_error(403)
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length)
+            data = json.loads(body)
+        except Exception as e:
+            logger.warning(f">>> Couldn't parse update: {e}")
+            metrics.WEBHOOK_UPDATES.inc(result="invalid")
+            self.send_error(400)
+            return
+        if cluster.is_enabled() and not self.headers.get(cluster.FORWARDED_HEADER):
+            owner = cluster.get_owner(data)
+            if owner != cluster.get_worker_id():
+                self._respond(cluster.forward(owner, body))
+                return
+        try:
+            update = telebot.types.Update.de_json(data)
+        except Exception as e:
+            logger.warning(f">>> Couldn't parse update: {e}")
+            metrics.WEBHOOK_UPDATES.inc(result="invalid")
+            self.send_error(400)
+            return
+        try:
+            server.updates.put_nowait(update)
+        except queue.Full:
+            # Telegram will deliver the update again later
+            metrics.WEBHOOK_UPDATES.inc(result="rejected")
+            self.send_error(503)
+            return
+        metrics.WEBHOOK_UPDATES.inc(result="accepted")
+        self._respond(200)
+
+    def _respond(self, status: int):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WebhookServer(ThreadingHTTPServer):
+    def __init__(self, settings: model.WebhookSettings):
+        port = cluster.get_listen_port(settings.port)
+        super().__init__((settings.host, port), WebhookHandler)
+        self.settings = settings
+        self.updates: queue.Queue = queue.Queue(maxsize=settings.queue_size)
+
+
+def serve(bot: telebot.TeleBot, settings: model.WebhookSettings):
+    """
+    Receive updates with the embedded HTTP server and pass them to the bot.
+    Webhook is registered in Telegram only if url is set, without it
+    the server can be tested locally by POSTing updates to it, example:
+    >>> curl -d @update.json http://127.0.0.1:8443/webhook
+    Blocks forever.
+    """
+    server = WebhookServer(settings)
+    # In a cluster Telegram sends all updates to the same url, owners are found by workers
+    if settings.url and cluster.get_worker_id() == 0:
+        bot.set_webhook(
+            url=settings.url.rstrip("/") + settings.path,
+            secret_token=settings.secret_token or None,
+            max_connections=settings.max_connections,
+        )
+    threading.Thread(
+        target=server.serve_forever, name="webhook-server", daemon=True
+    ).start()
+    logger.info(f">>> Receiving updates on {settings.host}:{server.server_port}")
+    while True:
+        updates = [server.updates.get()]
+        while len(updates) < BATCH_SIZE:
+            try:
+                updates.append(server.updates.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            bot.process_new_updates(updates)
+        except Exception as e:
+            logger.exception(f">>> Couldn't process updates: {e}")
@@ -0,0 +1,14 @@
+"""
+Modules read settings at import time, so tests set them before importing
+anything else from src instead of reading config.toml.
+"""
+from src import model
+from src import config
+
+config.set_settings(
+    config.Config(
+        general=model.GeneralSettings(),
+        telegram=model.TelegramSettings(bot_token="1:test", admin_id=None),
+        integrations=model.Integrations(openai=None, replicate=None),
+    )
+)
@@ -0,0 +1,57 @@
+import time
+
+import pytest
+
+from src import resilience
+
+
+def test_breaker_opens_after_failures_and_lets_a_single_trial_through():
+    breaker = resilience.CircuitBreaker("test", failure_threshold=2, reset_timeout=0.05)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == resilience.CLOSED
+    breaker.record_failure()
+    assert breaker.state == resilience.OPEN
+    assert not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.state == resilience.HALF_OPEN
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == resilience.CLOSED
+    assert breaker.failures == 0
+
+
+def test_failed_trial_opens_breaker_again():
+    breaker = resilience.CircuitBreaker("test", failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == resilience.OPEN
+    assert not breaker.allow()
+
+
+def test_retry_budget_is_refilled_by_requests():
+    budget = resilience.RetryBudget(ratio=0.5, max_tokens=1)
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert budget.withdraw()
+
+
+def test_call_is_not_retried_when_budget_is_exhausted(monkeypatch):
+    monkeypatch.setattr(resilience, "retry_budget", resilience.RetryBudget(0, 0))
+    calls = []
+
+    def fail():
+        calls.append(1)
+        raise ConnectionError("Connection reset")
+
+    policy = resilience.RetryPolicy((ConnectionError,))
+    with pytest.raises(ConnectionError):
+        policy.call("budget-test", fail)
+    assert len(calls) == 1
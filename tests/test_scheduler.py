@@ -0,0 +1,43 @@
+import threading
+
+import pytest
+
+from src import model
+from src import config
+from src import scheduler
+
+settings = config.get_settings()
+
+NETWORK = model.Network(
+    name="chat", command="lane-test", version="", type="text", history_tokens=None
+)
+
+
+def test_lane_runs_jobs_in_order_and_rejects_jobs_beyond_lane_size():
+    jobs = scheduler.Scheduler.get_instance()
+    release = threading.Event()
+    done = threading.Event()
+    ran: list[int] = []
+
+    def job(n: int):
+        release.wait()
+        ran.append(n)
+        if n == settings.scheduler.lane_size:
+            done.set()
+
+    assert jobs.submit(NETWORK, job, 0, key="1:1") == 0
+    positions = [
+        jobs.submit(NETWORK, job, n, key="1:1")
+        for n in range(1, settings.scheduler.lane_size + 1)
+    ]
+    assert positions == list(range(1, settings.scheduler.lane_size + 1))
+    with pytest.raises(model.QueueFullException):
+        jobs.submit(NETWORK, job, -1, key="1:1")
+    # Other conversations have their own lanes
+    other = threading.Event()
+    jobs.submit(NETWORK, other.set, key="1:2")
+    assert other.wait(timeout=5)
+
+    release.set()
+    assert done.wait(timeout=5)
+    assert ran == list(range(settings.scheduler.lane_size + 1))
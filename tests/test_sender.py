@@ -0,0 +1,66 @@
+import threading
+
+from telebot.apihelper import ApiTelegramException
+
+from src import model
+from src import sender
+
+UNLIMITED = model.RateLimit(per_minute=60_000, burst=1000)
+SETTINGS = model.SenderSettings(total=UNLIMITED, private=UNLIMITED, group=UNLIMITED)
+
+
+def flood_error(retry_after: float) -> ApiTelegramException:
+    result_json = {
+        "error_code": 429,
+        "description": "Too Many Requests",
+        "parameters": {"retry_after": retry_after},
+    }
+    return ApiTelegramException("sendMessage", None, result_json)
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent: list[str] = []
+        self.edits: list[tuple[str, int]] = []
+        self.flood_on: set[str] = set()
+        self.release = threading.Event()
+        self.release.set()
+
+    def send_message(self, chat_id: int, text: str, **kwargs):
+        self.release.wait()
+        if text in self.flood_on:
+            self.flood_on.remove(text)
+            self.sent.append(f"{text}:429")
+            raise flood_error(0.1)
+        self.sent.append(text)
+        return text
+
+    def edit_message_text(self, text: str, chat_id: int, message_id: int, **kwargs):
+        self.edits.append((text, message_id))
+        return text
+
+
+def test_chat_keeps_order_after_retry_after():
+    bot = FakeBot()
+    bot.flood_on.add("1")
+    outbox = sender.Sender(bot, SETTINGS)  # type: ignore[arg-type]
+    futures = [outbox.send_message(1, text) for text in ("1", "2", "3")]
+    assert [f.result(timeout=5) for f in futures] == ["1", "2", "3"]
+    assert bot.sent == ["1:429", "1", "2", "3"]
+
+
+def test_queued_edits_of_a_message_are_merged():
+    bot = FakeBot()
+    bot.release.clear()
+    outbox = sender.Sender(bot, SETTINGS)  # type: ignore[arg-type]
+    # Keeps the chat busy while edits are queued
+    sent = outbox.send_message(1, "Generating text...")
+    first = outbox.edit_message_text("first", chat_id=1, message_id=5)
+    last = outbox.edit_message_text("last", chat_id=1, message_id=5)
+    other = outbox.edit_message_text("other", chat_id=1, message_id=6)
+    bot.release.set()
+    assert first is last
+    assert last.result(timeout=5) == "last"
+    assert other.result(timeout=5) == "other"
+    assert sent.result(timeout=5) == "Generating text..."
+    assert bot.edits == [("last", 5), ("other", 6)]
@@ -0,0 +1,107 @@
+import time
+import asyncio
+import threading
+
+import pytest
+
+from src import singleflight
+
+
+def test_follower_gets_error_of_the_leader():
+    flights = singleflight.SingleFlight("test")
+    release = threading.Event()
+    calls = []
+    errors: list[Exception] = []
+
+    def fail():
+        calls.append(1)
+        release.wait()
+        raise ValueError("Prediction failed")
+
+    def follow():
+        try:
+            flights.do("key", fail)
+        except ValueError as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=follow)
+    leader.start()
+    follower = threading.Thread(target=follow)
+    follower.start()
+    # Let the follower join the call in flight
+    time.sleep(0.05)
+    release.set()
+    leader.join(timeout=5)
+    follower.join(timeout=5)
+    assert len(calls) == 1
+    assert len(errors) == 2 and errors[0] is errors[1]
+    assert not flights.calls
+
+
+def test_async_follower_gets_error_of_the_leader():
+    async def run():
+        flights = singleflight.AsyncSingleFlight("test")
+        release = asyncio.Event()
+
+        async def fail():
+            await release.wait()
+            raise ValueError("Prediction failed")
+
+        leader = asyncio.create_task(flights.do("key", fail))
+        follower = asyncio.create_task(flights.do("key", fail))
+        await asyncio.sleep(0)
+        release.set()
+        for task in (leader, follower):
+            with pytest.raises(ValueError):
+                await task
+        assert not flights.calls
+
+    asyncio.run(run())
+
+
+def test_async_follower_gets_result_when_leader_is_cancelled():
+    async def run():
+        flights = singleflight.AsyncSingleFlight("test")
+        release = asyncio.Event()
+        calls = []
+
+        async def predict():
+            calls.append(1)
+            await release.wait()
+            return "a cat"
+
+        leader = asyncio.create_task(flights.do("key", predict))
+        follower = asyncio.create_task(flights.do("key", predict))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        assert await follower == "a cat"
+        assert leader.cancelled()
+        assert len(calls) == 1
+
+    asyncio.run(run())
+
+
+def test_async_call_is_cancelled_when_every_caller_is_gone():
+    async def run():
+        flights = singleflight.AsyncSingleFlight("test")
+        cancelled = asyncio.Event()
+
+        async def predict():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        callers = [asyncio.create_task(flights.do("key", predict)) for _ in range(2)]
+        await asyncio.sleep(0)
+        for caller in callers:
+            caller.cancel()
+            await asyncio.sleep(0)
+        await asyncio.wait_for(cancelled.wait(), 1)
+        await asyncio.sleep(0)
+        assert not flights.calls
+
+    asyncio.run(run())
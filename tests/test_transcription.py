@@ -0,0 +1,53 @@
+from pathlib import Path
+from typing import Optional
+
+from src import transcription
+
+# chunk_duration = 60, chunk_overlap = 2: chunks start at 0, 58, 116
+CHUNKS: list[tuple[float, Path]] = [(0, Path("chunk-0.ogg")), (58, Path("chunk-1.ogg"))]
+Results = list[tuple[list[dict], Optional[str]]]
+
+
+def segment(start: float, end: float, text: str) -> dict:
+    return {"start": start, "end": end, "text": f" {text}"}
+
+
+def test_segments_are_taken_from_the_chunk_their_middle_falls_into():
+    results: Results = [
+        ([segment(0, 30, "One."), segment(30, 59.5, "Two.")], None),
+        ([segment(0, 1.5, "Two."), segment(1.5, 20, "Three.")], None),
+    ]
+    assert transcription._stitch(CHUNKS, results) == ("One. Two. Three.", None)
+
+
+def test_segment_crossing_the_end_of_previous_chunk_is_kept():
+    # Starts before the middle of the overlap, but the first chunk ends at 60
+    results: Results = [
+        ([segment(0, 58.5, "One two three."), segment(58.5, 60, "Four")], None),
+        ([segment(0.5, 8, "four five six.")], None),
+    ]
+    assert transcription._stitch(CHUNKS, results) == (
+        "One two three. four five six.",
+        None,
+    )
+
+
+def test_segment_crossing_the_start_of_next_chunk_is_kept():
+    # Next chunk starts at 58, the segment is cut there
+    results: Results = [
+        ([segment(0, 50, "One."), segment(50, 60, "Two three four")], None),
+        ([segment(0, 6, "three four five.")], None),
+    ]
+    assert transcription._stitch(CHUNKS, results) == (
+        "One. Two three four five.",
+        None,
+    )
+
+
+def test_error_of_any_chunk_is_returned():
+    results: Results = [([segment(0, 30, "One.")], None), ([], "Error")]
+    assert transcription._stitch(CHUNKS, results) == ("", "Error")
+
+
+def test_single_repeated_word_is_kept():
+    assert transcription._merge_texts("It is", "is it?") == "It is is it?"